@@ -1,10 +1,41 @@
-from typing import Dict, List
+"""
+Add jobs to the Job collection.
 
+Bulk ingestion streams JSONL / CSV job definitions from a file or stdin:
+    python add_jobs.py jobs.jsonl [--format jsonl|csv] [--chunk-size 1000] [--workers N]
+    cat jobs.csv | python add_jobs.py - --format csv --rejects rejects.jsonl
+Rows are validated in a process pool (fields, cron, source compiles) and written in
+unordered insert_many chunks, so memory stays flat whatever the size of the input.
+Rejected rows are reported with their line number and the reason, rows setting the
+scheduler's own fields (sync, to_be_deleted, updated_at) are rejected as well.
+CSV cells are parsed as JSON (cron object, deps array, numbers), deps may also be space
+separated, code and name are taken as is.
+"""
+
+import argparse
+import csv
+import json
+import os
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, TextIO, Tuple
+
+from apscheduler.triggers.cron import CronTrigger
 from mongoengine import *
+from mongoengine.errors import FieldDoesNotExist
+from pymongo.errors import BulkWriteError
 
+from libs.code import compile_src
 from libs.db import Job
 from utils import get_URI
 
+Row = Tuple[int, Optional[Dict], Optional[str]]  # line number, job definition / document, error
+
+CSV_TEXT_COLUMNS = ("code", "name")
+INTERNAL_FIELDS = ("sync", "to_be_deleted", "updated_at")  # managed by the scheduler
+VALIDATE_BATCH = 256  # rows per pool task
+
 # Sample
 # jobs = [
 #     {
@@ -40,14 +71,194 @@ def add_jobs(jobs: List[Dict]):
     return rows
 
 
-if __name__ == "__main__":
-    jobs = [
-        {
-            "cron": {"hour": "*", "minute": "*", "second": "0/5"},
-            "deps": ["Flask==2.1.2"],
-            "code": """import datetime\nimport time\nprint(datetime.datetime.now(), flush=True)\ntime.sleep(10)\nprint(datetime.datetime.now(), flush=True)""",
-        },
-    ]
+def read_jsonl(stream: TextIO) -> Iterator[Row]:
+    for line_no, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            yield line_no, json.loads(line), None
+        except ValueError as E:
+            yield line_no, None, f"invalid JSON: {E}"
+
+
+def csv_cell(column: str, value: str):
+    if column in CSV_TEXT_COLUMNS:
+        return value
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value.split() if column == "deps" else value
+
+
+def read_csv(stream: TextIO) -> Iterator[Row]:
+    reader = csv.DictReader(stream)
+    for row in reader:
+        line_no = reader.line_num  # last line of the row, cells may span lines
+        if None in row:
+            yield line_no, None, "more cells than columns"
+            continue
+        yield line_no, {k: csv_cell(k, v) for k, v in row.items() if v not in ("", None)}, None
+
+
+def validate_job(job: Dict) -> Dict:
+    """
+    Check a job definition the way the scheduler uses it.
+    :param dict job: Job fields.
+    :return: Document to insert.
+    :rtype: dict
+    :raise ValueError: Reason of the rejection.
+    """
+    if not isinstance(job, dict):
+        raise ValueError("not an object")
+
+    internal = [field for field in INTERNAL_FIELDS if field in job]
+    if internal:  # e.g. sync=True would never be scheduled
+        raise ValueError(f"internal fields can't be set: {', '.join(internal)}")
+
+    try:
+        doc = Job(**job)
+        doc.validate()
+    except (FieldDoesNotExist, ValidationError) as E:
+        raise ValueError(str(E))
+
+    try:
+        CronTrigger(**doc.cron)
+    except (ValueError, TypeError) as E:
+        raise ValueError(f"invalid cron: {E}")
+
+    try:
+        compile_src(doc.code)
+    except (SyntaxError, ValueError) as E:
+        raise ValueError(f"{type(E).__name__}: {E}")
+
+    return doc.to_mongo().to_dict()
+
+
+def validate_rows(rows: List[Row]) -> List[Row]:
+    """
+    Pool task, validate a batch of rows.
+    """
+    results = []
+    for line_no, job, error in rows:
+        if error is None:
+            try:
+                job = validate_job(job)
+            except ValueError as E:
+                job, error = None, str(E)
+        results.append((line_no, job, error))
+    return results
+
+
+def batches(rows: Iterable[Row], size: int) -> Iterator[List[Row]]:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def ingest(
+    stream: TextIO,
+    fmt: str = "jsonl",
+    chunk_size: int = 1000,
+    workers: Optional[int] = None,
+    on_reject: Optional[Callable[[int, str], None]] = None,
+) -> Dict[str, int]:
+    """
+    Stream job definitions into the Job collection.
+    :param stream: JSONL / CSV text.
+    :param str fmt: jsonl | csv.
+    :param int chunk_size: Documents per insert_many.
+    :param int workers: Validation processes, the CPU count by default, 0 to validate in process.
+    :param on_reject: Called with the line number and the reason of every rejected row.
+    :return: Counts of the rows read, inserted and rejected.
+    :rtype: dict
+    """
+    report = {"read": 0, "inserted": 0, "rejected": 0}
+    chunk: List[Tuple[int, Dict]] = []
+
+    def reject(line_no: int, error: str) -> None:
+        report["rejected"] += 1
+        if on_reject is not None:
+            on_reject(line_no, error)
+
+    def flush() -> None:
+        if not chunk:
+            return
+
+        try:  # unordered, a failed document doesn't stop the rest of the chunk
+            result = Job._get_collection().insert_many([doc for _, doc in chunk], ordered=False)
+            report["inserted"] += len(result.inserted_ids)
+        except BulkWriteError as E:
+            report["inserted"] += E.details["nInserted"]
+            for error in E.details["writeErrors"]:
+                reject(chunk[error["index"]][0], error["errmsg"])
+        chunk.clear()
+
+    def collect(rows: List[Row]) -> None:
+        for line_no, doc, error in rows:
+            report["read"] += 1
+            if error is not None:
+                reject(line_no, error)
+                continue
+
+            chunk.append((line_no, doc))
+            if len(chunk) >= chunk_size:
+                flush()
+
+    rows = read_csv(stream) if fmt == "csv" else read_jsonl(stream)
+
+    if workers == 0:
+        for batch in batches(rows, VALIDATE_BATCH):
+            collect(validate_rows(batch))
+    else:
+        workers = workers or os.cpu_count() or 1
+        with ProcessPoolExecutor(workers) as pool:
+            pending = deque()  # bounded, the input is read as fast as it is validated
+            for batch in batches(rows, VALIDATE_BATCH):
+                pending.append(pool.submit(validate_rows, batch))
+                if len(pending) >= 2 * workers:
+                    collect(pending.popleft().result())
+            while pending:
+                collect(pending.popleft().result())
+
+    flush()
+    return report
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description="Stream job definitions into the Job collection.")
+    parser.add_argument("path", nargs="?", default="-", help="File to read, - for stdin.")
+    parser.add_argument(
+        "--format", choices=("jsonl", "csv"), help="By the file extension, jsonl for stdin."
+    )
+    parser.add_argument("--chunk-size", type=int, default=1000, help="Documents per insert.")
+    parser.add_argument("--workers", type=int, default=None, help="Validation processes.")
+    parser.add_argument("--rejects", help="Rejected rows as JSONL, stderr by default.")
+    args = parser.parse_args(argv)
+
+    fmt = args.format or ("csv" if args.path.endswith(".csv") else "jsonl")
+    rejects = open(args.rejects, "w") if args.rejects else sys.stderr
+
+    def on_reject(line_no: int, error: str) -> None:
+        rejects.write(json.dumps({"line": line_no, "error": error}) + "\n")
 
     setup()
-    add_jobs(jobs)
+    stream = sys.stdin if args.path == "-" else open(args.path, newline="")
+    try:
+        report = ingest(stream, fmt, args.chunk_size, args.workers, on_reject)
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+        if rejects is not sys.stderr:
+            rejects.close()
+
+    print(json.dumps(report))
+    return 1 if report["rejected"] > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
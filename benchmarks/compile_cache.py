@@ -0,0 +1,63 @@
+"""
+Startup benchmark of Code construction over stored jobs, with and without the compile cache.
+Usage: python -m benchmarks.compile_cache [num_jobs]
+"""
+
+import json
+import sys
+import tempfile
+import time
+
+import libs.code
+from libs.cache import CompileCache
+from libs.code import Code
+
+TEMPLATE = """import json
+import datetime
+
+def parse(payload):
+    data = json.loads(payload)
+    return {{k: v * {n} for k, v in data.items() if isinstance(v, int)}}
+
+class Report:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def render(self):
+        lines = []
+        for i, row in enumerate(self.rows):
+            lines.append(f"{{i}}: {{row}} @ {{datetime.datetime.now()}}")
+        return "\\n".join(lines)
+
+result = parse('{{"a": {n}, "b": 2, "c": "x"}}')
+print(Report([result] * 3).render())"""
+
+
+def build(sources, cache) -> float:
+    libs.code.compile_cache = cache
+    start = time.perf_counter()
+
+    for n, src in enumerate(sources):
+        Code(f"bench_{n}", src)
+
+    return time.perf_counter() - start
+
+
+def main(num_jobs: int = 10000) -> dict:
+    sources = [TEMPLATE.format(n=n) for n in range(num_jobs)]
+    results = {"num_jobs": num_jobs}
+
+    with tempfile.TemporaryDirectory() as directory:
+        results["no_cache_s"] = build(sources, CompileCache(None, max_size=0))
+        results["cold_cache_s"] = build(sources, CompileCache(directory, num_jobs))
+        results["restart_disk_cache_s"] = build(sources, CompileCache(directory, num_jobs))
+
+        cache = CompileCache(directory, num_jobs)
+        build(sources, cache)
+        results["resync_memory_cache_s"] = build(sources, cache)
+
+    return results
+
+
+if __name__ == "__main__":
+    print(json.dumps(main(*map(int, sys.argv[1:])), indent=2))
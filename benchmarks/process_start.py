@@ -0,0 +1,50 @@
+"""
+Start-up latency of process executor runs, cold spawn vs warm forkserver with deps preloaded,
+and the app's own runner with main.py as the main module, which the workers must not re-run.
+Usage: python -m benchmarks.process_start [runs] [module ...]
+"""
+
+import json
+import sys
+import time
+
+from libs.runner import ProcessRunner
+
+
+def measure(runner: ProcessRunner, src: str, runs: int) -> float:
+    start = time.perf_counter()
+
+    for n in range(runs):
+        runner.run(f"bench_{n}", src, timeout=60)
+
+    return (time.perf_counter() - start) / runs
+
+
+def measure_app(runs: int) -> float:
+    import main as app
+
+    sys.modules["__main__"] = app  # as with python -m main
+    app.runner.preload([], force=True)
+    app.runner.run("bench_warmup", "pass", timeout=60)
+    return measure(app.runner, "pass", runs)
+
+
+def main(runs: int = 10, *modules: str) -> dict:
+    modules = modules or ("apscheduler.schedulers.background", "mongoengine")
+    src = "\n".join(f"import {module}" for module in modules)
+
+    forkserver = ProcessRunner("forkserver")
+    forkserver.preload(modules)
+
+    return {
+        "modules": list(modules),
+        "runs": runs,
+        "spawn_s_per_run": measure(ProcessRunner("spawn"), src, runs),
+        "forkserver_preloaded_s_per_run": measure(forkserver, src, runs),
+        "app_main_s_per_run": measure_app(runs),
+    }
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    print(json.dumps(main(int(args[0]) if args else 10, *args[1:]), indent=2))
@@ -0,0 +1,203 @@
+"""
+Bytes read and query time of a sync pass over a large Job collection, with the legacy
+query shape (full documents, no indexes) against the projected / indexed one. Both run
+fetch_store itself, the time is its "query" phase as recorded in FETCH_PHASE; the legacy
+shape is fetch_store with its projections turned off on a collection without indexes.
+Runs against mongomock by default, pass --uri to measure a real server, where the
+partial indexes change the query plans as well. mongomock matches $in in quadratic time,
+which dominates the full passes past a few thousand jobs there.
+
+Usage: python -m benchmarks.queries [--sizes 1000,10000] [--uri mongodb://localhost/bench]
+"""
+
+import argparse
+import json
+import sys
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Tuple
+from unittest import mock
+
+import bson
+from mongoengine import connect, disconnect
+from mongoengine.queryset.base import BaseQuerySet
+
+import libs.code
+import main as app
+from benchmarks.suite import quiet_logger
+from libs.cache import CompileCache
+from libs.db import Job
+from libs.deps import DependencyManager, PackageIndex
+from libs.metrics import FETCH_PHASE
+from libs.store import Store
+
+CODE = "import json\nimport datetime\n\n" + "\n".join(
+    f"value_{n} = json.dumps({{'n': {n}, 'at': str(datetime.datetime.now())}})" for n in range(12)
+)  # ~1KB, a typical job body
+
+
+def populate(collection, size: int, out_of_sync: float, deleted: float, held: float) -> None:
+    collection.delete_many({})
+    docs = []
+
+    for n in range(size):
+        stale = n % int(1 / out_of_sync) == 0
+        missing = stale and (n // int(1 / out_of_sync)) % int(1 / held) == 0  # of the stale ones
+        docs.append(
+            {
+                "cron": {"minute": str(n % 60)},
+                "deps": ["missing-package" if missing else "APScheduler"],
+                "code": CODE.replace("value_", f"value_{n}_"),
+                "name": f"job {n}",
+                "sync": not stale,
+                "to_be_deleted": n % int(1 / deleted) == 1,
+                "executor": "thread",
+            }
+        )
+
+        if len(docs) == 10000:
+            collection.insert_many(docs)
+            docs = []
+
+    if docs:
+        collection.insert_many(docs)
+
+
+class MeteredCursor:
+    """
+    Cursor counting the BSON bytes of the documents it yields.
+    """
+
+    def __init__(self, cursor, meter: List[int]) -> None:
+        self._cursor = cursor
+        self._meter = meter
+
+    def __getattr__(self, name):
+        attr = getattr(self._cursor, name)
+        if not callable(attr):
+            return attr
+
+        def chained(*args, **kwargs):  # batch_size, hint... return the cursor itself
+            result = attr(*args, **kwargs)
+            return self if result is self._cursor else result
+
+        return chained
+
+    def __iter__(self) -> "MeteredCursor":
+        return self
+
+    def __next__(self) -> Dict:
+        doc = next(self._cursor)
+        self._meter[0] += len(bson.encode(doc))
+        return doc
+
+    next = __next__
+
+
+class MeteredCollection:
+    def __init__(self, collection, meter: List[int]) -> None:
+        self._collection = collection
+        self._meter = meter
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+    def find(self, *args, **kwargs) -> MeteredCursor:
+        return MeteredCursor(self._collection.find(*args, **kwargs), self._meter)
+
+
+@contextmanager
+def legacy_shape() -> Iterator[None]:
+    """
+    Full documents for every query of fetch_store, as it loaded them before.
+    """
+    with mock.patch.object(BaseQuerySet, "only", lambda queryset, *fields: queryset):
+        yield
+
+
+def sync_pass(logger: app.Logger, full: bool) -> Tuple[int, float]:
+    """
+    One fetch_store pass from an empty store.
+    :return: (bytes read, seconds of the query phase).
+    """
+    state = app.State()
+    state.store = Store(scheduler=app.scheduler)
+    app.scheduler.remove_all_jobs()
+
+    meter = [0]
+    collection = Job._get_collection()
+    before = FETCH_PHASE.total(phase="query")
+    with mock.patch.object(Job, "_collection", MeteredCollection(collection, meter)):
+        app.fetch_store(state, logger, fetch_all=full)
+
+    for synced in list(app.deps_synced):  # held back jobs, failed installs
+        synced.result()
+    return meter[0], FETCH_PHASE.total(phase="query") - before
+
+
+def plans(collection, full: bool) -> Dict[str, str]:
+    """
+    Winning plan stage of the sync pass queries, on a real server only.
+    """
+    try:
+        return {
+            name: collection.find(filter).explain()["queryPlanner"]["winningPlan"].get("stage", "")
+            for name, filter in (("delete", {"to_be_deleted": True}), ("sync", {"sync": False}))
+            if full is False
+        }
+    except Exception:  # mongomock has no query planner
+        return {}
+
+
+def bench(sizes: List[int], uri: str) -> Dict[str, float]:
+    results = {}
+    disconnect()
+    connect(db="bench", host=uri)
+    collection = Job._get_collection()
+    logger = quiet_logger()
+
+    state = app.State()
+    state.deps = PackageIndex()
+    manager = DependencyManager(pip=[sys.executable, "-c", "raise SystemExit(1)"])
+    app.deps_manager = manager  # "missing-package" fails right away instead of hitting PyPI
+
+    for size in sizes:
+        libs.code.compile_cache = CompileCache(None, size)
+
+        for name, full in (("incremental", False), ("full", True)):
+            # the pass deletes and syncs jobs, every shape starts from the same collection
+            populate(collection, size, out_of_sync=0.01, deleted=0.001, held=0.1)
+            collection.drop_indexes()  # Job declared no indexes before
+            with legacy_shape():
+                total, elapsed = sync_pass(logger, full)
+            results[f"queries.{size}.{name}.legacy_bytes"] = total
+            results[f"queries.{size}.{name}.legacy_s"] = elapsed
+
+            populate(collection, size, out_of_sync=0.01, deleted=0.001, held=0.1)
+            Job.ensure_indexes()
+            total, elapsed = sync_pass(logger, full)
+            results[f"queries.{size}.{name}.projected_bytes"] = total
+            results[f"queries.{size}.{name}.projected_s"] = elapsed
+
+            for query, stage in plans(collection, full).items():
+                results[f"queries.{size}.{name}.{query}_plan"] = stage
+
+    app.scheduler.remove_all_jobs()
+    manager.shutdown()
+    collection.drop()
+    disconnect()
+    return results
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--sizes", default="1000,10000")
+    parser.add_argument("--uri", default="mongomock://localhost")
+    args = parser.parse_args(argv)
+
+    results = bench([int(size) for size in args.sizes.split(",")], args.uri)
+    print(json.dumps(results, indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,294 @@
+"""
+Benchmark suite of the scheduler's hot paths, against mongomock instead of the live cluster.
+Prints a flat JSON of the results, keys ending in _s / _us are times (lower is better),
+keys ending in _per_s are throughputs (higher is better).
+
+Usage: python -m benchmarks.suite [--sizes 100,1000,10000,100000] [--out results.json]
+                                  [--compare baseline.json] [--tolerance 0.2]
+With --compare, exits with 1 if a result regressed by more than the tolerance.
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+from apscheduler.events import EVENT_JOB_EXECUTED
+from apscheduler.schedulers.background import BackgroundScheduler
+from mongoengine import connect, disconnect
+
+import libs.code
+import main as app
+from libs.cache import CompileCache
+from libs.code import Code, PatchStd
+from libs.db import Job
+from libs.deps import PackageIndex
+from libs.executor import AdaptiveThreadPoolExecutor
+from libs.metrics import FETCH_PHASE
+from libs.store import Store
+
+SRC = "import json\nresult = json.dumps({{'n': {n}}})\nprint(result)"
+DEP = "APScheduler"  # installed, jobs are never held back
+PHASES = ("delete", "query", "pip", "compile", "schedule")
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)] if values else 0.0
+
+
+def quiet_logger() -> app.Logger:
+    logger = app.Logger()
+    for name in ("root_logger", "pip_logger", "code_logger"):
+        bench = logging.getLogger(f"bench.{name}")
+        bench.setLevel(logging.WARNING)
+        setattr(logger, name, bench)
+    return logger
+
+
+def bench_fetch_store(sizes: List[int]) -> Dict[str, float]:
+    results = {}
+    logger = quiet_logger()
+
+    for size in sizes:
+        disconnect()
+        connect(db="bench", host="mongomock://localhost")
+        Job.drop_collection()
+        app.scheduler.remove_all_jobs()
+        libs.code.compile_cache = CompileCache(None, size)
+
+        state = app.State()
+        state.store = Store(scheduler=app.scheduler)
+        state.deps = PackageIndex()
+
+        start = time.perf_counter()
+        rows = [
+            Job(cron={"minute": str(n % 60)}, deps=[DEP], code=SRC.format(n=n))
+            for n in range(size)
+        ]
+        Job.objects.insert(rows, load_bulk=False)
+        results[f"fetch_store.{size}.insert_s"] = time.perf_counter() - start
+
+        phases = {phase: FETCH_PHASE.total(phase=phase) for phase in PHASES}
+        start = time.perf_counter()
+        app.fetch_store(state, logger, fetch_all=True)
+        results[f"fetch_store.{size}.full_s"] = time.perf_counter() - start
+
+        for phase, before in phases.items():
+            results[f"fetch_store.{size}.{phase}_s"] = FETCH_PHASE.total(phase=phase) - before
+
+        # nothing changed, the incremental pass only queries
+        start = time.perf_counter()
+        app.fetch_store(state, logger)
+        results[f"fetch_store.{size}.incremental_s"] = time.perf_counter() - start
+
+        # 1% of the jobs edited
+        edited = Job.objects.limit(max(size // 100, 1))
+        for job in edited:
+            job.update(set__code=job.code + "\nprint('edited')", set__sync=False)
+        start = time.perf_counter()
+        app.fetch_store(state, logger)
+        results[f"fetch_store.{size}.edit_1pct_s"] = time.perf_counter() - start
+
+        assert len(state.store.index) == size
+
+    app.scheduler.remove_all_jobs()
+    disconnect()
+    return results
+
+
+def bench_code(num: int) -> Dict[str, float]:
+    results = {}
+    sources = [SRC.format(n=n) for n in range(num)]
+
+    libs.code.compile_cache = CompileCache(None, num)
+    start = time.perf_counter()
+    codes = [Code(f"bench_{n}", src) for n, src in enumerate(sources)]
+    results["code.construct_per_s"] = num / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    lazy = [Code(f"bench_lazy_{n}", src, lazy=True) for n, src in enumerate(sources)]
+    results["code.construct_lazy_cached_per_s"] = num / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for code in codes:
+        code.run_with_std_patch()
+    results["code.execute_per_s"] = num / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(20) as executor:
+        list(executor.map(lambda code: code.run_with_std_patch(), codes))
+    results["code.execute_20_threads_per_s"] = num / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for code in lazy:
+        code.run_with_std_patch()
+    results["code.execute_lazy_per_s"] = num / (time.perf_counter() - start)
+
+    return results
+
+
+def bench_store(sizes: List[int]) -> Dict[str, float]:
+    results = {}
+
+    for size in sizes:
+        store = Store()
+        codes = [Code(f"bench_store_{n}", "pass", lazy=True) for n in range(size)]
+
+        start = time.perf_counter()
+        for n, code in enumerate(codes):
+            store.add(f"bucket_{n % 60}", code)
+        results[f"store.{size}.add_us"] = (time.perf_counter() - start) / size * 1e6
+
+        start = time.perf_counter()
+        for code in codes:
+            store.locate(code.name)
+        results[f"store.{size}.locate_us"] = (time.perf_counter() - start) / size * 1e6
+
+        start = time.perf_counter()
+        for code in codes:
+            store.remove(code.name)
+        results[f"store.{size}.remove_us"] = (time.perf_counter() - start) / size * 1e6
+
+    return results
+
+
+def bench_dispatch(
+    num_jobs: int = 200, workers: int = 4, run_time: float = 0.02
+) -> Dict[str, float]:
+    """
+    Lag between the scheduled and the actual start of runs, more runs at one instant than workers.
+    """
+    scheduler = BackgroundScheduler(
+        executors={"default": AdaptiveThreadPoolExecutor(min_workers=1, max_workers=workers)}
+    )
+    lags: List[float] = []
+    lock = threading.Lock()
+    done = threading.Event()
+
+    def job(scheduled: datetime) -> None:
+        with lock:
+            lags.append((datetime.now(scheduled.tzinfo) - scheduled).total_seconds())
+        time.sleep(run_time)
+
+    def on_executed(_) -> None:
+        if len(lags) >= num_jobs:
+            done.set()
+
+    scheduler.add_listener(on_executed, EVENT_JOB_EXECUTED)
+    scheduler.start()
+
+    run_date = datetime.now(scheduler.timezone) + timedelta(seconds=0.5)
+    for n in range(num_jobs):
+        scheduler.add_job(
+            job, "date", run_date=run_date, args=[run_date], misfire_grace_time=None
+        )
+
+    done.wait(60)
+    scheduler.shutdown()
+
+    return {
+        "dispatch.lag_p50_s": percentile(lags, 0.5),
+        "dispatch.lag_p99_s": percentile(lags, 0.99),
+        "dispatch.lag_max_s": max(lags) if lags else 0.0,
+        "dispatch.ideal_drain_s": num_jobs * run_time / workers,
+    }
+
+
+def bench_capture(lines: int = 100000) -> Dict[str, float]:
+    results = {}
+    text = "x" * 60
+
+    def emit(file=None) -> float:
+        start = time.perf_counter()
+        for _ in range(lines):
+            print(text, file=file)
+        return (time.perf_counter() - start) / lines * 1e6
+
+    results["capture.baseline_stringio_us"] = emit(io.StringIO())
+
+    with PatchStd():
+        results["capture.patched_us"] = emit()
+
+    with PatchStd(limit=4096):
+        results["capture.patched_bounded_4k_us"] = emit()
+
+    with PatchStd(on_line=lambda line: None):
+        results["capture.patched_streaming_us"] = emit()
+
+    return results
+
+
+def compare(results: Dict[str, float], baseline: Dict[str, float], tolerance: float) -> List[str]:
+    regressions = []
+
+    for key, value in results.items():
+        base = baseline.get(key)
+        if not base:
+            continue
+
+        if key.endswith("_per_s"):
+            regressed = value < base * (1 - tolerance)
+        elif key.endswith("_s") or key.endswith("_us"):
+            regressed = value > base * (1 + tolerance)
+        else:
+            regressed = False
+
+        if regressed:
+            regressions.append(f"{key}: {base:.6g} -> {value:.6g}")
+
+    return regressions
+
+
+def run(sizes: List[int]) -> Dict[str, float]:
+    results = {}
+    results.update(bench_fetch_store(sizes))
+    results.update(bench_code(min(max(sizes), 10000)))
+    results.update(bench_store(sizes))
+    results.update(bench_dispatch())
+    results.update(bench_capture())
+    return results
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--sizes", default="100,1000,10000,100000")
+    parser.add_argument("--out", help="Write the results to this file as well.")
+    parser.add_argument("--compare", help="Baseline results to check for regressions.")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "timestamp": datetime.utcnow().isoformat(),
+        "results": run([int(size) for size in args.sizes.split(",")]),
+    }
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    print(output)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report["results"], json.load(f)["results"], args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
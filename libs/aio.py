@@ -0,0 +1,112 @@
+"""
+Shared asyncio event loop for coroutine jobs.
+The loop runs in its own thread next to the scheduler's thread pool, so thousands of
+I/O-bound jobs waiting on the network share one thread instead of holding one each.
+"""
+
+import asyncio
+import sys
+import threading
+from concurrent.futures import Future
+from typing import Coroutine, Optional, Set
+
+from apscheduler.executors.base import BaseExecutor, run_job
+from apscheduler.executors.base_py3 import run_coroutine_job
+
+
+class EventLoopThread:
+    """
+    Event loop running forever in a daemon thread, started on first use.
+    """
+
+    def __init__(self, name: str = "asyncio") -> None:
+        self.name = name
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def start(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._thread is None:
+                self.loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+            return self.loop
+
+    def _run(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro: Coroutine) -> Future:
+        """
+        Schedule the coroutine on the loop from any thread.
+        :param coro: Coroutine.
+        :return: Future resolved with the coroutine's result.
+        :rtype: Future
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.start())
+
+    def stop(self, wait: bool = True) -> None:
+        with self._lock:
+            thread, loop = self._thread, self.loop
+            self._thread = None
+
+        if thread is None:
+            return
+
+        loop.call_soon_threadsafe(loop.stop)
+        if wait:
+            thread.join()
+            loop.close()
+
+
+async def run_blocking_job(job, jobstore_alias, run_times, logger_name):
+    return await asyncio.get_event_loop().run_in_executor(
+        None, run_job, job, jobstore_alias, run_times, logger_name
+    )
+
+
+class LoopThreadExecutor(BaseExecutor):
+    """
+    APScheduler executor running coroutine jobs on an EventLoopThread, for the
+    blocking / background schedulers which don't own an event loop.
+    Other jobs run in the loop's default thread pool.
+    :param EventLoopThread loop_thread: Loop the jobs run on, a new one by default.
+    """
+
+    def __init__(self, loop_thread: Optional[EventLoopThread] = None) -> None:
+        super().__init__()
+        self.loop_thread = loop_thread or EventLoopThread()
+        self._pending: Set[Future] = set()
+
+    def start(self, scheduler, alias) -> None:
+        super().start(scheduler, alias)
+        self.loop_thread.start()
+
+    def shutdown(self, wait: bool = True) -> None:
+        for future in list(self._pending):
+            future.cancel()
+        self.loop_thread.stop(wait)
+
+    def _do_submit_job(self, job, run_times) -> None:
+        def callback(future: Future) -> None:
+            self._pending.discard(future)
+            try:
+                events = future.result()
+            except BaseException:
+                self._run_job_error(job.id, *sys.exc_info()[1:])
+            else:
+                self._run_job_success(job.id, events)
+
+        if getattr(job.func, "is_coroutine", False) or asyncio.iscoroutinefunction(job.func):
+            future = self.loop_thread.submit(
+                run_coroutine_job(job, job._jobstore_alias, run_times, self._logger.name)
+            )
+        else:
+            future = self.loop_thread.submit(
+                run_blocking_job(job, job._jobstore_alias, run_times, self._logger.name)
+            )
+
+        self._pending.add(future)
+        future.add_done_callback(callback)
@@ -0,0 +1,258 @@
+"""
+Compile cache for job sources.
+Code objects are kept in an in-memory LRU and marshalled to disk, keyed by a hash
+of the source, the interpreter's bytecode tag and the version of the wrapper compiling
+the sources, so restarts and re-syncs skip parsing and compiling unchanged sources.
+The directory is capped, the least recently used files (by mtime) are pruned.
+
+Module cache for lazily materialized jobs, caps the number of live job modules.
+"""
+
+import hashlib
+import marshal
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from types import CodeType, ModuleType
+from typing import Callable, Dict, Hashable, Optional, Tuple
+
+
+class CompileCache:
+    """
+    :param str directory: Directory for the marshalled code objects, None to keep them in memory only.
+    :param int max_size: Number of code objects kept in memory.
+    :param str version: Version of the way sources are compiled, bumped when it changes.
+    :param int max_files: Number of files kept in the directory.
+    """
+
+    def __init__(
+        self,
+        directory: Optional[str] = None,
+        max_size: int = 4096,
+        version: str = "",
+        max_files: int = 16384,
+    ) -> None:
+        self.directory = directory
+        self.max_size = max_size
+        self.version = version
+        self.max_files = max_files
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lru: "OrderedDict[str, CodeType]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._prune_lock = threading.Lock()
+        self._files = 0
+
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            self.prune()
+
+    def key(self, src: str) -> str:
+        tag = sys.implementation.cache_tag or sys.version
+        return hashlib.sha256(f"{tag}\0{self.version}\0{src}".encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".marshal")
+
+    def _remember(self, key: str, code: CodeType) -> None:
+        with self._lock:
+            self._lru[key] = code
+            self._lru.move_to_end(key)
+
+            while len(self._lru) > self.max_size:
+                self._lru.popitem(last=False)
+
+    def _load(self, key: str) -> Optional[CodeType]:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                code = marshal.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, ValueError, TypeError):
+            code = None
+
+        if not isinstance(code, CodeType):  # corrupt / truncated, rewritten on the miss
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+
+        try:
+            os.utime(path)  # recently used, pruned last
+        except OSError:
+            pass
+        return code
+
+    def _dump(self, key: str, code: CodeType) -> None:
+        path = self._path(key)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+        try:
+            with open(tmp, "wb") as f:
+                marshal.dump(code, f)
+            os.replace(tmp, path)  # atomic, concurrent writers can't leave partial files
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return
+
+        with self._prune_lock:
+            self._files += 1
+            full = self._files > self.max_files
+        if full:
+            self.prune()
+
+    def prune(self) -> int:
+        """
+        Remove the least recently used files above max_files, down to 90% of it.
+        :return: Number of removed files.
+        :rtype: int
+        """
+        with self._prune_lock:
+            entries = []
+            try:
+                with os.scandir(self.directory) as it:
+                    for entry in it:
+                        try:
+                            entries.append((entry.stat().st_mtime, entry.path))
+                        except OSError:  # removed meanwhile
+                            pass
+            except OSError:
+                return 0
+
+            removed = 0
+            if len(entries) > self.max_files:
+                entries.sort()
+                for _, path in entries[: len(entries) - int(self.max_files * 0.9)]:
+                    try:
+                        os.remove(path)
+                        removed += 1
+                    except OSError:
+                        pass
+
+            self._files = len(entries) - removed
+            return removed
+
+    def get(self, src: str, build: Callable[[str], CodeType]) -> CodeType:
+        """
+        Get the code object of the source, building it on a miss.
+        :param str src: Source code, the cache key.
+        :param build: Compiles the source to a code object, exceptions are not cached.
+        :return: Code object.
+        :rtype: CodeType
+        """
+        key = self.key(src)
+
+        with self._lock:
+            code = self._lru.get(key)
+            if code is not None:
+                self._lru.move_to_end(key)
+                self.hits += 1
+                return code
+
+        code = self._load(key) if self.directory else None
+
+        if code is not None:
+            self.disk_hits += 1
+        else:
+            self.misses += 1
+            code = build(src)
+            if self.directory:
+                self._dump(key, code)
+
+        self._remember(key, code)
+        return code
+
+    def clear(self) -> None:
+        with self._lock:
+            self._lru.clear()
+
+
+class ModuleCache:
+    """
+    LRU / idle-TTL cache of materialized job modules, for jobs kept lazily as source.
+    :param int max_size: Number of modules kept alive.
+    :param float ttl: Seconds a module may stay unused before evict_idle drops it, None to disable.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: Optional[float] = None) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lru: "OrderedDict[Hashable, Tuple[ModuleType, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._lru)
+
+    def get(self, key: Hashable, load: Callable[[], ModuleType]) -> ModuleType:
+        """
+        Get the module, materializing it on a miss.
+        :param key: Cache key, e.g. (name, digest) of the Code.
+        :param load: Materializes the module.
+        :return: Module.
+        :rtype: ModuleType
+        """
+        with self._lock:
+            entry = self._lru.get(key)
+            if entry is not None:
+                self._lru[key] = (entry[0], time.monotonic())
+                self._lru.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        module = load()
+
+        with self._lock:
+            self._lru[key] = (module, time.monotonic())
+            self._lru.move_to_end(key)
+
+            while len(self._lru) > self.max_size:
+                self._lru.popitem(last=False)
+                self.evictions += 1
+
+        return module
+
+    def discard(self, key: Hashable) -> None:
+        with self._lock:
+            self._lru.pop(key, None)
+
+    def evict_idle(self) -> int:
+        """
+        Drop the modules unused for longer than the TTL.
+        :return: Number of evicted modules.
+        :rtype: int
+        """
+        if self.ttl is None:
+            return 0
+
+        deadline = time.monotonic() - self.ttl
+        evicted = 0
+
+        with self._lock:
+            # least recently used first, stop at the first one still in use
+            for key, (_, last_used) in list(self._lru.items()):
+                if last_used > deadline:
+                    break
+                del self._lru[key]
+                evicted += 1
+
+            self.evictions += evicted
+
+        return evicted
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._lru),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
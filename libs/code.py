@@ -3,12 +3,46 @@ Code object and other helper methods for remote code execution.
 https://github.com/shambu09/remote-code-execution
 """
 
+import ast
+import asyncio
+import hashlib
 import importlib
+import inspect
 import io
+import os
 import sys
+import threading
+from collections import deque
+from contextvars import ContextVar
 from dataclasses import dataclass, field
-from types import ModuleType
-from typing import Any, List, Optional
+from types import CodeType, ModuleType
+from typing import Any, Callable, Deque, List, Optional, Tuple, Union
+
+from libs.cache import CompileCache, ModuleCache
+from libs.metrics import CODE_INIT
+
+# version of functionalise_src / compile_src, bump it when they change the compiled code
+COMPILE_VERSION = "2"
+
+compile_cache = CompileCache(
+    os.environ.get("CODE_CACHE_DIR", os.path.join(".cache", "bytecode")) or None,
+    int(os.environ.get("CODE_CACHE_SIZE", "4096")),
+    version=COMPILE_VERSION,
+    max_files=int(os.environ.get("CODE_CACHE_FILES", "16384")),
+)
+
+# run statuses
+SUCCESS = "success"
+ERROR = "error"
+TIMEOUT = "timeout"
+
+# characters of output kept per run, the oldest are dropped, 0 for unbounded
+CAPTURE_LIMIT = int(os.environ.get("CAPTURE_LIMIT", str(64 * 1024)))
+
+module_cache = ModuleCache(
+    int(os.environ.get("MODULE_CACHE_SIZE", "1024")),
+    float(os.environ["MODULE_IDLE_TTL"]) if os.environ.get("MODULE_IDLE_TTL") else None,
+)
 
 
 def __save_module_to_file(src: str, module_name: str) -> None:
@@ -36,11 +70,11 @@ def import_file(mod_name: str) -> ModuleType:
     return module
 
 
-def import_dmod(name: str, src: str) -> ModuleType:
+def import_dmod(name: str, src: Union[str, CodeType]) -> ModuleType:
     """
     Import dynamically generated code as module.
     :param str name: Name of the module.
-    :param str src: Code to be imported as module.
+    :param src: Code (or its compiled code object) to be imported as module.
     :return: Module.
     :rtype: ModuleType
     """
@@ -91,25 +125,154 @@ class ProxyStream:
         pass
 
 
+class CaptureStream(io.TextIOBase):
+    """
+    Write-only capture buffer within a memory budget, keeps the last limit characters
+    and marks what was dropped. Complete lines can be handed to a callback as they are
+    written, e.g. to log the output of a job while it runs.
+    :param int limit: Characters kept, 0 for unbounded.
+    :param on_line: Called with every complete line, without the newline.
+    """
+
+    def __init__(self, limit: int = 0, on_line: Optional[Callable[[str], None]] = None) -> None:
+        super().__init__()
+        self.limit = limit
+        self.on_line = on_line
+        self.size = 0
+        self.dropped = 0
+        self._chunks: Deque[str] = deque()
+        self._pending = ""
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, string: str) -> int:
+        n = len(string)
+        if n == 0:
+            return 0
+
+        if self.on_line is not None:
+            self._emit(string)
+
+        self._chunks.append(string)
+        self.size += n
+
+        if self.limit and self.size > self.limit:
+            self._trim()
+        elif len(self._chunks) > 1024:  # many small writes, e.g. print's separators
+            self._chunks = deque(["".join(self._chunks)])
+
+        return n
+
+    def _trim(self) -> None:
+        while self.size > self.limit:
+            head = self._chunks[0]
+            excess = self.size - self.limit
+
+            if len(head) <= excess:
+                self._chunks.popleft()
+                excess = len(head)
+            else:
+                self._chunks[0] = head[excess:]
+
+            self.size -= excess
+            self.dropped += excess
+
+    def _emit(self, string: str) -> None:
+        self._pending += string
+
+        if "\n" in string:
+            *lines, self._pending = self._pending.split("\n")
+            for line in lines:
+                self.on_line(line)
+
+        elif self.limit and len(self._pending) > self.limit:  # no newline in sight
+            self.on_line(self._pending)
+            self._pending = ""
+
+    def close(self) -> None:
+        if self.on_line is not None and self._pending:
+            self.on_line(self._pending)
+            self._pending = ""
+        super().close()
+
+    def getvalue(self) -> str:
+        value = "".join(self._chunks)
+        if self.dropped:
+            return f"[... {self.dropped} characters truncated ...]\n{value}"
+        return value
+
+
+_capture: ContextVar[Optional[CaptureStream]] = ContextVar("capture", default=None)
+_install_lock = threading.Lock()
+
+
+class DispatchStream:
+    """
+    Stream installed once in place of sys.stdout, routes every write to the
+    capture buffer of the current thread / context, or to the original stream
+    when nothing is being captured.
+    """
+
+    def __init__(self, fallback) -> None:
+        self.fallback = fallback
+
+    def _target(self):
+        buffer = _capture.get()
+        return self.fallback if buffer is None else buffer
+
+    def write(self, string: str) -> int:
+        return self._target().write(string)
+
+    def writelines(self, lines) -> None:
+        self._target().writelines(lines)
+
+    def flush(self) -> None:
+        self._target().flush()
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.fallback, name)
+
+
+def install_dispatcher() -> DispatchStream:
+    """
+    Install the dispatcher stream as sys.stdout, if it is not installed already.
+    :return: Installed dispatcher stream.
+    :rtype: DispatchStream
+    """
+    with _install_lock:
+        if not isinstance(sys.stdout, DispatchStream):
+            sys.stdout = DispatchStream(sys.stdout)
+
+        return sys.stdout
+
+
 class PatchStd:
     """
-    Context manager for monkey-patching stdout.
+    Context manager for capturing stdout of the current thread / context.
+    sys.stdout is never swapped per job, so concurrent jobs don't leak output
+    into each other's buffers.
+    :param int limit: Characters of output kept, the oldest are dropped, None for CAPTURE_LIMIT.
+    :param on_line: Called with every line of output as it is written.
     """
 
-    def __init__(self) -> None:
-        self._out = sys.stdout
-        self.out = io.StringIO()
+    def __init__(
+        self, limit: Optional[int] = None, on_line: Optional[Callable[[str], None]] = None
+    ) -> None:
+        self._out = install_dispatcher().fallback
+        self.out = CaptureStream(CAPTURE_LIMIT if limit is None else limit, on_line)
         self.value = ""
 
     def _print(self, *args) -> None:
         print(*args, file=self._out)
 
     def __enter__(self) -> "PatchStd":
-        sys.stdout = self.out
+        self._token = _capture.set(self.out)
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb) -> None:
-        sys.stdout = self._out
+        _capture.reset(self._token)
+        self.out.close()  # hands over the last unterminated line
         self.value = self.out.getvalue()
         del self.out
 
@@ -125,15 +288,124 @@ def validate_properties(module: ModuleType, properties: List[str]) -> None:
             raise PropertyMissingException(f"Property {property} is missing.")
 
 
-def functionalise_src(src: str) -> str:
+def functionalise_src(src: str, is_async: bool = False) -> str:
     """
     Functionalise the source code.
     :param str src: Source code.
+    :param bool is_async: Wrap it in a coroutine function.
     :return: Functionalised source code.
     :rtype: str
     """
     src = src.replace("\n", "\n\t")
-    return f"def i__run__():\n\t" + src
+    return f"{'async ' if is_async else ''}def i__run__():\n\t" + src
+
+
+def is_async_src(src: str) -> bool:
+    """
+    Whether the source code awaits at the top level, i.e. is the body of a coroutine.
+    :param str src: Source code.
+    :return: Whether the source is async.
+    :rtype: bool
+    """
+    try:
+        code = compile(src, "<string>", "exec", flags=ast.PyCF_ALLOW_TOP_LEVEL_AWAIT)
+    except SyntaxError:
+        return False
+
+    return bool(code.co_flags & inspect.CO_COROUTINE)
+
+
+def is_entry_run(node: ast.stmt) -> bool:
+    """
+    Whether the statement runs an async entry point, i.e. is asyncio.run(main()).
+    """
+    if not isinstance(node, ast.Expr) or not isinstance(node.value, ast.Call):
+        return False
+
+    call = node.value
+    return (
+        isinstance(call.func, ast.Attribute)
+        and call.func.attr == "run"
+        and isinstance(call.func.value, ast.Name)
+        and call.func.value.id == "asyncio"
+        and len(call.args) == 1
+        and not call.keywords
+    )
+
+
+def compile_entry_src(src: str) -> Optional[CodeType]:
+    """
+    Compile a source running its async entry point with asyncio.run at the top level into a
+    coroutine, the entry point is awaited instead of run on a loop of its own.
+    :param str src: Source code.
+    :return: Code object, None if the source has no async entry point.
+    """
+    tree = ast.parse(functionalise_src(src, is_async=True))
+    body = tree.body[0].body
+    entries = [n for n, node in enumerate(body) if is_entry_run(node)]
+    if len(entries) == 0:
+        return None
+
+    for n in entries:
+        body[n] = ast.copy_location(ast.Expr(ast.Await(body[n].value.args[0])), body[n])
+    return compile(ast.fix_missing_locations(tree), "<string>", "exec")
+
+
+def is_async_code(code: Union[str, CodeType]) -> bool:
+    """
+    Whether the compiled functionalised source defines a coroutine i__run__.
+    """
+    if not isinstance(code, CodeType):
+        return False
+
+    for const in code.co_consts:
+        if isinstance(const, CodeType) and const.co_name == "i__run__":
+            return bool(const.co_flags & inspect.CO_COROUTINE)
+
+    return False
+
+
+def compile_src(src: str) -> CodeType:
+    """
+    Compile the functionalised source code.
+    Sources awaiting at the top level, or running an async entry point with asyncio.run, are
+    wrapped in a coroutine function instead.
+    :param str src: Source code.
+    :return: Code object.
+    :rtype: CodeType
+    """
+    try:
+        code = compile(functionalise_src(src), "<string>", "exec")
+    except SyntaxError:
+        if not is_async_src(src):  # checked on failure only, sync sources compile once
+            raise
+        return compile(functionalise_src(src, is_async=True), "<string>", "exec")
+
+    if "asyncio.run(" in src:  # parsed for an entry point only then
+        return compile_entry_src(src) or code
+    return code
+
+
+def cached_compile(src: str) -> Union[str, CodeType]:
+    """
+    Compile the source code through the compile cache.
+    :param str src: Source code.
+    :return: Code object, or the functionalised source if it doesn't compile (import_dmod reports the error).
+    """
+    try:
+        return compile_cache.get(src, compile_src)
+    except Exception:
+        return functionalise_src(src)
+
+
+def src_digest(src: str) -> str:
+    """
+    Content hash of the source code.
+    :param str src: Source code.
+    :return: Hex digest.
+    :rtype: str
+    """
+    return hashlib.sha256(src.encode("utf-8")).hexdigest()
 
 
 @dataclass(frozen=True)
@@ -143,12 +415,27 @@ class Code:
     :param str name: Name of the module.
     :param str src: Code to be imported as module.
     :param ModuleType module: Module oobject of the code.
+    :param str digest: Content hash of the source code.
+    :param bool lazy: Keep only the source, materialize the module through module_cache on run.
+    :param str executor: Execution mode, thread | process | venv.
+    :param float timeout: Wall-clock timeout of a run, process / venv mode and coroutines only.
+    :param tuple deps: Requirements of the code.
+    :param bool coroutine: Whether the code awaits at the top level or runs an async entry point,
+        run on the event loop.
+    :param str title: Name of the job, recorded with its runs.
     """
 
     # //uid: str = field(default="")
     name: str = field(default="")
     src: str = field(default="", repr=False)
     lib: Optional[ModuleType] = field(default=None, repr=False)
+    digest: str = field(default="", repr=False, compare=False)
+    lazy: bool = field(default=False, compare=False)
+    executor: str = field(default="thread", compare=False)
+    timeout: Optional[float] = field(default=None, compare=False)
+    deps: Tuple[str, ...] = field(default=(), compare=False)
+    coroutine: bool = field(default=False, init=False, compare=False)
+    title: str = field(default="", compare=False)
 
     def __post_init__(self) -> None:
         """
@@ -156,23 +443,89 @@ class Code:
         :return: None
         :rtype: NoneType
         """
-        if self.src != "":
-            object.__setattr__(
-                self, "lib", import_dmod(self.name, functionalise_src(self.src))
-            )
-        else:
+        if self.src == "":
             raise CodeMissingException(f"Source code is missing.")
 
-        validate_properties(self.lib, ["i__run__"])
+        with CODE_INIT.time(lazy=self.lazy):
+            object.__setattr__(self, "digest", src_digest(self.src))
+
+            if self.lazy:
+                code = cached_compile(self.src)  # warm the compile cache, materialized on run
+                object.__setattr__(self, "coroutine", is_async_code(code))
+            else:
+                object.__setattr__(self, "lib", self.materialize())
+                object.__setattr__(
+                    self, "coroutine", inspect.iscoroutinefunction(self.lib.i__run__)
+                )
+
+    @property
+    def signature(self) -> tuple:
+        return (self.digest, self.executor, self.timeout, self.deps)
+
+    def materialize(self) -> ModuleType:
+        """
+        Import the code as a module.
+        :return: Module.
+        :rtype: ModuleType
+        """
+        module = import_dmod(self.name, cached_compile(self.src))
+        validate_properties(module, ["i__run__"])
+        return module
+
+    def module(self) -> ModuleType:
+        """
+        Module of the code, materialized through module_cache for lazy code.
+        :return: Module.
+        :rtype: ModuleType
+        """
+        if self.lib is not None:
+            return self.lib
+
+        return module_cache.get((self.name, self.digest), self.materialize)
+
+    def execute(self, on_line: Optional[Callable[[str], None]] = None) -> Tuple[str, str]:
+        """
+        Run the code, capturing its output within CAPTURE_LIMIT.
+        :param on_line: Called with every line of output while the code runs.
+        :return: Captured output (or the repr of the error) and the status, success | error | timeout.
+        :rtype: tuple
+        """
+        if self.coroutine:  # outside of the event loop, e.g. in a worker process
+            return asyncio.run(self.execute_async(on_line))
 
-    def run_with_std_patch(self) -> str:
         try:
-            with PatchStd() as std:
-                self.lib.i__run__()
-            return std.value
+            with PatchStd(on_line=on_line) as std:
+                self.module().i__run__()
+            return std.value, SUCCESS
 
         except Exception as E:
-            return repr(E)
+            return repr(E), ERROR
+
+    async def execute_async(
+        self, on_line: Optional[Callable[[str], None]] = None
+    ) -> Tuple[str, str]:
+        """
+        Run the coroutine code on the running event loop.
+        Output is captured per task, concurrent jobs on the loop don't mix.
+        """
+        try:
+            with PatchStd(on_line=on_line) as std:
+                await asyncio.wait_for(self.module().i__run__(), self.timeout)
+            return std.value, SUCCESS
+
+        except asyncio.TimeoutError:
+            return repr(TimeoutError(f"Job {self.name} cancelled after {self.timeout}s")), TIMEOUT
+
+        except Exception as E:
+            return repr(E), ERROR
+
+    def run_with_std_patch(self, on_line: Optional[Callable[[str], None]] = None) -> str:
+        return self.execute(on_line)[0]
+
+    async def run_async_with_std_patch(
+        self, on_line: Optional[Callable[[str], None]] = None
+    ) -> str:
+        return (await self.execute_async(on_line))[0]
 
 
 if __name__ == "__main__":
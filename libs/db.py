@@ -6,13 +6,49 @@ Schema:
     name
     sync
     to_be_deleted
+    updated_at
     timezone
+    executor
+    timeout
+    stagger
+    jitter
+    max_instances
+    coalesce
+    misfire_grace_time
+
+JobRun schema (run history, expires at expire_at):
+    job_id
+    name
+    started_at
+    ended_at
+    duration
+    status
+    output
+    expire_at
+
+Worker schema (sharding, one per live worker):
+    worker_id
+    host
+    pid
+    started_at
+    heartbeat_at
+    expire_at
+
+Lease schema (sharding, one per partition of the job ids):
+    partition
+    owner
+    expires_at
+
+StoreEntry schema (snapshot of the scheduled jobs, for warm restarts):
+    id (job id)
+    spec
 """
 
+from datetime import datetime
 from typing import Dict, List
 
-from mongoengine import (BooleanField, DictField, Document, ListField,
-                         StringField)
+from mongoengine import (BooleanField, DateTimeField, DictField, Document,
+                         FloatField, IntField, ListField, StringField)
 
 
 class Job(Document):
@@ -29,4 +65,104 @@ class Job(Document):
     # METADATA
     sync: bool = BooleanField(default=False)
     to_be_deleted: bool = BooleanField(default=False)
+    updated_at: datetime = DateTimeField(
+        default=datetime.utcnow
+    )  # UTC, set on insert / save, writers updating in place should set it too
     timezone: str = StringField(default=None)
+
+    # LOAD SMOOTHING
+    stagger: int = IntField(
+        default=None, min_value=0
+    )  # seconds, window of the deterministic offset after the cron instant, None for STAGGER_WINDOW
+    jitter: int = IntField(default=None, min_value=0)  # seconds, random delay added to every run
+
+    # CONCURRENCY / MISFIRES, None for the scheduler's defaults
+    max_instances: int = IntField(default=None, min_value=1)  # concurrent runs of the job
+    coalesce: bool = BooleanField(default=None)  # run missed runs once instead of each of them
+    misfire_grace_time: int = IntField(
+        default=None, min_value=1
+    )  # seconds a run may be late before it is skipped
+
+    # EXECUTION
+    executor: str = StringField(
+        default="thread", choices=("thread", "process", "venv")
+    )  # venv: process in an isolated environment holding the job's deps
+    timeout: float = FloatField(
+        default=None
+    )  # seconds, kills the worker (process / venv executor) or cancels the coroutine
+
+    meta = {
+        "indexes": [
+            # partial, only the few jobs waiting for a sync / deletion are indexed
+            {"fields": ["sync"], "partialFilterExpression": {"sync": False}},
+            {"fields": ["to_be_deleted"], "partialFilterExpression": {"to_be_deleted": True}},
+            "updated_at",
+        ],
+    }
+
+    def save(self, *args, **kwargs):
+        self.updated_at = datetime.utcnow()
+        return super().save(*args, **kwargs)
+
+
+class JobRun(Document):
+    job_id: str = StringField(required=True)
+    name: str = StringField(default="")
+
+    # TIMING, UTC
+    started_at: datetime = DateTimeField(required=True)
+    ended_at: datetime = DateTimeField(required=True)
+    duration: float = FloatField(required=True)  # seconds
+
+    # RESULT
+    status: str = StringField(required=True, choices=("success", "error", "timeout"))
+    output: str = StringField(default="")  # tail of the output, truncated
+
+    # RETENTION
+    expire_at: datetime = DateTimeField(required=True)  # removed by the TTL index
+
+    meta = {
+        "collection": "job_run",
+        "indexes": [
+            ("job_id", "-started_at"),
+            ("status", "-started_at"),
+            {"fields": ["expire_at"], "expireAfterSeconds": 0},
+        ],
+    }
+
+
+class Worker(Document):
+    worker_id: str = StringField(required=True, unique=True)
+    host: str = StringField(default="")
+    pid: int = IntField(default=None)
+
+    # LIVENESS, UTC
+    started_at: datetime = DateTimeField(required=True)
+    heartbeat_at: datetime = DateTimeField(required=True)  # dead after a lease TTL without one
+    expire_at: datetime = DateTimeField(required=True)  # removed by the TTL index
+
+    meta = {
+        "collection": "worker",
+        "indexes": [
+            "heartbeat_at",
+            {"fields": ["expire_at"], "expireAfterSeconds": 0},
+        ],
+    }
+
+
+class Lease(Document):
+    partition: int = IntField(required=True, unique=True, min_value=0)
+    owner: str = StringField(default=None)  # worker_id, None once released
+    expires_at: datetime = DateTimeField(required=True)  # free to claim afterwards, UTC
+
+    meta = {
+        "collection": "lease",
+        "indexes": [("owner", "expires_at")],
+    }
+
+
+class StoreEntry(Document):
+    id: str = StringField(primary_key=True)  # job id
+    spec: Dict = DictField(required=True)  # JobSpec fields
+
+    meta = {"collection": "store_snapshot"}
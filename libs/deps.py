@@ -0,0 +1,308 @@
+"""
+Dependency manager installing job requirements in the background.
+Requirements are downloaded / built into an optional local wheelhouse in parallel, so
+repeated installs (and offline installs) skip the index, and installed one pip run at a
+time: concurrent runs into the same site-packages race on shared dependencies and on
+their RECORD / metadata files.
+
+Package index of the installed distributions, built in-process from importlib.metadata
+and matched against job requirements with requirement-specifier semantics.
+"""
+
+import importlib
+import json
+import logging
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache, partial
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from packaging.requirements import InvalidRequirement, Requirement
+from packaging.utils import canonicalize_name
+
+from libs.metrics import PIP_INSTALL
+
+try:
+    from importlib import metadata
+except ImportError:  # python < 3.8
+    import importlib_metadata as metadata
+
+VCS_SCHEMES = ("git+", "hg+", "svn+", "bzr+")
+
+
+@lru_cache(maxsize=4096)
+def parse_requirement(requirement: str) -> Optional[Requirement]:
+    try:
+        return Requirement(requirement)
+    except InvalidRequirement:
+        return None
+
+
+def normalize_url(url: str) -> str:
+    """
+    URL of a direct URL / VCS requirement without the VCS scheme, revision and fragment, as
+    recorded in the direct_url.json of the installed distribution.
+    """
+    url = url.split("#", 1)[0]
+    if url.startswith(VCS_SCHEMES):
+        url = url.split("+", 1)[1]
+        base, at, revision = url.rpartition("@")
+        if at and "/" not in revision:  # @ref, not the user of the netloc
+            url = base
+    return url.rstrip("/")
+
+
+def url_requirement(requirement: str) -> Optional[Tuple[Optional[str], str]]:
+    """
+    Name (None if unknown) and normalized URL of a direct URL / VCS requirement,
+    name @ url or a bare URL with an #egg= fragment, e.g. git+https://host/repo.git@v1#egg=name.
+    :return: (name, url), None for other requirements.
+    :rtype: tuple
+    """
+    parsed = parse_requirement(requirement)
+    if parsed is not None:
+        if parsed.url is None:
+            return None
+        return canonicalize_name(parsed.name), normalize_url(parsed.url)
+
+    if "://" not in requirement:
+        return None
+
+    egg = parse_qs(urlsplit(requirement).fragment).get("egg")
+    return (canonicalize_name(egg[0]) if egg else None), normalize_url(requirement.strip())
+
+
+class PackageIndex:
+    """
+    Installed distributions, normalized name -> version.
+    :param list path: Paths to index, None for sys.path.
+    """
+
+    def __init__(self, path: Optional[List[str]] = None) -> None:
+        self.path = path
+        self.versions: Dict[str, str] = {}
+        self.urls: Dict[str, str] = {}  # normalized URL -> name, of the dists installed from one
+        self._lock = threading.Lock()
+        self.refresh()
+
+    def _discover(self) -> Iterator:
+        if self.path is not None:
+            return metadata.distributions(path=self.path)
+        return metadata.distributions()
+
+    def refresh(self) -> None:
+        """
+        Re-index the installed distributions, all of them: an install also adds, upgrades and
+        downgrades the dependencies of the requirements, a scan is cheap next to pip.
+        """
+        importlib.invalidate_caches()
+
+        versions = {}
+        urls = {}
+        for dist in self._discover():
+            name = dist.metadata["Name"]
+            if name:
+                versions.setdefault(canonicalize_name(name), dist.version)
+                direct_url = dist.read_text("direct_url.json")  # PEP 610, installed from a URL
+                if direct_url:
+                    try:
+                        urls[normalize_url(json.loads(direct_url)["url"])] = canonicalize_name(name)
+                    except (ValueError, KeyError, TypeError):
+                        pass
+
+        with self._lock:
+            self.versions = versions
+            self.urls = urls
+
+    def satisfied(self, requirement: str) -> bool:
+        parsed = parse_requirement(requirement)
+        if parsed is not None and parsed.marker is not None:
+            if not parsed.marker.evaluate({"extra": ""}):
+                return True  # not needed on this platform, pip ignores it as well
+
+        direct = url_requirement(requirement)
+        if direct is not None:  # no version to match, installed from the URL or under its name
+            name, url = direct
+            return url in self.urls or (name is not None and name in self.versions)
+
+        if parsed is None:
+            return False
+
+        version = self.versions.get(canonicalize_name(parsed.name))
+        if version is None:
+            return False
+
+        return parsed.specifier.contains(version, prereleases=True)
+
+    def missing(self, requirements: Iterable[str]) -> Set[str]:
+        return set(filter(lambda requirement: not self.satisfied(requirement), requirements))
+
+    def __contains__(self, requirement: str) -> bool:
+        return self.satisfied(requirement)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter([f"{name}=={version}" for name, version in self.versions.items()])
+
+    def __len__(self) -> int:
+        return len(self.versions)
+
+    def __repr__(self) -> str:
+        return f"PackageIndex({sorted(self)})"
+
+
+def gather(futures: List[Future]) -> Future:
+    """
+    Future resolved with the results of all the futures once they are done.
+    """
+    combined: Future = Future()
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(_: Future) -> None:
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] > 0:
+                return
+        combined.set_result([future.result() for future in futures])
+
+    for future in futures:
+        future.add_done_callback(done)
+
+    return combined
+
+
+class DependencyManager:
+    """
+    :param str wheelhouse: Directory of cached wheels, requirements are built into it and installed from it.
+    :param bool offline: Install from the wheelhouse only, never hit the index.
+    :param int workers: Number of requirements downloaded / built into the wheelhouse in parallel.
+    :param str target: Install into this directory instead of the interpreter's site-packages.
+    :param float retry_delay: Seconds a failed requirement is skipped before being retried.
+    """
+
+    def __init__(
+        self,
+        wheelhouse: Optional[str] = None,
+        offline: bool = False,
+        workers: int = 4,
+        target: Optional[str] = None,
+        retry_delay: float = 900,
+        pip: Sequence[str] = (sys.executable, "-m", "pip"),
+        logger: Optional[logging.Logger] = None,
+    ) -> None:
+        self.wheelhouse = wheelhouse
+        self.offline = offline
+        self.target = target
+        self.retry_delay = retry_delay
+        self.pip = list(pip)
+        self.logger = logger or logging.getLogger("pip")
+        self.pending: Dict[str, Future] = {}
+        self.failed: Dict[str, float] = {}
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="pip")
+        self._lock = threading.RLock()  # _done may run inline from ensure
+        self._install_lock = threading.Lock()  # one pip install at a time into the target
+
+    def _run(self, args: List[str]) -> Tuple[bool, str]:
+        try:
+            p = subprocess.run(
+                self.pip + ["--disable-pip-version-check"] + args,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                universal_newlines=True,
+            )
+        except OSError as E:
+            return False, repr(E)
+
+        return p.returncode == 0, p.stdout
+
+    def install(self, requirements: List[str]) -> Tuple[bool, str]:
+        """
+        Install the requirements together in one pip run, blocking, after the manager's other
+        installs. Only the wheelhouse builds run in parallel.
+        :param list requirements: Requirement specifiers.
+        :return: Whether pip succeeded and its log.
+        :rtype: tuple
+        """
+        start = time.monotonic()
+        args = ["install"]
+
+        if self.target:
+            args += ["--target", self.target, "--upgrade"]
+
+        if self.wheelhouse:
+            cached = self.offline
+            if not self.offline:  # build / download into the wheelhouse first
+                cached, out = self._run(
+                    ["wheel", "--wheel-dir", self.wheelhouse, "--find-links", self.wheelhouse]
+                    + requirements
+                )
+            if cached:
+                args += ["--no-index", "--find-links", self.wheelhouse]
+
+        with self._install_lock:
+            ok, out = self._run(args + requirements)
+        PIP_INSTALL.observe(time.monotonic() - start, result="ok" if ok else "failed")
+        self.logger.info(
+            "pip install %s %s in %.2fs:\n%s",
+            " ".join(requirements),
+            "succeeded" if ok else "failed",
+            time.monotonic() - start,
+            out,
+        )
+        return ok, out
+
+    def _install(self, requirement: str) -> Tuple[str, bool, str]:
+        ok, out = self.install([requirement])
+        return requirement, ok, out
+
+    def _done(self, requirement: str, future: Future) -> None:
+        with self._lock:
+            self.pending.pop(requirement, None)
+
+            if not future.result()[1]:
+                self.mark_failed(requirement)
+            else:
+                self.failed.pop(requirement, None)
+
+    def mark_failed(self, requirement: str) -> None:
+        """
+        Skip the requirement until the retry delay passed, e.g. installed but still not found.
+        """
+        with self._lock:
+            self.failed[requirement] = time.monotonic() + self.retry_delay
+
+    def ensure(self, requirements: Iterable[str]) -> Optional[Future]:
+        """
+        Install the requirements in the background.
+        Requirements already being installed are joined, recently failed ones are skipped.
+        :param requirements: Requirement specifiers.
+        :return: Future resolved with (requirement, ok, log) tuples, None if nothing is installed.
+        :rtype: Future
+        """
+        futures = []
+        now = time.monotonic()
+
+        with self._lock:
+            for requirement in sorted(set(requirements)):
+                if self.failed.get(requirement, now) > now:
+                    continue
+
+                future = self.pending.get(requirement)
+                if future is None:
+                    future = self._executor.submit(self._install, requirement)
+                    self.pending[requirement] = future
+                    future.add_done_callback(partial(self._done, requirement))
+
+                futures.append(future)
+
+        if len(futures) == 0:
+            return None
+
+        return gather(futures)
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)
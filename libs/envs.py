@@ -0,0 +1,195 @@
+"""
+Cache of isolated virtualenvs, one per distinct set of job dependencies.
+Environments are layered on the base interpreter (system site-packages) and only
+hold the job's pinned requirements, installed through the shared wheelhouse.
+Jobs with the same deps share an environment, unused ones are garbage-collected.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sysconfig
+import threading
+import time
+import venv
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from libs.deps import DependencyManager, parse_requirement
+
+READY_MARKER = ".ready"
+
+
+def normalize_deps(deps: Iterable[str]) -> List[str]:
+    normalized = set()
+
+    for dep in deps:
+        parsed = parse_requirement(dep)
+        normalized.add(str(parsed if parsed is not None else dep.strip()).lower())
+
+    return sorted(normalized)
+
+
+class EnvCache:
+    """
+    :param str root: Directory holding the environments.
+    :param str wheelhouse: Shared wheelhouse the requirements are installed from.
+    :param bool offline: Install from the wheelhouse only.
+    :param int workers: Number of environments created in parallel.
+    :param float grace: Seconds an unused environment is kept before collect removes it.
+    :param float retry_delay: Seconds a failed environment is not recreated.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        wheelhouse: Optional[str] = None,
+        offline: bool = False,
+        workers: int = 2,
+        grace: float = 3600,
+        retry_delay: float = 900,
+        logger: Optional[logging.Logger] = None,
+    ) -> None:
+        self.root = root
+        self.wheelhouse = wheelhouse
+        self.offline = offline
+        self.grace = grace
+        self.retry_delay = retry_delay
+        self.logger = logger or logging.getLogger("pip")
+        self.pending: Dict[str, Future] = {}
+        self.last_used: Dict[str, float] = {}
+        self.failed: Dict[str, Tuple[float, BaseException]] = {}
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="venv")
+        self._lock = threading.RLock()  # _done may run inline from ensure
+
+    @staticmethod
+    def key(deps: Iterable[str]) -> str:
+        deps = "\n".join(normalize_deps(deps))
+        return hashlib.sha256(deps.encode("utf-8")).hexdigest()[:24]
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def is_ready(self, deps: Iterable[str]) -> bool:
+        return os.path.exists(os.path.join(self.path(self.key(deps)), READY_MARKER))
+
+    def python(self, deps: Iterable[str]) -> str:
+        """
+        Interpreter of the environment of the deps, which must be ready.
+        """
+        key = self.key(deps)
+        self.last_used[key] = time.time()
+        scripts = "Scripts" if os.name == "nt" else "bin"
+        return os.path.join(self.path(key), scripts, "python")
+
+    def _create(self, key: str, deps: List[str]) -> str:
+        path = self.path(key)
+        start = time.monotonic()
+        shutil.rmtree(path, ignore_errors=True)  # leftovers of an interrupted creation
+
+        # no pip inside, packages are installed by the base pip into the env's site-packages
+        venv.EnvBuilder(
+            system_site_packages=True, symlinks=os.name != "nt", with_pip=False
+        ).create(path)
+        site_packages = sysconfig.get_path(
+            "purelib", vars={"base": path, "platbase": path}
+        )
+
+        manager = DependencyManager(
+            wheelhouse=self.wheelhouse,
+            offline=self.offline,
+            workers=1,
+            target=site_packages,
+            logger=self.logger,
+        )
+        ok, out = manager.install(deps)
+        manager.shutdown(wait=False)
+
+        if not ok:
+            shutil.rmtree(path, ignore_errors=True)
+            raise RuntimeError(f"Failed to create environment for {deps}:\n{out}")
+
+        with open(os.path.join(path, READY_MARKER), "w") as f:
+            json.dump(deps, f)
+
+        self.logger.info(
+            "Created environment %s for %s in %.2fs", key, deps, time.monotonic() - start
+        )
+        return self.python(deps)
+
+    def ensure(self, deps: Iterable[str]) -> Future:
+        """
+        Create the environment of the deps in the background, if it doesn't exist.
+        :param deps: Requirement specifiers.
+        :return: Future resolved with the environment's interpreter.
+        :rtype: Future
+        """
+        deps = normalize_deps(deps)
+        key = self.key(deps)
+
+        with self._lock:
+            future = self.pending.get(key)
+            if future is not None:
+                return future
+
+            if self.is_ready(deps):
+                future = Future()
+                future.set_result(self.python(deps))
+                return future
+
+            retry_at, error = self.failed.get(key, (0, None))
+            if retry_at > time.monotonic():
+                future = Future()
+                future.set_exception(error)
+                return future
+
+            future = self._executor.submit(self._create, key, deps)
+            self.pending[key] = future
+
+        future.add_done_callback(partial(self._done, key))
+        return future
+
+    def _done(self, key: str, future: Future) -> None:
+        with self._lock:
+            self.pending.pop(key, None)
+
+            if future.exception() is not None:
+                self.failed[key] = (time.monotonic() + self.retry_delay, future.exception())
+                self.logger.error("%s", future.exception())
+            else:
+                self.failed.pop(key, None)
+
+    def collect(self, active: Set[str]) -> List[str]:
+        """
+        Remove the environments unused for longer than the grace period.
+        :param set active: Keys of the environments used by scheduled jobs.
+        :return: Keys of the removed environments.
+        :rtype: list
+        """
+        if not os.path.isdir(self.root):
+            return []
+
+        deadline = time.time() - self.grace
+        removed = []
+
+        with self._lock:
+            for key in os.listdir(self.root):
+                path = self.path(key)
+                if key in active or key in self.pending or not os.path.isdir(path):
+                    continue
+
+                marker = os.path.join(path, READY_MARKER)
+                last_used = self.last_used.get(
+                    key, os.path.getmtime(marker) if os.path.exists(marker) else 0
+                )
+                if last_used > deadline:
+                    continue
+
+                shutil.rmtree(path, ignore_errors=True)
+                self.last_used.pop(key, None)
+                removed.append(key)
+
+        return removed
@@ -0,0 +1,178 @@
+"""
+Adaptive executor for the scheduler.
+Workers are added while jobs queue up faster than the observed run time drains
+them, up to max_workers, and retire after staying idle, down to min_workers.
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict, Optional, Set
+
+from apscheduler.executors.pool import BasePoolExecutor
+
+
+class AdaptivePool:
+    """
+    Thread pool sized by queue depth and run time, with the submit / shutdown
+    interface of concurrent.futures.
+    :param int min_workers: Workers kept alive when idle.
+    :param int max_workers: Upper bound of workers.
+    :param float idle_timeout: Seconds an idle worker above min_workers waits before retiring.
+    :param float max_wait: Seconds a queued job may wait, estimated from the average run time, before a worker is added.
+    :param float smoothing: Weight of the latest run in the average run time.
+    """
+
+    def __init__(
+        self,
+        min_workers: int = 2,
+        max_workers: int = 20,
+        idle_timeout: float = 60,
+        max_wait: float = 1,
+        smoothing: float = 0.2,
+        thread_name_prefix: str = "scheduler",
+    ) -> None:
+        self.min_workers = min(min_workers, max_workers)
+        self.max_workers = max_workers
+        self.idle_timeout = idle_timeout
+        self.max_wait = max_wait
+        self.smoothing = smoothing
+        self.thread_name_prefix = thread_name_prefix
+        self.avg_runtime: Optional[float] = None
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._queued = 0
+        self._idle = 0
+        self._threads: Set[threading.Thread] = set()
+        self._counter = 0
+        self._shutdown = False
+        self._lock = threading.Lock()
+
+        with self._lock:
+            for _ in range(self.min_workers):
+                self._spawn()
+
+    @property
+    def workers(self) -> int:
+        return len(self._threads)
+
+    def _spawn(self) -> None:
+        self._counter += 1
+        thread = threading.Thread(
+            target=self._work, name=f"{self.thread_name_prefix}_{self._counter}", daemon=True
+        )
+        self._threads.add(thread)
+        thread.start()
+
+    def _should_grow(self) -> bool:
+        if self.workers >= self.max_workers:
+            return False
+
+        backlog = self._queued - self._idle
+        if backlog <= 0:
+            return False
+
+        if self.workers == 0 or self.avg_runtime is None:
+            return True
+
+        # short jobs drain through the current workers, long ones need more of them
+        return backlog * self.avg_runtime / self.workers > self.max_wait
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        future: Future = Future()
+
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("cannot schedule new futures after shutdown")
+
+            self._queue.put((future, fn, args, kwargs))
+            self._queued += 1
+
+            if self._should_grow():
+                self._spawn()
+
+        return future
+
+    def _retire(self) -> None:
+        self._threads.discard(threading.current_thread())
+
+    def _observe(self, runtime: float) -> None:
+        with self._lock:
+            if self.avg_runtime is None:
+                self.avg_runtime = runtime
+            else:
+                self.avg_runtime += self.smoothing * (runtime - self.avg_runtime)
+
+    def _work(self) -> None:
+        while True:
+            with self._lock:
+                self._idle += 1
+
+            try:
+                item = self._queue.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                with self._lock:
+                    self._idle -= 1
+                    # a job submitted while the wait timed out counted on this worker, no
+                    # other one was added for it
+                    if self.workers > self.min_workers and self._queued <= self._idle:
+                        self._retire()
+                        return
+                continue
+
+            with self._lock:
+                self._idle -= 1
+                if item is None:  # shutdown
+                    self._retire()
+                    return
+                self._queued -= 1
+
+            future, fn, args, kwargs = item
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            start = time.monotonic()
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as E:
+                future.set_exception(E)
+            else:
+                future.set_result(result)
+
+            self._observe(time.monotonic() - start)
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "workers": self.workers,
+            "idle": self._idle,
+            "queued": self._queued,
+            "avg_runtime": self.avg_runtime,
+        }
+
+    def shutdown(self, wait: bool = True) -> None:
+        with self._lock:
+            self._shutdown = True
+            threads = list(self._threads)
+
+        for _ in threads:
+            self._queue.put(None)
+
+        if wait:
+            for thread in threads:
+                thread.join()
+
+
+class AdaptiveThreadPoolExecutor(BasePoolExecutor):
+    """
+    APScheduler executor running the jobs in an AdaptivePool.
+    :param int min_workers: Workers kept alive when idle.
+    :param int max_workers: Upper bound of workers.
+    :param kwargs: Passed to AdaptivePool.
+    """
+
+    def __init__(self, min_workers: int = 2, max_workers: int = 20, **kwargs) -> None:
+        super().__init__(AdaptivePool(int(min_workers), int(max_workers), **kwargs))
+
+    @property
+    def pool(self) -> AdaptivePool:
+        return self._pool
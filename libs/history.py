@@ -0,0 +1,150 @@
+"""
+Run history of the jobs.
+Runs are buffered in memory and written with one insert_many when the buffer
+reaches batch_size or every flush_interval seconds, so recording a run costs no
+database round-trip on the job's thread. Retention is left to the TTL index of
+JobRun, failed runs are kept longer than successful ones.
+"""
+
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from libs.code import SUCCESS
+from libs.db import JobRun
+
+
+class HistoryWriter:
+    """
+    :param int batch_size: Runs buffered before a flush is triggered.
+    :param float flush_interval: Seconds between two flushes at most.
+    :param int max_buffer: Runs kept while the database is unreachable, the oldest are dropped.
+    :param int output_limit: Characters of output stored per run, the tail is kept.
+    :param float retention: Seconds successful runs are kept.
+    :param float error_retention: Seconds failed / timed out runs are kept.
+    """
+
+    def __init__(
+        self,
+        batch_size: int = 500,
+        flush_interval: float = 5,
+        max_buffer: int = 50000,
+        output_limit: int = 4096,
+        retention: float = 7 * 86400,
+        error_retention: float = 30 * 86400,
+        logger: Optional[logging.Logger] = None,
+    ) -> None:
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.output_limit = output_limit
+        self.retention = timedelta(seconds=retention)
+        self.error_retention = timedelta(seconds=error_retention)
+        self.logger = logger or logging.getLogger("root")
+        self.written = 0
+        self.dropped = 0
+        self._buffer: List[JobRun] = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def record(
+        self,
+        job_id: str,
+        started_at: datetime,
+        ended_at: datetime,
+        status: str,
+        output: str = "",
+        name: str = "",
+    ) -> None:
+        """
+        Buffer a run, written out by the background flusher.
+        :param str job_id: Id of the job.
+        :param datetime started_at: Start of the run, UTC.
+        :param datetime ended_at: End of the run, UTC.
+        :param str status: success | error | timeout.
+        :param str output: Output of the run, truncated to output_limit.
+        :param str name: Name of the job.
+        """
+        if len(output) > self.output_limit:
+            output = output[-self.output_limit :]
+
+        retention = self.retention if status == SUCCESS else self.error_retention
+        run = JobRun(
+            job_id=job_id,
+            name=name,
+            started_at=started_at,
+            ended_at=ended_at,
+            duration=(ended_at - started_at).total_seconds(),
+            status=status,
+            output=output,
+            expire_at=ended_at + retention,
+        )
+
+        with self._lock:
+            self._buffer.append(run)
+            full = len(self._buffer) >= self.batch_size
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="history", daemon=True)
+                self._thread.start()
+
+        if full:
+            self._wakeup.set()
+
+    def pending(self) -> int:
+        return len(self._buffer)
+
+    def flush(self) -> int:
+        """
+        Write out the buffered runs with one insert_many.
+        :return: Number of runs written.
+        :rtype: int
+        """
+        with self._flush_lock:
+            with self._lock:
+                runs, self._buffer = self._buffer, []
+
+            if len(runs) == 0:
+                return 0
+
+            try:
+                JobRun.objects.insert(runs, load_bulk=False)
+            except Exception as E:
+                self.logger.error("Failed to write %s job runs: %r", len(runs), E)
+
+                with self._lock:  # retried on the next flush, within max_buffer
+                    self._buffer = runs + self._buffer
+                    excess = len(self._buffer) - self.max_buffer
+                    if excess > 0:
+                        del self._buffer[:excess]
+                        self.dropped += excess
+                return 0
+
+            self.written += len(runs)
+            return len(runs)
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def close(self) -> None:
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        self._stopped.clear()
+
+
+def last_runs(job_id: str, limit: int = 10) -> List[JobRun]:
+    """
+    Latest runs of the job, newest first.
+    """
+    return list(JobRun.objects(job_id=job_id).order_by("-started_at").limit(limit))
@@ -0,0 +1,262 @@
+"""
+Non-blocking logging pipeline.
+Loggers put their records on one in-memory queue and return, a single background
+listener writes them out in batches, flushing every handler once per batch, so disk
+latency stays off the jobs' threads.
+
+Log files rotate on size and / or age, rotated files are gzipped.
+"""
+
+import atexit
+import gzip
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+from logging.handlers import QueueHandler, RotatingFileHandler
+from typing import Dict, Iterable, List, Optional
+
+_STOP = object()
+
+
+class RotatingGzipFileHandler(RotatingFileHandler):
+    """
+    File handler rotating when the file reaches maxBytes or is interval seconds old,
+    keeping backupCount gzipped files.
+    :param float interval: Seconds between time-based rotations, 0 to rotate on size only.
+    :param bool buffered: Don't flush every record, the owner flushes, e.g. once per batch.
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        mode: str = "a",
+        maxBytes: int = 0,
+        backupCount: int = 7,
+        encoding: Optional[str] = None,
+        delay: bool = False,
+        interval: float = 0,
+        buffered: bool = False,
+    ) -> None:
+        super().__init__(filename, mode, maxBytes, backupCount, encoding, delay)
+        self.interval = interval
+        self.buffered = buffered
+        self.rollover_at = self._next_rollover(
+            os.path.getmtime(filename) if os.path.exists(filename) else time.time()
+        )
+
+    def _next_rollover(self, start: float) -> float:
+        return start + self.interval if self.interval > 0 else float("inf")
+
+    def namer(self, default_name: str) -> str:
+        return default_name + ".gz"
+
+    def rotator(self, source: str, dest: str) -> None:
+        if not os.path.exists(source):
+            return
+
+        with open(source, "rb") as src, gzip.open(dest, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(source)
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if record.created >= self.rollover_at:
+            return True
+
+        return super().shouldRollover(record) == 1
+
+    def doRollover(self) -> None:
+        super().doRollover()
+        self.rollover_at = self._next_rollover(time.time())
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if not self.buffered:
+            return super().emit(record)
+
+        try:
+            if self.shouldRollover(record):
+                self.doRollover()
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+
+
+class RoutingQueueHandler(QueueHandler):
+    """
+    Puts the records of a logger on the shared queue, tagged with the logger's route.
+    :param queue: Shared queue.
+    :param str route: Name of the logger, selects the handlers the listener writes the record to.
+    :param str policy: drop records when the queue is full, or block until there is room.
+    """
+
+    def __init__(self, queue: queue.Queue, route: str, policy: str = "drop") -> None:
+        super().__init__(queue)
+        self.route = route
+        self.policy = policy
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = super().prepare(record)
+        record.route = self.route
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        if self.policy == "block":
+            self.queue.put(record)  # backpressure on the logging thread
+            return
+
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class BatchingQueueListener:
+    """
+    Background thread writing the queued records to the handlers of their route.
+    :param queue: Shared queue.
+    :param dict routes: Logger name -> handlers.
+    :param int batch_size: Records written between two flushes at most.
+    """
+
+    def __init__(
+        self,
+        queue: queue.Queue,
+        routes: Dict[str, List[logging.Handler]],
+        queue_handlers: Iterable[RoutingQueueHandler] = (),
+        batch_size: int = 512,
+    ) -> None:
+        self.queue = queue
+        self.routes = routes
+        self.queue_handlers = list(queue_handlers)
+        self.batch_size = batch_size
+        self.reported_dropped = 0
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def handlers(self) -> List[logging.Handler]:
+        unique = {}
+        for handlers in self.routes.values():
+            for handler in handlers:
+                unique[id(handler)] = handler
+        return list(unique.values())
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._monitor, name="log_listener", daemon=True)
+        self._thread.start()
+
+    def _drain(self) -> List:
+        batch = [self.queue.get()]  # idle until there is something to write
+
+        while len(batch) < self.batch_size and batch[-1] is not _STOP:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _report_dropped(self) -> None:
+        dropped = sum(handler.dropped for handler in self.queue_handlers)
+        if dropped > self.reported_dropped:
+            record = logging.makeLogRecord(
+                {
+                    "name": "logs",
+                    "levelno": logging.WARNING,
+                    "levelname": "WARNING",
+                    "msg": f"Log queue full, dropped {dropped - self.reported_dropped} records",
+                }
+            )
+            for handler in self.routes.get("root", ()):
+                handler.handle(record)
+            self.reported_dropped = dropped
+
+    def _monitor(self) -> None:
+        stop = False
+
+        while not stop:
+            batch = self._drain()
+            touched = {}
+
+            for record in batch:
+                if record is _STOP:
+                    stop = True
+                    continue
+
+                for handler in self.routes.get(getattr(record, "route", None), ()):
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+                        touched[id(handler)] = handler
+
+            self._report_dropped()
+            for handler in touched.values():
+                handler.flush()
+
+    def stop(self) -> None:
+        """
+        Write out the queued records and stop the listener.
+        """
+        if self._thread is None:
+            return
+
+        self.queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+
+        for handler in self.handlers:
+            handler.flush()
+
+
+listener: Optional[BatchingQueueListener] = None
+
+
+def enqueue_loggers(
+    names: Iterable[str], max_size: int = 10000, policy: str = "drop", batch_size: int = 512
+) -> BatchingQueueListener:
+    """
+    Move the handlers of the loggers behind one queue and a background listener.
+    :param names: Names of the configured loggers.
+    :param int max_size: Records the queue holds, 0 for unbounded.
+    :param str policy: drop | block, when the queue is full.
+    :param int batch_size: Records written between two flushes at most.
+    :return: Started listener.
+    :rtype: BatchingQueueListener
+    """
+    global listener
+    stop_listener()
+
+    records: queue.Queue = queue.Queue(max_size)
+    routes = {}
+    queue_handlers = []
+
+    for name in names:
+        logger = logging.getLogger(name)
+        routes[name] = list(logger.handlers)
+
+        for handler in routes[name]:
+            logger.removeHandler(handler)
+            if isinstance(handler, RotatingGzipFileHandler):
+                handler.buffered = True
+
+        queue_handler = RoutingQueueHandler(records, name, policy)
+        logger.addHandler(queue_handler)
+        queue_handlers.append(queue_handler)
+
+    listener = BatchingQueueListener(records, routes, queue_handlers, batch_size)
+    listener.start()
+    return listener
+
+
+def stop_listener() -> None:
+    global listener
+
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+
+atexit.register(stop_listener)
@@ -0,0 +1,386 @@
+"""
+Metrics of the scheduler and the jobs' hot paths, exported as Prometheus text
+from a local HTTP endpoint or a periodically written file.
+Minimal in-process counters / gauges / histograms, no client library needed.
+"""
+
+import bisect
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from apscheduler.events import (EVENT_JOB_ERROR, EVENT_JOB_EXECUTED,
+                                EVENT_JOB_MAX_INSTANCES, EVENT_JOB_MISSED,
+                                EVENT_JOB_SUBMITTED)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+Labels = Tuple[str, ...]
+OTHER = "other"  # label values of the series past the limit of a metric
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric(ABC):
+    """
+    :param str name: Metric name.
+    :param str help: Description.
+    :param labelnames: Label names, values are passed as keyword arguments.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Labels:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    @abstractmethod
+    def samples(self) -> Iterator[Tuple[str, Labels, str, float]]:
+        pass
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, key, extra, value in self.samples():
+            labels = _format_labels(self.labelnames, key, extra)
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, help, labelnames)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        for key, value in sorted(self._values.items()):
+            yield "_total", key, "", value
+
+
+class Gauge(Metric):
+    """
+    Gauge set explicitly, or read from fn when rendered.
+    :param fn: Returns the value, or a dict of label values tuple -> value.
+    """
+
+    kind = "gauge"
+
+    def __init__(
+        self, name: str, help: str, labelnames: Sequence[str] = (), fn: Optional[Callable] = None
+    ) -> None:
+        super().__init__(name, help, labelnames)
+        self.fn = fn
+        self._values: Dict[Labels, float] = {}
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def value(self, **labels) -> float:
+        if self.fn is not None and not self.labelnames:
+            return self.fn()
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        values = self._values
+        if self.fn is not None:
+            try:
+                value = self.fn()
+            except Exception:
+                return
+            values = value if isinstance(value, dict) else {(): value}
+
+        for key, value in sorted(values.items()):
+            yield "", key, "", value
+
+
+class Histogram(Metric):
+    """
+    :param max_series: Label combinations kept, the observations of any other one are counted
+        under the "other" label values. None for no limit.
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+        max_series: Optional[int] = None,
+    ) -> None:
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self.max_series = max_series
+        self._values: Dict[Labels, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            if (
+                self.max_series is not None
+                and key not in self._values
+                and len(self._values) >= self.max_series
+            ):
+                key = (OTHER,) * len(self.labelnames)
+            counts, total = self._values.setdefault(key, ([0] * len(self.buckets), [0.0]))
+            counts[index] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        entry = self._values.get(self._key(labels))
+        return sum(entry[0]) if entry else 0
+
+    def total(self, **labels) -> float:
+        entry = self._values.get(self._key(labels))
+        return entry[1][0] if entry else 0.0
+
+    def quantile(self, q: float, **labels) -> float:
+        """
+        Upper bound of the bucket holding the q-quantile.
+        """
+        entry = self._values.get(self._key(labels))
+        if not entry or sum(entry[0]) == 0:
+            return 0.0
+
+        rank = q * sum(entry[0])
+        cumulative = 0
+        for bound, count in zip(self.buckets, entry[0]):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return self.buckets[-1]
+
+    def samples(self):
+        for key, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield "_bucket", key, f'le="{_format_value(bound)}"', cumulative
+            yield "_sum", key, "", total[0]
+            yield "_count", key, "", cumulative
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(
+        self, name: str, help: str, labelnames: Sequence[str] = (), fn: Optional[Callable] = None
+    ) -> Gauge:
+        return self.register(Gauge(name, help, labelnames, fn))
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+        max_series: Optional[int] = None,
+    ) -> Histogram:
+        return self.register(Histogram(name, help, labelnames, buckets, max_series))
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics.values()) + "\n"
+
+
+registry = Registry()
+
+JOB_EVENTS = registry.counter(
+    "scheduler_job_events", "Scheduler job events by kind.", ["event"]
+)
+SCHEDULER_LAG = registry.histogram(
+    "scheduler_lag_seconds", "Delay between the scheduled and the actual submission of a run."
+)
+JOB_DURATION = registry.histogram(
+    "job_duration_seconds", "Wall-clock duration of a job run.", ["executor", "status"]
+)
+JOB_RUN = registry.histogram(
+    "job_run_seconds",
+    "Wall-clock duration of the runs of a job, the jobs past JOB_METRICS_LIMIT are counted "
+    'under job="other".',
+    ["job"],
+    max_series=int(os.environ.get("JOB_METRICS_LIMIT", "200")),
+)
+FETCH_PHASE = registry.histogram(
+    "fetch_store_phase_seconds", "Duration of the phases of a fetch_store pass.", ["phase"]
+)
+CODE_INIT = registry.histogram(
+    "code_init_seconds", "Duration of Code construction (hash, compile, import).", ["lazy"]
+)
+PIP_INSTALL = registry.histogram(
+    "pip_install_seconds",
+    "Duration of a pip install run.",
+    ["result"],
+    buckets=(1, 2.5, 5, 10, 30, 60, 120, 300, 600),
+)
+
+
+class PhaseTimer:
+    """
+    Exclusive time of nested phases, e.g. compile inside schedule counts for compile only.
+    """
+
+    def __init__(self) -> None:
+        self.durations: Dict[str, float] = {}
+        self._stack: List[List] = []
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        frame = [name, time.perf_counter(), 0.0]  # name, start, time spent in nested phases
+        self._stack.append(frame)
+        try:
+            yield
+        finally:
+            self._stack.pop()
+            elapsed = time.perf_counter() - frame[1]
+            self.durations[name] = self.durations.get(name, 0) + elapsed - frame[2]
+            if self._stack:
+                self._stack[-1][2] += elapsed
+
+    def observe(self, histogram: Histogram) -> None:
+        for name, duration in self.durations.items():
+            histogram.observe(duration, phase=name)
+
+
+def instrument_scheduler(scheduler) -> None:
+    """
+    Count the scheduler's job events and measure its lag from the submissions.
+    """
+
+    def on_event(event) -> None:
+        if event.code == EVENT_JOB_SUBMITTED:
+            now = time.time()
+            for run_time in event.scheduled_run_times:
+                SCHEDULER_LAG.observe(max(now - run_time.timestamp(), 0))
+            return
+
+        JOB_EVENTS.inc(event=names[event.code])
+
+    names = {
+        EVENT_JOB_EXECUTED: "executed",
+        EVENT_JOB_ERROR: "error",
+        EVENT_JOB_MISSED: "missed",
+        EVENT_JOB_MAX_INSTANCES: "max_instances",
+    }
+    mask = EVENT_JOB_SUBMITTED
+    for code in names:
+        mask |= code
+    scheduler.add_listener(on_event, mask)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    registry: Registry = registry
+
+    def do_GET(self) -> None:
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        pass  # scrapes stay out of the logs
+
+
+def serve(port: int, host: str = "127.0.0.1", registry: Registry = registry) -> ThreadingHTTPServer:
+    """
+    Serve the metrics at http://host:port/metrics from a daemon thread.
+    :param int port: Port, 0 for any free one.
+    :return: Server, server_address holds the bound address.
+    :rtype: ThreadingHTTPServer
+    """
+    handler = type("MetricsHandler", (_Handler,), {"registry": registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+
+class FileExporter:
+    """
+    Write the metrics to a file every interval seconds, e.g. for node_exporter's textfile collector.
+    """
+
+    def __init__(self, path: str, interval: float = 15, registry: Registry = registry) -> None:
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+        self._stopped = threading.Event()
+
+    def write(self) -> None:
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            f.write(self.registry.render())
+        os.replace(tmp, self.path)  # scrapers never read a partial file
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            try:
+                self.write()
+            except OSError:
+                pass
+
+    def start(self) -> "FileExporter":
+        self.write()
+        threading.Thread(target=self._run, name="metrics_file", daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self._stopped.set()
@@ -0,0 +1,108 @@
+"""
+Reconciliation of the desired job set against the jobs live in the store / scheduler.
+Only the jobs that changed are touched, edited jobs are replaced instead of re-added.
+"""
+
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Mapping, Optional, Tuple
+
+from libs.code import Code
+
+
+@dataclass(frozen=True)
+class JobSpec:
+    """
+    :param str id: Job id, also the scheduler job id and the Code name.
+    :param str bucket: Cron bucket of the job.
+    :param dict cron: Cron fields of the job.
+    :param str src: Source code of the job.
+    :param str digest: Content hash of the source code.
+    :param str executor: Execution mode of the job, thread | process | venv.
+    :param float timeout: Wall-clock timeout of a run, process / venv mode and coroutines only.
+    :param tuple deps: Requirements of the job.
+    :param int offset: Staggering offset in seconds after the cron instant.
+    :param int jitter: Random delay in seconds added to every run.
+    :param dict options: Scheduler job options, max_instances / coalesce / misfire_grace_time.
+    :param str title: Name of the job, recorded with its runs.
+    """
+
+    id: str
+    bucket: str
+    cron: Dict = field(compare=False)
+    src: str = field(repr=False)
+    digest: str = field(repr=False)
+    executor: str = "thread"
+    timeout: Optional[float] = None
+    deps: Tuple[str, ...] = ()
+    offset: int = field(default=0, compare=False)  # part of the bucket
+    jitter: Optional[int] = field(default=None, compare=False)  # part of the bucket
+    options: Dict = field(default_factory=dict, compare=False)  # part of the bucket
+    title: str = field(default="", compare=False)
+
+    @property
+    def signature(self) -> Tuple:
+        return (self.digest, self.executor, self.timeout, self.deps)
+
+
+@dataclass
+class Plan:
+    """
+    Minimal set of scheduler / store operations to reach the desired job set.
+    """
+
+    add: List[JobSpec] = field(default_factory=list)
+    modify: List[JobSpec] = field(default_factory=list)  # code / execution mode / name changed
+    reschedule: List[JobSpec] = field(default_factory=list)  # cron / stagger / options changed
+    remove: List[str] = field(default_factory=list)
+    failed: List[str] = field(default_factory=list)  # rejected when applied, e.g. an invalid cron
+
+    def __len__(self) -> int:
+        return len(self.add) + len(self.modify) + len(self.reschedule) + len(self.remove)
+
+    def summary(self) -> str:
+        summary = (
+            f"add:{len(self.add)} modify:{len(self.modify)} "
+            f"reschedule:{len(self.reschedule)} remove:{len(self.remove)}"
+        )
+        return f"{summary} failed:{len(self.failed)}" if self.failed else summary
+
+
+def diff(
+    desired: Iterable[JobSpec],
+    live: Mapping[str, Tuple[str, Code]],
+    removed: Iterable[str] = (),
+    full: bool = False,
+) -> Plan:
+    """
+    Diff the desired jobs against the live ones.
+    :param desired: Specs of the jobs which should be scheduled.
+    :param live: Live jobs, job id -> (bucket, Code), e.g. Store.index.
+    :param removed: Ids of the jobs which should not be scheduled anymore.
+    :param bool full: Whether desired is the complete job set, live jobs missing from it are removed.
+    :return: Plan.
+    :rtype: Plan
+    """
+    plan = Plan()
+    seen = set()
+    removed = set(removed)
+
+    for spec in desired:
+        if spec.id in removed or spec.id in seen:
+            continue
+        seen.add(spec.id)
+
+        if spec.id not in live:
+            plan.add.append(spec)
+            continue
+
+        bucket, code_obj = live[spec.id]
+        if code_obj.signature != spec.signature or code_obj.title != spec.title:
+            plan.modify.append(spec)
+        if bucket != spec.bucket:
+            plan.reschedule.append(spec)
+
+    if full:
+        removed.update(job_id for job_id in live if job_id not in seen)
+
+    plan.remove.extend(job_id for job_id in removed if job_id in live)
+    return plan
@@ -0,0 +1,220 @@
+"""
+Runner for executing job code in a separate worker process.
+Output is captured in the worker and sent back, a wall-clock timeout kills the worker.
+Workers are forked from a warm forkserver which has the jobs' dependencies pre-imported.
+They run the jobs with this module only, the parent's main module (main.py, which builds
+the scheduler and its pools on import) is never re-run in them.
+
+Jobs isolated in their own environment run in that environment's interpreter,
+with this module as the entry point (python -m libs.runner).
+"""
+
+import importlib.machinery
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import threading
+from multiprocessing import forkserver
+from multiprocessing.connection import Connection
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+from libs.code import ERROR, TIMEOUT, Code
+
+START_METHOD = os.environ.get("PROCESS_START_METHOD", "forkserver")
+
+# always preloaded, the workers' entry point
+BASE_PRELOAD = ["libs.runner"]
+# main module of the parent, {"path": ..., "name": ...}, for the forkserver
+PARENT_MAIN_ENV = "RUNNER_PARENT_MAIN"
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parent_main() -> Dict[str, Optional[str]]:
+    main = sys.modules["__main__"]
+    return {
+        "path": getattr(main, "__file__", None),
+        "name": getattr(getattr(main, "__spec__", None), "name", None),
+    }
+
+
+def adopt_parent_main() -> None:
+    """
+    In the forkserver, mark the parent's main module as already loaded.
+    Every worker re-runs the parent's main module before the job otherwise: the forkserver
+    drops the main path from its preparation data, a "__main__" preload never happens.
+    """
+    main = sys.modules["__main__"]
+    parent = os.environ.get(PARENT_MAIN_ENV)
+    if parent is None or getattr(main, "__file__", None) is not None:
+        return  # not a forkserver (started with -c), e.g. python -m libs.runner
+
+    parent = json.loads(parent)
+    if parent["path"] is not None:
+        main.__file__ = os.path.normpath(parent["path"])
+    if parent["name"] is not None:
+        main.__spec__ = importlib.machinery.ModuleSpec(parent["name"], None)
+
+
+def _run_in_worker(conn: Connection, name: str, src: str) -> None:
+    try:
+        conn.send(Code(name, src).execute())
+    except Exception as E:
+        conn.send((repr(E), ERROR))
+    finally:
+        conn.close()
+
+
+class ProcessRunner:
+    """
+    Runs every job in its own worker process, so runaway jobs can be killed and
+    CPU-bound jobs don't hold the scheduler's GIL.
+    :param str start_method: multiprocessing start method of the workers.
+    """
+
+    def __init__(self, start_method: str = START_METHOD) -> None:
+        self.context = multiprocessing.get_context(start_method)
+        self.preloaded: Set[str] = set()
+        self._lock = threading.Lock()
+
+        if self.forkserver:
+            self.context.set_forkserver_preload(BASE_PRELOAD)
+
+    @property
+    def forkserver(self) -> bool:
+        return self.context.get_start_method() == "forkserver"
+
+    def _export_main(self) -> None:
+        if self.forkserver:  # inherited by the forkserver when it starts
+            os.environ[PARENT_MAIN_ENV] = json.dumps(parent_main())
+
+    def preload(self, modules: Iterable[str], force: bool = False) -> bool:
+        """
+        Pre-import the modules in the forkserver, restarting it if the set changed.
+        :param modules: Modules to pre-import, e.g. the top-level modules of the jobs' deps.
+        :param bool force: Restart even if the set is unchanged, e.g. after installing deps.
+        :return: Whether the forkserver was restarted.
+        :rtype: bool
+        """
+        modules = set(modules)
+
+        if not self.forkserver or (modules == self.preloaded and not force):
+            return False
+
+        with self._lock:
+            self.preloaded = modules
+            self.context.set_forkserver_preload(BASE_PRELOAD + sorted(modules))
+            self._export_main()
+
+            # no public way to restart the forkserver, without it the preload applies once the
+            # current server exits
+            stop = getattr(forkserver._forkserver, "_stop", None)
+            if stop is None:
+                return False
+            try:
+                stop()  # running workers are unaffected, new ones fork from the new server
+            except (OSError, ValueError):
+                return False
+
+            forkserver.ensure_running()  # warm up now rather than on the next run
+
+        return True
+
+    def execute(self, name: str, src: str, timeout: Optional[float] = None) -> Tuple[str, str]:
+        """
+        Run the code in a worker process.
+        :param str name: Name of the module.
+        :param str src: Source code.
+        :param float timeout: Seconds after which the worker is killed, None to wait forever.
+        :return: Captured output (or the repr of the error) and the status, see Code.execute.
+        :rtype: tuple
+        """
+        recv_conn, send_conn = self.context.Pipe(duplex=False)
+        worker = self.context.Process(
+            target=_run_in_worker, args=(send_conn, name, src), daemon=True
+        )
+
+        with self._lock:
+            self._export_main()
+            worker.start()
+        send_conn.close()
+
+        try:
+            if recv_conn.poll(timeout):
+                result = recv_conn.recv()
+            else:
+                worker.kill()
+                result = repr(TimeoutError(f"Job {name} killed after {timeout}s")), TIMEOUT
+
+        except EOFError:  # worker died without sending anything
+            worker.join()
+            result = repr(ChildProcessError(f"Worker exited with code {worker.exitcode}")), ERROR
+
+        finally:
+            recv_conn.close()
+
+        worker.join()
+        return result
+
+    def run(self, name: str, src: str, timeout: Optional[float] = None) -> str:
+        return self.execute(name, src, timeout)[0]
+
+    def execute_in(
+        self, python: str, name: str, src: str, timeout: Optional[float] = None
+    ) -> Tuple[str, str]:
+        """
+        Run the code in a worker process of another interpreter, e.g. a job's virtualenv.
+        :param str python: Path of the interpreter.
+        :param str name: Name of the module.
+        :param str src: Source code.
+        :param float timeout: Seconds after which the worker is killed, None to wait forever.
+        :return: Captured output (or the repr of the error) and the status, see Code.execute.
+        :rtype: tuple
+        """
+        try:
+            p = subprocess.run(
+                [python, "-m", "libs.runner"],
+                input=json.dumps({"name": name, "src": src}),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                cwd=ROOT,
+                timeout=timeout,
+                universal_newlines=True,
+            )
+        except subprocess.TimeoutExpired:
+            return repr(TimeoutError(f"Job {name} killed after {timeout}s")), TIMEOUT
+        except OSError as E:
+            return repr(E), ERROR
+
+        if p.returncode != 0:
+            return repr(ChildProcessError(f"Worker exited with code {p.returncode}")), ERROR
+
+        output, status = json.loads(p.stdout)
+        return output, status
+
+    def run_in(
+        self, python: str, name: str, src: str, timeout: Optional[float] = None
+    ) -> str:
+        return self.execute_in(python, name, src, timeout)[0]
+
+
+def serve_stdin() -> None:
+    """
+    Worker entry point, runs the job read from stdin and writes its output to stdout.
+    """
+    job = json.load(sys.stdin)
+
+    # keep stray output of the job (e.g. from its own threads) off the result stream
+    result = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    json.dump(Code(job["name"], job["src"]).execute(), result)
+    result.close()
+
+
+adopt_parent_main()  # imported by the forkserver as a preload
+
+if __name__ == "__main__":
+    serve_stdin()
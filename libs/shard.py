@@ -0,0 +1,236 @@
+"""
+Lease-based sharding of the jobs across workers.
+Job ids hash to a fixed number of partitions, the partitions are spread over the
+live workers with a consistent hash ring, so a worker joining or leaving moves
+only ~1/N of them. A worker runs the jobs of a partition only while it holds the
+partition's lease in MongoDB: lost partitions are unscheduled before their lease
+is released, and a dead worker's leases are claimed once they expire, so every
+job runs on exactly one worker.
+"""
+
+import bisect
+import hashlib
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+import zlib
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+from mongoengine import Q
+from mongoengine.errors import NotUniqueError
+from pymongo.errors import DuplicateKeyError
+
+from libs.db import Lease, Worker
+
+VNODES = 128  # points of a worker on the ring, evens out the partitions per worker
+
+
+def partition_of(job_id: str, partitions: int) -> int:
+    return zlib.crc32(str(job_id).encode("utf-8")) % partitions
+
+
+def _point(key: str) -> int:
+    # crc32 of near-identical keys clusters on the ring, md5 spreads them evenly
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    Consistent hash ring of the workers.
+    :param workers: Ids of the workers.
+    :param int vnodes: Points per worker.
+    """
+
+    def __init__(self, workers: Iterable[str], vnodes: int = VNODES) -> None:
+        points = sorted(
+            (_point(f"{worker}#{n}"), worker)
+            for worker in set(workers)
+            for n in range(vnodes)
+        )
+        self._hashes = [point for point, _ in points]
+        self._workers = [worker for _, worker in points]
+
+    def owner(self, partition: int) -> Optional[str]:
+        if not self._workers:
+            return None
+
+        index = bisect.bisect(self._hashes, _point(f"partition-{partition}"))
+        return self._workers[index % len(self._workers)]
+
+    def assign(self, partitions: int) -> Dict[str, Set[int]]:
+        """
+        :return: Worker id -> partitions it should own.
+        :rtype: dict
+        """
+        assignment: Dict[str, Set[int]] = {worker: set() for worker in self._workers}
+        for partition in range(partitions):
+            assignment[self.owner(partition)].add(partition)
+        return assignment
+
+
+class ShardCoordinator:
+    """
+    Registers the worker with heartbeats and keeps the leases of its partitions.
+    :param int partitions: Partitions of the job ids, the same on every worker.
+    :param float lease_ttl: Seconds a lease / heartbeat is valid, well above heartbeat_interval.
+    :param float heartbeat_interval: Seconds between two heartbeats.
+    :param on_acquire: Called with the partitions gained, after their leases are held.
+    :param on_release: Called with the partitions lost, before their leases are released.
+    :param str worker_id: Id of the worker, host:pid:random by default.
+    """
+
+    def __init__(
+        self,
+        partitions: int = 256,
+        lease_ttl: float = 30,
+        heartbeat_interval: float = 10,
+        on_acquire: Optional[Callable[[Set[int]], None]] = None,
+        on_release: Optional[Callable[[Set[int]], None]] = None,
+        worker_id: Optional[str] = None,
+        logger: Optional[logging.Logger] = None,
+    ) -> None:
+        self.partitions = partitions
+        self.lease_ttl = timedelta(seconds=lease_ttl)
+        self.heartbeat_interval = heartbeat_interval
+        self.on_acquire = on_acquire
+        self.on_release = on_release
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.logger = logger or logging.getLogger("root")
+        self.started_at = datetime.utcnow()
+        self.owned: Set[int] = set()
+        self.workers: List[str] = []
+        self._renewed_at = 0.0  # monotonic time of the last successful heartbeat
+        self._lock = threading.RLock()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def owns(self, job_id: str) -> bool:
+        return partition_of(job_id, self.partitions) in self.owned
+
+    def live_workers(self, now: datetime) -> List[str]:
+        alive = Worker.objects(heartbeat_at__gt=now - self.lease_ttl).only("worker_id")
+        return sorted(worker.worker_id for worker in alive)
+
+    def _claim(self, partition: int, now: datetime) -> bool:
+        free = Q(owner=self.worker_id) | Q(owner=None) | Q(expires_at__lte=now)
+        try:
+            lease = Lease.objects(partition=partition).filter(free).modify(
+                upsert=True,
+                new=True,
+                set_on_insert__partition=partition,
+                set__owner=self.worker_id,
+                set__expires_at=now + self.lease_ttl,
+            )
+        except (NotUniqueError, DuplicateKeyError):  # held by another worker
+            return False
+        return lease is not None
+
+    def heartbeat(self) -> Set[int]:
+        """
+        Renew the worker's registration and leases, then rebalance.
+        :return: Partitions owned.
+        :rtype: set
+        """
+        with self._lock:
+            started = time.monotonic()
+            now = datetime.utcnow()
+            Worker.objects(worker_id=self.worker_id).update_one(
+                upsert=True,
+                set__host=socket.gethostname(),
+                set__pid=os.getpid(),
+                set__started_at=self.started_at,
+                set__heartbeat_at=now,
+                set__expire_at=now + self.lease_ttl * 10,
+            )
+
+            self.workers = self.live_workers(now)
+            target = HashRing(self.workers).assign(self.partitions).get(self.worker_id, set())
+
+            # handed over, stop running the jobs before anyone else may start them
+            lost = self.owned - target
+            if lost:
+                self._release(lost)
+
+            Lease.objects(owner=self.worker_id, partition__in=list(target)).update(
+                set__expires_at=now + self.lease_ttl
+            )
+            for partition in target - self.owned:
+                self._claim(partition, now)
+
+            held = Lease.objects(owner=self.worker_id, expires_at__gt=now).only("partition")
+            owned = set(lease.partition for lease in held) & target
+            self._renewed_at = started
+
+            stolen = self.owned - owned  # expired while the worker was stalled
+            if stolen:
+                self._release(stolen, expire=False)
+
+            gained = owned - self.owned
+            self.owned = owned
+            if gained:
+                self.logger.info(
+                    "Shard %s acquired %s partitions, owns %s of %s with %s workers",
+                    self.worker_id,
+                    len(gained),
+                    len(self.owned),
+                    self.partitions,
+                    len(self.workers),
+                )
+                if self.on_acquire is not None:
+                    self.on_acquire(gained)
+
+            return set(self.owned)
+
+    def _release(self, partitions: Set[int], expire: bool = True) -> None:
+        self.owned -= partitions
+        if self.on_release is not None:
+            self.on_release(partitions)
+
+        if expire:
+            Lease.objects(owner=self.worker_id, partition__in=list(partitions)).update(
+                set__owner=None, set__expires_at=datetime.utcnow()
+            )
+        self.logger.info(
+            "Shard %s released %s partitions, owns %s",
+            self.worker_id,
+            len(partitions),
+            len(self.owned),
+        )
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.heartbeat_interval):
+            try:
+                self.heartbeat()
+            except Exception as E:
+                self.logger.error("Shard %s heartbeat failed: %r", self.worker_id, E)
+
+                # the leases expire before the next attempt, stop running the jobs
+                with self._lock:
+                    elapsed = time.monotonic() - self._renewed_at
+                    remaining = self.lease_ttl.total_seconds() - elapsed
+                    if remaining < self.heartbeat_interval and self.owned:
+                        self._release(set(self.owned), expire=False)
+
+    def start(self) -> "ShardCoordinator":
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="shard", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """
+        Leave the ring, the partitions are handed over right away instead of on expiry.
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        with self._lock:
+            if self.owned:
+                self._release(set(self.owned))
+            Worker.objects(worker_id=self.worker_id).delete()
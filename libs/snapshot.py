@@ -0,0 +1,121 @@
+"""
+Snapshot of the jobs in the store, next to a persistent jobstore for warm restarts.
+Every reconciliation writes only the jobs it touched, so on boot the store is rebuilt
+from the snapshot instead of querying, diffing and scheduling the whole job set, and
+only the jobs changed since the last sync are reconciled.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from dataclasses import fields
+from typing import Dict, Iterable, List
+
+from pymongo import DeleteOne, ReplaceOne
+
+from libs.db import StoreEntry
+from libs.reconcile import JobSpec, Plan
+
+
+def spec_to_dict(spec: JobSpec) -> Dict:
+    doc = {f.name: getattr(spec, f.name) for f in fields(spec)}
+    doc.update(cron=dict(spec.cron), deps=list(spec.deps), options=dict(spec.options))
+    return doc
+
+
+def spec_from_dict(doc: Dict) -> JobSpec:
+    doc = dict(doc)
+    doc["deps"] = tuple(doc.get("deps", ()))
+    return JobSpec(**doc)
+
+
+class Snapshot(ABC):
+    """
+    Job id -> JobSpec of the scheduled jobs.
+    """
+
+    @abstractmethod
+    def load(self) -> List[JobSpec]:
+        pass
+
+    @abstractmethod
+    def write(self, specs: Iterable[JobSpec], removed: Iterable[str]) -> None:
+        pass
+
+    @abstractmethod
+    def clear(self) -> None:
+        pass
+
+    def apply(self, plan: Plan) -> None:
+        """
+        Record the jobs added / changed and removed by the plan.
+        """
+        specs = {spec.id: spec for spec in plan.add + plan.modify + plan.reschedule}
+        for job_id in plan.failed:  # kept as they were
+            specs.pop(job_id, None)
+        if specs or plan.remove:
+            self.write(specs.values(), plan.remove)
+
+
+class MongoSnapshot(Snapshot):
+    """
+    Snapshot in the StoreEntry collection, one document per job.
+    """
+
+    def load(self) -> List[JobSpec]:
+        return [spec_from_dict(doc["spec"]) for doc in StoreEntry._get_collection().find()]
+
+    def write(self, specs: Iterable[JobSpec], removed: Iterable[str]) -> None:
+        ops = [
+            ReplaceOne({"_id": spec.id}, {"_id": spec.id, "spec": spec_to_dict(spec)}, upsert=True)
+            for spec in specs
+        ] + [DeleteOne({"_id": job_id}) for job_id in removed]
+
+        if ops:
+            StoreEntry._get_collection().bulk_write(ops, ordered=False)
+
+    def clear(self) -> None:
+        StoreEntry.drop_collection()
+
+
+class SQLiteSnapshot(Snapshot):
+    """
+    Snapshot in a local SQLite database, e.g. the file of the SQLite jobstore.
+    :param str path: Database file.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS store_snapshot "
+                "(id TEXT PRIMARY KEY, spec TEXT NOT NULL)"
+            )
+
+    def load(self) -> List[JobSpec]:
+        with self._lock:
+            rows = self._conn.execute("SELECT spec FROM store_snapshot").fetchall()
+        return [spec_from_dict(json.loads(spec)) for spec, in rows]
+
+    def write(self, specs: Iterable[JobSpec], removed: Iterable[str]) -> None:
+        with self._lock, self._conn:  # one transaction
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO store_snapshot (id, spec) VALUES (?, ?)",
+                [(spec.id, json.dumps(spec_to_dict(spec))) for spec in specs],
+            )
+            self._conn.executemany(
+                "DELETE FROM store_snapshot WHERE id = ?", [(job_id,) for job_id in removed]
+            )
+
+    def clear(self) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM store_snapshot")
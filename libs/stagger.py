@@ -0,0 +1,153 @@
+"""
+Load smoothing for crowded cron instants.
+Jobs sharing a cron fire in the same second, a deterministic offset derived from
+the job id (or the bucket in coalesced mode) spreads them over a window after the
+instant, so every run stays in the interval it was scheduled in.
+"""
+
+import hashlib
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from apscheduler.triggers.cron import CronTrigger
+from tzlocal import get_localzone
+
+PERIOD_START = datetime(2001, 1, 1, tzinfo=timezone.utc)  # fixed, the offsets stay stable
+PERIOD_SAMPLES = 1024
+
+
+def stagger_offset(key: str, window: Optional[int]) -> int:
+    """
+    Deterministic offset of the key within the window, stable across restarts and workers.
+    :param str key: Job id, or the bucket in coalesced mode.
+    :param int window: Window in seconds, None / 0 to disable.
+    :return: Offset in seconds, in [0, window).
+    :rtype: int
+    """
+    if not window or window <= 0:
+        return 0
+
+    digest = hashlib.sha1(key.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % int(window)
+
+
+class StaggeredCronTrigger(CronTrigger):
+    """
+    Cron trigger firing a fixed number of seconds after each cron instant.
+    :param int offset: Seconds after the cron instant.
+    """
+
+    def __init__(self, offset: int = 0, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.offset = timedelta(seconds=offset)
+
+    def get_next_fire_time(self, previous_fire_time, now):
+        if previous_fire_time is not None:
+            previous_fire_time -= self.offset
+
+        # a cron instant less than offset ago still has its staggered run ahead
+        fire_time = super().get_next_fire_time(previous_fire_time, now - self.offset)
+        return fire_time + self.offset if fire_time is not None else None
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state["offset"] = self.offset
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self.offset = state.get("offset", timedelta(0))
+
+    def __str__(self):
+        if not self.offset:
+            return super().__str__()
+        return f"{super().__str__()}+{int(self.offset.total_seconds())}s"
+
+
+def fire_times(
+    cron: Dict, start: datetime, end: datetime, limit: Optional[int] = None
+) -> List[datetime]:
+    trigger = CronTrigger(**cron, timezone=start.tzinfo)
+    times: List[datetime] = []
+    fire_time = trigger.get_next_fire_time(None, start)
+
+    while fire_time is not None and fire_time < end and (limit is None or len(times) < limit):
+        times.append(fire_time)
+        fire_time = trigger.get_next_fire_time(fire_time, fire_time + timedelta(microseconds=1))
+
+    return times
+
+
+def cron_period(cron: Dict) -> Optional[int]:
+    """
+    Shortest gap between two consecutive fire times of the cron, over its first fire times in
+    a year from a fixed instant, an offset below it keeps every run before the next instant.
+    :return: Gap in seconds, None when the cron fires less than twice or is invalid.
+    :rtype: int
+    """
+    return _cron_period(tuple(sorted((field, str(value)) for field, value in cron.items())))
+
+
+@lru_cache(maxsize=4096)
+def _cron_period(cron: Tuple[Tuple[str, str], ...]) -> Optional[int]:
+    try:
+        times = fire_times(
+            dict(cron), PERIOD_START, PERIOD_START + timedelta(days=366), PERIOD_SAMPLES
+        )
+    except (ValueError, TypeError):  # rejected when the job is scheduled
+        return None
+
+    gaps = [(later - earlier).total_seconds() for earlier, later in zip(times, times[1:])]
+    return int(min(gaps)) if gaps else None
+
+
+def peak_concurrency(
+    jobs: Iterable[Tuple[str, Dict, int]],
+    horizon: timedelta = timedelta(hours=1),
+    start: Optional[datetime] = None,
+) -> Dict[str, object]:
+    """
+    Peak number of jobs firing in the same second, without and with the offsets.
+    :param jobs: (bucket, cron, offset) of every job, the fire times are computed once per bucket.
+        Jobs with an invalid cron are left out.
+    :param timedelta horizon: Time span simulated.
+    :param datetime start: Start of the span, aware, defaults to now.
+    :return: Peak and its instant before / after staggering.
+    :rtype: dict
+    """
+    start = (start or datetime.now(get_localzone())).replace(microsecond=0)
+    end = start + horizon
+    by_bucket: Dict[str, Tuple[List[datetime], List[int]]] = {}
+    invalid = set()
+
+    for bucket, cron, offset in jobs:
+        if bucket in invalid:
+            continue
+
+        if bucket not in by_bucket:
+            try:
+                by_bucket[bucket] = (fire_times(cron, start, end), [])
+            except (ValueError, TypeError):  # left out, rejected when the job is scheduled
+                invalid.add(bucket)
+                continue
+        by_bucket[bucket][1].append(offset)
+
+    before: Counter = Counter()
+    after: Counter = Counter()
+
+    for times, offsets in by_bucket.values():
+        shifts = Counter(offsets)
+        for fire_time in times:
+            before[fire_time] += len(offsets)
+            for offset, count in shifts.items():
+                after[fire_time + timedelta(seconds=offset)] += count
+
+    report: Dict[str, object] = {"jobs": sum(len(o) for _, o in by_bucket.values())}
+    for name, counter in (("before", before), ("after", after)):
+        instant, peak = counter.most_common(1)[0] if counter else (None, 0)
+        report[name] = peak
+        report[f"{name}_at"] = instant.isoformat() if instant is not None else None
+
+    return report
@@ -3,25 +3,70 @@ Store class to store all the code to execute according to schedule.
 """
 
 from collections import UserDict, UserList
+from typing import Any, Dict, Optional, Tuple
 
 from libs.code import Code
 
 
 class CodeList(UserList):
+    """
+    List of Code objects of a bucket, unique by name.
+    Keeps the position of every name so removal is O(1) (swap with the last, pop).
+    """
+
+    def __init__(self, initlist=None) -> None:
+        super().__init__()
+        self.positions: Dict[str, int] = {}
+
+        for item in initlist or []:
+            self.append(item)
+
     def append(self, item: Code) -> None:
         if not isinstance(item, Code):
             raise TypeError("Can only append Code objects to the list")
+        elif item.name in self.positions:
+            self.data[self.positions[item.name]] = item
         else:
+            self.positions[item.name] = len(self.data)
             return super().append(item)
 
+    def pop_name(self, name: str) -> Optional[Code]:
+        position = self.positions.pop(name, None)
+        if position is None:
+            return None
+
+        item = self.data[position]
+        last = self.data.pop()
+
+        if position < len(self.data):
+            self.data[position] = last
+            self.positions[last.name] = position
+
+        return item
+
 
 class Store(UserDict):
+    """
+    Cron bucket -> CodeList mapping, with a secondary index job id -> (bucket, Code).
+    Jobs are added with Store.add and removed with Store.remove / Store.discard.
+    """
+
+    def __init__(self, *args, scheduler: Any = None, **kwargs) -> None:
+        self.index: Dict[str, Tuple[str, Code]] = {}
+        self.scheduler = scheduler
+        super().__init__(*args, **kwargs)
+
     def __setitem__(self, __k: str, __v: CodeList) -> None:
         if not isinstance(__v, CodeList):
             raise TypeError("Can only put CodeList objects in Store")
         if not isinstance(__k, str):
             raise TypeError("Can only use strings as keys in Store")
         else:
+            if __k in self.data:
+                self._unindex(__k)
+            for code_obj in __v:
+                self.index[code_obj.name] = (__k, code_obj)
+
             return super().__setitem__(__k, __v)
 
     def __getitem__(self, __k: str):
@@ -34,3 +79,46 @@ class Store(UserDict):
             __v = super().__getitem__(__k)
 
         return __v
+
+    def __delitem__(self, __k: str) -> None:
+        self._unindex(__k)
+        return super().__delitem__(__k)
+
+    def _unindex(self, bucket: str) -> None:
+        for code_obj in self.data[bucket]:
+            if self.index.get(code_obj.name, (None,))[0] == bucket:
+                del self.index[code_obj.name]
+
+    def add(self, bucket: str, code_obj: Code) -> None:
+        if code_obj.name in self.index:
+            self.discard(code_obj.name)
+
+        self[bucket].append(code_obj)
+        self.index[code_obj.name] = (bucket, code_obj)
+
+    def locate(self, name: str) -> Optional[Tuple[str, Code]]:
+        return self.index.get(name)
+
+    def discard(self, name: str) -> Optional[Tuple[str, Code]]:
+        found = self.index.pop(name, None)
+
+        if found is not None:
+            bucket, _ = found
+            code_list = self.data[bucket]
+            code_list.pop_name(name)
+
+            if len(code_list) == 0:
+                del self.data[bucket]
+
+        return found
+
+    def remove(self, name: str) -> Optional[Tuple[str, Code]]:
+        """
+        Discard the job from the store and unschedule it in the same step.
+        """
+        found = self.discard(name)
+
+        if self.scheduler is not None and self.scheduler.get_job(name) is not None:
+            self.scheduler.remove_job(name)
+
+        return found
@@ -0,0 +1,156 @@
+"""
+Change stream consumer to keep the in-memory store in sync with the Job collection.
+Events are applied as they happen, polling stays as the fallback when change
+streams are not available (e.g. standalone mongod without a replica set).
+"""
+
+import logging
+import threading
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+UPSERT = "upsert"
+DELETE = "delete"
+
+# change streams need a replica set / sharded cluster, these codes mean they never will work
+UNSUPPORTED_CODES = {40573, 40324, 136}
+
+
+def classify(event: Dict) -> Tuple[Optional[str], Optional[str], Optional[Dict]]:
+    """
+    Translate a raw change event into an action on the store.
+    :param dict event: Change event as returned by pymongo.
+    :return: (action, job id, full document), action is None for events to skip.
+    :rtype: tuple
+    """
+    op = event.get("operationType")
+    key = event.get("documentKey") or {}
+    job_id = str(key["_id"]) if "_id" in key else None
+
+    if op == DELETE:
+        return DELETE, job_id, None
+
+    if op not in ("insert", "replace", "update"):
+        return None, job_id, None
+
+    doc = event.get("fullDocument")
+    if doc is None:  # deleted before the lookup, the delete event follows
+        return None, job_id, None
+
+    if doc.get("to_be_deleted", False):
+        return DELETE, job_id, doc
+
+    if op == "update":
+        updated = set((event.get("updateDescription") or {}).get("updatedFields", {}))
+        if updated <= {"sync"}:  # acks written by the sync itself
+            return None, job_id, None
+
+    return UPSERT, job_id, doc
+
+
+def watch_jobs(resume_after: Optional[Dict] = None) -> Iterable[Dict]:
+    """
+    Open a change stream on the Job collection.
+    :param dict resume_after: Resume token of the last processed event.
+    :return: Change stream.
+    """
+    from libs.db import Job
+
+    return Job._get_collection().watch(
+        full_document="updateLookup", resume_after=resume_after
+    )
+
+
+class ChangeStreamSync(threading.Thread):
+    """
+    Background thread applying Job change events through the given callbacks.
+    Stops (and leaves the polling path in charge) if change streams are unsupported.
+    """
+
+    def __init__(
+        self,
+        on_upsert: Callable[[str, Dict], Any],
+        on_delete: Callable[[str, Optional[Dict]], Any],
+        logger: logging.Logger,
+        source: Callable[[Optional[Dict]], Iterable[Dict]] = watch_jobs,
+        retry_delay: float = 5,
+    ) -> None:
+        super().__init__(name="change-stream-sync", daemon=True)
+        self.on_upsert = on_upsert
+        self.on_delete = on_delete
+        self.logger = logger
+        self.source = source
+        self.retry_delay = retry_delay
+        self.resume_token: Optional[Dict] = None
+        self.available = True
+        self.applied = 0
+        self._stop_event = threading.Event()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+    def dispatch(self, event: Dict) -> None:
+        action, job_id, doc = classify(event)
+
+        if action == UPSERT:
+            self.on_upsert(job_id, doc)
+        elif action == DELETE:
+            self.on_delete(job_id, doc)
+
+        if action is not None:
+            self.applied += 1
+
+        self.resume_token = event.get("_id", self.resume_token)
+
+    def consume(self) -> bool:
+        """
+        Consume one stream until it ends.
+        :return: Whether the stream should be reopened.
+        :rtype: bool
+        """
+        stream = self.source(self.resume_token)
+
+        try:
+            for event in stream:
+                if event.get("operationType") in ("drop", "invalidate"):
+                    self.logger.info("Change stream invalidated, falling back to polling")
+                    return False
+
+                try:
+                    self.dispatch(event)
+                except Exception:
+                    self.logger.exception("Failed to apply change event %s", event.get("_id"))
+
+                if self._stop_event.is_set():
+                    return False
+        finally:
+            close = getattr(stream, "close", None)
+            if close is not None:
+                close()
+
+        return not self._stop_event.is_set()
+
+    def run(self) -> None:
+        self.logger.info("Watching Job change stream")
+
+        while not self._stop_event.is_set():
+            try:
+                if not self.consume():
+                    break
+
+            except OperationFailure as E:
+                if E.code in UNSUPPORTED_CODES:
+                    self.available = False
+                    self.logger.info(
+                        "Change streams unavailable (%s), falling back to polling", E
+                    )
+                    break
+                self.logger.exception("Change stream failed, reopening")
+
+            except PyMongoError:
+                self.logger.exception("Change stream failed, reopening")
+
+            self._stop_event.wait(self.retry_delay)
+
+        self.logger.info("Stopped watching Job change stream, applied %s events", self.applied)
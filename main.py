@@ -1,17 +1,37 @@
+import atexit
+import hashlib
 import logging
 import os
+import threading
 import time
-from typing import Dict, Set
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+from typing import Dict, List, Optional, Set, Tuple, Union
 
-from apscheduler.executors import pool
+from apscheduler.jobstores.base import BaseJobStore
+from apscheduler.jobstores.mongodb import MongoDBJobStore
 from apscheduler.schedulers.background import BlockingScheduler
 from mongoengine import *
 
-from libs.code import Code
+from libs.aio import EventLoopThread, LoopThreadExecutor
+from libs.code import Code, module_cache, src_digest
 from libs.db import Job
+from libs.deps import DependencyManager, PackageIndex
+from libs.envs import EnvCache
+from libs.executor import AdaptiveThreadPoolExecutor
+from libs.history import HistoryWriter
+from libs.metrics import (FETCH_PHASE, JOB_DURATION, JOB_RUN, FileExporter, PhaseTimer,
+                          instrument_scheduler, registry, serve)
+from libs.reconcile import JobSpec, Plan, diff
+from libs.runner import ProcessRunner
+from libs.shard import ShardCoordinator, partition_of
+from libs.snapshot import MongoSnapshot, Snapshot, SQLiteSnapshot
 from libs.singleton import Singleton
-from libs.store import CodeList, Store
-from utils import get_deps, get_URI, install_deps, setup_logging
+from libs.stagger import StaggeredCronTrigger, cron_period, peak_concurrency, stagger_offset
+from libs.store import Store
+from libs.sync import ChangeStreamSync
+from utils import dep_modules, get_URI, setup_logging
 
 
 class Logger(Singleton):
@@ -22,22 +42,155 @@ class Logger(Singleton):
 
 class State(Singleton):
     store: Store
-    deps: Set[str]
+    deps: PackageIndex
 
 
 class CodeJob:
+    """
+    :param Code code: Code to run.
+    :param members: Code of the identical jobs sharing the run, each gets the output, the code
+        itself by default.
+    """
+
     code: Code
     logger: Logger
+    members: List[Code]
 
-    def __init__(self, code: Code, logger: Logger) -> None:
+    def __init__(self, code: Code, logger: Logger, members: Optional[List[Code]] = None) -> None:
         self.code = code
         self.logger = logger
+        self.members = members or [code]
+
+    @property
+    def label(self) -> str:
+        return ", ".join(member.name for member in self.members)
+
+    def __call__(self) -> Dict[str, str]:
+        started_at = datetime.utcnow()
+
+        if self.code.executor == "process":
+            result, status = runner.execute(self.code.name, self.code.src, self.code.timeout)
+        elif self.code.executor == "venv":
+            python = env_cache.python(self.code.deps)
+            result, status = runner.execute_in(
+                python, self.code.name, self.code.src, self.code.timeout
+            )
+        else:
+            result, status = self.code.execute(self.on_line if STREAM_OUTPUT else None)
+            return self.report(started_at, result, status, streamed=STREAM_OUTPUT)
+        return self.report(started_at, result, status)
+
+    def on_line(self, line: str) -> None:
+        self.logger.code_logger.info("job::%s | %s", self.label, line)
+
+    def report(
+        self, started_at: datetime, result: str, status: str, streamed: bool = False
+    ) -> Dict[str, str]:
+        ended_at = datetime.utcnow()
+        duration = (ended_at - started_at).total_seconds()
+        JOB_DURATION.observe(
+            duration,
+            executor="asyncio" if self.code.coroutine else self.code.executor,
+            status=status,
+        )
+        for member in self.members:
+            JOB_RUN.observe(duration, job=member.name)
+        if RUN_HISTORY:
+            for member in self.members:
+                history.record(member.name, started_at, ended_at, status, result, member.title)
+
+        if streamed:  # the lines are logged already
+            self.logger.code_logger.info("----job::%s---- %s", self.label, status)
+        else:
+            code_logs = f"\n----job::{self.label}----\n{result}\n-------------------------------------\n"
+            self.logger.code_logger.info(code_logs)
+        return {member.name: result for member in self.members}
+
+
+class AsyncCodeJob(CodeJob):
+    """
+    Coroutine job, runs on the shared event loop instead of holding a pool thread.
+    """
+
+    is_coroutine = True  # picked up by LoopThreadExecutor
+
+    async def __call__(self) -> Dict[str, str]:
+        started_at = datetime.utcnow()
+        result, status = await self.code.execute_async(self.on_line if STREAM_OUTPUT else None)
+        return self.report(started_at, result, status, streamed=STREAM_OUTPUT)
+
+
+def code_job(
+    code_obj: Code, logger: Logger, members: Optional[List[Code]] = None
+) -> Tuple[CodeJob, str]:
+    """
+    Scheduler job of the code and the executor it runs on.
+    """
+    if code_obj.coroutine and code_obj.executor == "thread":
+        return AsyncCodeJob(code_obj, logger, members), "asyncio"
+    return CodeJob(code_obj, logger, members), "default"
+
+
+class BucketJob:
+    """
+    Single scheduler job of a cron bucket, fans out over the bucket's CodeList.
+    Identical jobs run once when deduplicated, their output goes to every one of them.
+    """
+
+    store: Store
+    bucket: str
+    logger: Logger
+
+    def __init__(self, store: Store, bucket: str, logger: Logger) -> None:
+        self.store = store
+        self.bucket = bucket
+        self.logger = logger
+
+    def __call__(self) -> Dict[str, str]:
+        groups: Dict[Tuple, List[Code]] = {}
+        for code_obj in list(self.store.data.get(self.bucket, ())):
+            key = code_obj.signature if DEDUP_JOBS else (code_obj.name,)
+            groups.setdefault(key, []).append(code_obj)
+
+        futures = []
+        for code_objs in groups.values():
+            # a materialized member runs for the group, the others are never imported
+            materialized = [code_obj for code_obj in code_objs if code_obj.lib is not None]
+            leader = (materialized or code_objs)[0]
+            job, executor = code_job(leader, self.logger, code_objs)
+            futures.append(aio.submit(job()) if executor == "asyncio" else fanout.submit(job))
+
+        results = {}
+        for future in futures:
+            results.update(future.result())
+        return results
+
+
+def run_job(job_id: str) -> Dict[str, str]:
+    """
+    Entry point of the jobs in the persistent jobstore, which hold a reference to it and the job id.
+    """
+    found = state.store.locate(job_id)
+    if found is None:  # removed since, unscheduled by the next reconciliation
+        logger.root_logger.warning("Job %s is not in the store, skipped", job_id)
+        return {}
+    return CodeJob(found[1], logger)()
+
 
-    def __call__(self) -> None:
-        result = self.code.run_with_std_patch()
-        code_logs = f"\n----job::{self.code.name}----\n{result}\n-------------------------------------\n"
-        self.logger.code_logger.info(code_logs)
-        return {self.code.name: result}
+async def run_async_job(job_id: str) -> Dict[str, str]:
+    found = state.store.locate(job_id)
+    if found is None:
+        logger.root_logger.warning("Job %s is not in the store, skipped", job_id)
+        return {}
+    return await AsyncCodeJob(found[1], logger)()
+
+
+def run_bucket(bucket: str) -> Dict[str, str]:
+    return BucketJob(state.store, bucket, logger)()
+
+
+def bucket_job_id(bucket: str) -> str:
+    return f"bucket::{bucket}"
 
 
 def cronify(cron_config: Dict):
@@ -45,14 +198,414 @@ def cronify(cron_config: Dict):
     return f"< {key} >"
 
 
-executors = {"default": pool.ThreadPoolExecutor(20)}
-scheduler = BlockingScheduler(executors=executors)
+def dedup_group(signature: Tuple) -> str:
+    """
+    Short hash of a job's signature (code digest, execution mode, timeout, deps).
+    """
+    return hashlib.sha1(repr(signature).encode("utf-8")).hexdigest()[:12]
+
+
+def scheduled_bucket(
+    bucket: str,
+    offset: int = 0,
+    jitter: Optional[int] = None,
+    options: Optional[Dict] = None,
+    group: Optional[str] = None,
+) -> str:
+    """
+    Bucket of the jobs sharing the cron and the way it is scheduled, one scheduler job when coalesced.
+    Deduplicated jobs are bucketed by their group as well, one scheduler job per group.
+    """
+    if offset:
+        bucket = f"{bucket} +{offset}s"
+    if jitter:
+        bucket = f"{bucket} ~{jitter}s"
+    if options:
+        bucket = f"{bucket} [{' '.join(f'{k}={v}' for k, v in sorted(options.items()))}]"
+    if group:
+        bucket = f"{bucket} #{group}"
+    return bucket
+
+
+JOB_OPTIONS = ("max_instances", "coalesce", "misfire_grace_time")
+
+
+# fields job_spec reads, the rest of the document is not loaded
+SPEC_FIELDS = (
+    "cron", "deps", "code", "executor", "timeout", "stagger", "jitter", "name"
+) + JOB_OPTIONS
+
+
+def job_options(job: Job) -> Dict:
+    return {key: job[key] for key in JOB_OPTIONS if job[key] is not None}
+
+
+aio = EventLoopThread()
+executors = {
+    "asyncio": LoopThreadExecutor(aio),
+    "default": AdaptiveThreadPoolExecutor(
+        min_workers=int(os.environ.get("EXECUTOR_MIN_WORKERS", "2")),
+        max_workers=int(os.environ.get("EXECUTOR_MAX_WORKERS", "20")),
+        idle_timeout=float(os.environ.get("EXECUTOR_IDLE_TIMEOUT", "60")),
+    )
+}
+# memory | mongodb | sqlite, the code jobs go to the "persistent" jobstore unless memory
+JOBSTORE = os.environ.get("JOBSTORE", "memory")
+JOBSTORE_PATH = os.environ.get("JOBSTORE_PATH", os.path.join(".cache", "jobs.sqlite"))
+# seconds, runs missed while the worker restarted still fire within it (persistent jobstore only)
+RESTART_GRACE_TIME = int(os.environ.get("RESTART_GRACE_TIME", "3600"))
+
+scheduler = BlockingScheduler(
+    executors=executors,
+    job_defaults={"misfire_grace_time": RESTART_GRACE_TIME, "coalesce": True}
+    if JOBSTORE != "memory"
+    else {},
+)
+fanout = ThreadPoolExecutor(int(os.environ.get("FANOUT_WORKERS", "20")))
+runner = ProcessRunner()
+deps_manager = DependencyManager(
+    wheelhouse=os.environ.get("PIP_WHEELHOUSE"),
+    offline=os.environ.get("PIP_OFFLINE", "0") == "1",
+    workers=int(os.environ.get("PIP_WORKERS", "4")),
+)
+env_cache = EnvCache(
+    os.environ.get("ENV_CACHE_DIR", os.path.join(".cache", "envs")),
+    wheelhouse=os.environ.get("PIP_WHEELHOUSE"),
+    offline=os.environ.get("PIP_OFFLINE", "0") == "1",
+    grace=float(os.environ.get("ENV_GC_GRACE", "3600")),
+)
+
+history = HistoryWriter(
+    batch_size=int(os.environ.get("HISTORY_BATCH_SIZE", "500")),
+    flush_interval=float(os.environ.get("HISTORY_FLUSH_INTERVAL", "5")),
+    output_limit=int(os.environ.get("HISTORY_OUTPUT_LIMIT", "4096")),
+    retention=float(os.environ.get("HISTORY_TTL", str(7 * 86400))),
+    error_retention=float(os.environ.get("HISTORY_ERROR_TTL", str(30 * 86400))),
+)
 
 state = State()
 logger = Logger()
 
 FETCH_HOUR = os.environ.get("FETCH_CRON_HOUR", "*")
 FETCH_MINUTE = os.environ.get("FETCH_CRON_MINUTE", "*/15")
+SYNC_MODE = os.environ.get("SYNC_MODE", "poll")  # poll | stream
+LAZY_JOBS = os.environ.get("LAZY_JOBS", "0") == "1"
+# one scheduler job per cron bucket instead of one per job
+COALESCE_BUCKETS = os.environ.get("COALESCE_BUCKETS", "0") == "1"
+RUN_HISTORY = os.environ.get("RUN_HISTORY", "1") == "1"
+METRICS_PORT = os.environ.get("METRICS_PORT")  # served on 127.0.0.1
+METRICS_FILE = os.environ.get("METRICS_FILE")
+METRICS_INTERVAL = float(os.environ.get("METRICS_INTERVAL", "15"))
+# log the output of thread / coroutine jobs line by line while they run
+STREAM_OUTPUT = os.environ.get("STREAM_OUTPUT", "0") == "1"
+# documents per cursor batch of the Job queries
+QUERY_BATCH_SIZE = int(os.environ.get("QUERY_BATCH_SIZE", "1000"))
+# seconds, jobs are spread over this window after their cron instant (per bucket when coalesced),
+# capped at the shortest gap between two fire times of the cron
+STAGGER_WINDOW = int(os.environ.get("STAGGER_WINDOW", "0"))
+# run only the jobs of the partitions leased by this worker, to scale out over several workers
+SHARDING = os.environ.get("SHARDING", "0") == "1"
+# identical jobs (code, execution mode, deps, cron) run once per instant, the output is fanned out
+DEDUP_JOBS = os.environ.get("DEDUP_JOBS", "0") == "1"
+
+shard: Optional[ShardCoordinator] = None  # set by main when sharding
+snapshot: Optional[Snapshot] = None  # set by main with a persistent jobstore
+
+
+sync_lock = threading.RLock()
+# one future per background install, done once on_deps_installed has re-indexed the deps
+deps_synced: Set[Future] = set()
+
+
+def owns(job_id) -> bool:
+    return shard is None or shard.owns(str(job_id))
+
+
+def per_bucket() -> bool:
+    """
+    Whether the code jobs are scheduled as one scheduler job per bucket instead of per job.
+    """
+    return COALESCE_BUCKETS or DEDUP_JOBS
+
+
+def job_spec(job: Job) -> JobSpec:
+    bucket = cronify(job.cron)
+    digest = src_digest(job.code)
+    group = None
+    if DEDUP_JOBS:
+        group = dedup_group((digest, job.executor, job.timeout, tuple(job.deps)))
+    window = job.stagger if job.stagger is not None else STAGGER_WINDOW
+    if window:  # kept below the cron period, a run never slides past the next instant
+        window = min(window, cron_period(job.cron) or window)
+    # the members of a group share their offset, they run at the same instant
+    offset = stagger_offset(bucket if COALESCE_BUCKETS else group or str(job.id), window)
+    options = job_options(job)
+
+    return JobSpec(
+        id=str(job.id),
+        bucket=scheduled_bucket(bucket, offset, job.jitter, options, group),
+        cron=job.cron,
+        src=job.code,
+        digest=digest,
+        executor=job.executor,
+        timeout=job.timeout,
+        deps=tuple(job.deps),
+        offset=offset,
+        jitter=job.jitter,
+        options=options,
+        title=job.name or "",
+    )
+
+
+def cron_trigger(spec: JobSpec) -> StaggeredCronTrigger:
+    return StaggeredCronTrigger(offset=spec.offset, jitter=spec.jitter, **spec.cron)
+
+
+def valid_cron(logger: Logger, spec: JobSpec) -> bool:
+    try:
+        cron_trigger(spec)
+    except (ValueError, TypeError) as E:  # unknown / out of range fields
+        logger.root_logger.error(
+            "Job %s has an invalid cron %s: %s", spec.id, cronify(spec.cron), E
+        )
+        return False
+    return True
+
+
+def log_stagger_report(logger: Logger, specs: List[JobSpec]) -> None:
+    if STAGGER_WINDOW == 0 and not any(spec.offset or spec.jitter for spec in specs):
+        return
+
+    report = peak_concurrency((cronify(spec.cron), spec.cron, spec.offset) for spec in specs)
+    logger.root_logger.info(
+        "Peak jobs per second over the next hour: %s at %s unstaggered, %s at %s staggered",
+        report["before"],
+        report["before_at"],
+        report["after"],
+        report["after_at"],
+    )
+
+
+def new_code(spec: JobSpec, lazy: bool = False) -> Code:
+    return Code(
+        spec.id,
+        spec.src,
+        lazy=lazy or LAZY_JOBS or spec.executor != "thread",  # runs from source in the worker
+        executor=spec.executor,
+        timeout=spec.timeout,
+        deps=spec.deps,
+        title=spec.title,
+    )
+
+
+def job_target(code_obj: Code, logger: Logger) -> Dict:
+    """
+    add_job / modify_job arguments running the code.
+    """
+    func, executor = code_job(code_obj, logger)
+    if snapshot is None:
+        return {"func": func, "executor": executor}
+
+    # persisted by reference, the job id is looked up in the store when the job fires
+    return {
+        "func": run_async_job if executor == "asyncio" else run_job,
+        "args": [code_obj.name],
+        "executor": executor,
+        "jobstore": "persistent",
+    }
+
+
+def joins_group(state: State, spec: JobSpec) -> bool:
+    # deduplicated, the group runs through one member, the others don't need their module
+    return DEDUP_JOBS and spec.bucket in state.store
+
+
+def bucket_target(state: State, logger: Logger, bucket: str) -> Dict:
+    if snapshot is None:
+        return {"func": BucketJob(state.store, bucket, logger)}
+    return {"func": run_bucket, "args": [bucket], "jobstore": "persistent"}
+
+
+def schedule_code(state: State, logger: Logger, spec: JobSpec, code_obj: Code) -> None:
+    if not per_bucket():
+        scheduler.add_job(
+            trigger=cron_trigger(spec),
+            id=spec.id,
+            replace_existing=True,
+            **job_target(code_obj, logger),
+            **spec.options,
+        )
+    elif scheduler.get_job(bucket_job_id(spec.bucket)) is None:
+        scheduler.add_job(
+            trigger=cron_trigger(spec),
+            id=bucket_job_id(spec.bucket),
+            **bucket_target(state, logger, spec.bucket),
+            **spec.options,
+        )
+
+
+def drop_empty_bucket(state: State, bucket: str) -> None:
+    if per_bucket() and bucket not in state.store:
+        if scheduler.get_job(bucket_job_id(bucket)) is not None:
+            scheduler.remove_job(bucket_job_id(bucket))
+
+
+def apply_plan(
+    state: State, logger: Logger, plan: Plan, timer: Optional[PhaseTimer] = None
+) -> Plan:
+    timer = timer or PhaseTimer()
+
+    for job_id in plan.remove:
+        found = state.store.remove(job_id)
+        if found is not None:
+            module_cache.discard((job_id, found[1].digest))
+            drop_empty_bucket(state, found[0])
+
+    for spec in plan.add:
+        if not valid_cron(logger, spec):  # rejected alone, the rest of the pass goes on
+            plan.failed.append(spec.id)
+            continue
+
+        with timer.phase("compile"):
+            code_obj = new_code(spec, lazy=joins_group(state, spec))
+        state.store.add(spec.bucket, code_obj)
+        schedule_code(state, logger, spec, code_obj)
+
+    for spec in plan.modify:
+        bucket, old_code_obj = state.store.locate(spec.id)
+        module_cache.discard((spec.id, old_code_obj.digest))
+        with timer.phase("compile"):
+            code_obj = new_code(spec, lazy=joins_group(state, spec))
+        state.store.add(bucket, code_obj)
+
+        if not per_bucket():  # bucket jobs read the store when they fire
+            scheduler.modify_job(spec.id, **job_target(code_obj, logger))
+
+    for spec in plan.reschedule:
+        if not valid_cron(logger, spec):  # keeps its current schedule
+            plan.failed.append(spec.id)
+            continue
+
+        bucket, code_obj = state.store.locate(spec.id)
+        state.store.add(spec.bucket, code_obj)
+
+        # re-added rather than rescheduled, options back to defaults are reset too
+        if not per_bucket():
+            scheduler.remove_job(spec.id)
+        schedule_code(state, logger, spec, code_obj)
+        drop_empty_bucket(state, bucket)
+
+    if len(plan) > 0:
+        logger.root_logger.info("Reconciled jobs, %s", plan.summary())
+        if snapshot is not None:
+            snapshot.apply(plan)
+
+    return plan
+
+
+def hold_missing_deps(
+    state: State, logger: Logger, specs: List[Union[JobSpec, Job]]
+) -> List[Union[JobSpec, Job]]:
+    ready = []
+    missing = set()
+    envs = []
+
+    for spec in specs:
+        if spec.executor == "venv":  # deps go to the job's own environment
+            (ready if env_cache.is_ready(spec.deps) else envs).append(spec)
+            continue
+
+        needed = state.deps.missing(spec.deps)
+        if len(needed) > 0:
+            missing.update(needed)
+        else:
+            ready.append(spec)
+
+    logger.root_logger.info(
+        "Need to install %s deps",
+        str(len(missing)),
+    )  # install deps which are not installed already and are required by the jobs
+
+    if len(missing) > 0:
+        logger.root_logger.info(
+            "Deps : %s, holding back %s jobs until installed",
+            str(missing),
+            str(len(specs) - len(ready)),
+        )
+
+        future = deps_manager.ensure(missing)
+        if future is not None:
+            synced: Future = Future()
+            deps_synced.add(synced)
+            future.add_done_callback(partial(on_deps_installed, state, logger, synced))
+
+    for spec in envs:
+        future = env_cache.ensure(spec.deps)
+        if not future.done():  # failed environments are retried on a later pass
+            future.add_done_callback(lambda _: sync_held_jobs(state, logger))
+
+    if len(envs) > 0:
+        logger.root_logger.info(
+            "Holding back %s jobs until their environments are created", str(len(envs))
+        )
+
+    return ready
+
+
+def sync_held_jobs(state: State, logger: Logger) -> None:
+    scheduler.add_job(
+        fetch_store, args=[state, logger], id="fetch_held_jobs", replace_existing=True
+    )  # sync the held back jobs right away instead of on the next poll
+
+
+def on_deps_installed(
+    state: State, logger: Logger, synced: Future, future: Future
+) -> None:
+    """
+    Done callback of a background install, re-indexes the deps and syncs the held back jobs.
+
+    :param synced: Resolved once the deps are re-indexed, whether or not the install succeeded.
+    """
+    try:
+        installed = [requirement for requirement, ok, _ in future.result() if ok]
+
+        with sync_lock:
+            state.deps.refresh()  # update deps, transitive ones included
+            logger.pip_logger.info(
+                "After install: Deps available : %s", str(state.deps)
+            )
+
+            # pip succeeded but the index still misses them, e.g. a dist under another name:
+            # retried after the delay instead of installed again by the sync pass it triggers
+            unresolved = [requirement for requirement in installed if requirement not in state.deps]
+            for requirement in unresolved:
+                deps_manager.mark_failed(requirement)
+
+        if len(unresolved) > 0:
+            logger.pip_logger.warning(
+                "Installed but still missing: %s, retried in %ss",
+                str(unresolved),
+                deps_manager.retry_delay,
+            )
+
+        refresh_workers(state, logger, force=True)
+        if len(installed) > len(unresolved):
+            sync_held_jobs(state, logger)
+    finally:
+        deps_synced.discard(synced)
+        synced.set_result(None)
+
+
+def refresh_workers(state: State, logger: Logger, force: bool = False) -> None:
+    deps = set()
+    for _, code_obj in state.store.index.values():
+        if code_obj.executor == "process":
+            deps.update(code_obj.deps)
+
+    if runner.preload(dep_modules(deps), force=force and len(deps) > 0):
+        logger.root_logger.info(
+            "Restarted process workers, preloaded: %s", sorted(runner.preloaded)
+        )
 
 
 @scheduler.scheduled_job(
@@ -62,83 +615,303 @@ FETCH_MINUTE = os.environ.get("FETCH_CRON_MINUTE", "*/15")
     args=[state, logger],
 )
 def fetch_store(state: State, logger: Logger, fetch_all: bool = False) -> State:
-    to_be_deleted_jobs = Job.objects(to_be_deleted=True)
+    timer = PhaseTimer()
+    started_at = datetime.utcnow()
+
+    with sync_lock:
+        with timer.phase("delete"):
+            del_ids = set(
+                str(job.id) for job in Job.objects(to_be_deleted=True).only("id") if owns(job.id)
+            )
 
-    if len(to_be_deleted_jobs) > 0:
-        logger.root_logger.info(f"To be deleted {len(to_be_deleted_jobs)} jobs")
-        buckets = set()
-        del_ids = set()
+            if len(del_ids) > 0:
+                logger.root_logger.info(f"To be deleted {len(del_ids)} jobs")
 
-        for job in to_be_deleted_jobs:
-            buckets.add(cronify(job.cron))
-            del_ids.add(str(job.id))
+                Job.objects(id__in=list(del_ids)).delete()
 
-        for bucket in buckets:
-            state.store[bucket] = CodeList(
-                filter(
-                    lambda code_obj: code_obj.name not in del_ids, state.store[bucket]
+                logger.root_logger.info(
+                    "Deleted %s jobs:\n%s\n",
+                    str(len(del_ids)),
+                    str(del_ids),
                 )
+
+        with timer.phase("query"):
+            if fetch_all:  # the code of (nearly) every job is needed, one pass on the spec fields
+                jobs, fields = Job.objects(), SPEC_FIELDS
+            else:  # deps first, the code is only loaded for the jobs which can be scheduled
+                jobs, fields = Job.objects(sync=False), ("deps", "executor")
+
+            candidates = [
+                job_spec(job) if fetch_all else job
+                for job in jobs.only(*fields).no_cache().batch_size(QUERY_BATCH_SIZE)
+                if owns(job.id)
+            ]
+            num_jobs = len(candidates)
+
+        logger.root_logger.info("fetched %s jobs", str(num_jobs))
+
+        with timer.phase("pip"):
+            ready = hold_missing_deps(state, logger, candidates)
+
+        with timer.phase("query"):
+            if fetch_all:
+                specs = ready
+            else:
+                deps = {str(job.id): (tuple(job.deps), job.executor) for job in ready}
+                docs = Job.objects(id__in=list(deps)).only(*SPEC_FIELDS).no_cache()
+                # deps / executor edited since the deps pass are left for the next pass
+                specs = [
+                    spec
+                    for spec in map(job_spec, docs.batch_size(QUERY_BATCH_SIZE))
+                    if deps.get(spec.id) == (spec.deps, spec.executor)
+                ]
+
+        if fetch_all:
+            log_stagger_report(logger, specs)
+
+        with timer.phase("schedule"):
+            plan = diff(specs, state.store.index, del_ids, full=fetch_all)
+            apply_plan(state, logger, plan, timer)
+
+            if len(plan) > 0:
+                refresh_workers(state, logger)
+
+        logger.root_logger.info("scheduled %s jobs", str(len(specs)))
+        if DEDUP_JOBS and len(plan) > 0:
+            logger.root_logger.info(
+                "Deduplicated %s jobs into %s groups", len(state.store.index), len(state.store)
             )
 
-        for job in to_be_deleted_jobs:
-            job.delete()
+        if num_jobs > 0:
+            logger.pip_logger.info("After fetch_store: Store: %s", str(state.store))
+
+        # set the processed jobs as in sync with in-memory store, held back / rejected ones stay
+        # out of sync, as well as the ones edited during the pass
+        with timer.phase("query"):
+            unchanged = Q(updated_at=None) | Q(updated_at__lte=started_at)
+            failed = set(plan.failed)
+            synced = [spec.id for spec in specs if spec.id not in failed]
+            if len(synced) == num_jobs and shard is None:
+                Job.objects(sync=False).filter(unchanged).update(set__sync=True)
+            else:
+                Job.objects(id__in=synced, sync=False).filter(unchanged).update(set__sync=True)
+
+    timer.observe(FETCH_PHASE)
+    return state
+
 
-        logger.root_logger.info(
-            "Deleted %s jobs:\n%s\n",
-            str(len(del_ids)),
-            str(del_ids),
+def collect_envs(state: State, logger: Logger) -> None:
+    with sync_lock:
+        active = set(
+            env_cache.key(code_obj.deps)
+            for _, code_obj in state.store.index.values()
+            if code_obj.executor == "venv"
         )
 
-    needed_deps = set()
-    if fetch_all:
-        jobs = Job.objects()
-    else:
-        jobs = Job.objects(sync=False)
+    removed = env_cache.collect(active)
+    logger.pip_logger.info(
+        "Collected %s unused environments, %s in use", len(removed), len(active)
+    )
 
-    num_jobs = 0
 
-    for job in jobs:
-        needed_deps.update(job.deps)
-        num_jobs += 1
+def evict_modules(logger: Logger) -> None:
+    evicted = module_cache.evict_idle()
+    logger.root_logger.info(
+        "Evicted %s idle job modules, module cache: %s", evicted, module_cache.stats()
+    )
 
-    logger.root_logger.info("fetched %s jobs", str(num_jobs))
-    needed_deps = needed_deps - state.deps
 
-    logger.root_logger.info(
-        "Need to install %s deps",
-        str(len(needed_deps)),
-    )  # install deps which are not installed already and are required by the jobs
+def apply_upsert(state: State, logger: Logger, job_id: str, doc: Dict) -> None:
+    if not owns(job_id):
+        return
 
-    if len(needed_deps) > 0:
-        logger.root_logger.info(
-            "Deps : %s",
-            str(needed_deps),
-        )
+    job = Job._from_son(doc)
+
+    with sync_lock:
+        ready = hold_missing_deps(state, logger, [job_spec(job)])
+        if len(ready) == 0:
+            return  # synced once its deps are installed
+
+        plan = apply_plan(state, logger, diff(ready, state.store.index))
+        refresh_workers(state, logger)
+        if len(plan.failed) == 0:
+            Job.objects(id=job.id).update(set__sync=True)
+
+    logger.root_logger.info("Synced job %s from change stream", job_id)
+
+
+def apply_delete(state: State, logger: Logger, job_id: str, doc: Optional[Dict]) -> None:
+    if not owns(job_id):
+        return
 
-        pip_install_log = install_deps(needed_deps)
-        logger.pip_logger.info("Pip install log:\n%s", pip_install_log)
-        time.sleep(2)
+    with sync_lock:
+        apply_plan(state, logger, diff([], state.store.index, [job_id]))
 
-        state.deps = get_deps()  # update deps
-        logger.pip_logger.info(
-            "After fetch_store: Deps available : %s", str(state.deps)
+    if doc is not None:  # flagged with to_be_deleted, remove the document as well
+        Job.objects(id=doc["_id"]).delete()
+
+    logger.root_logger.info("Deleted job %s from change stream", job_id)
+
+
+def acquire_partitions(state: State, logger: Logger, partitions: Set[int]) -> None:
+    if scheduler.running:  # otherwise the first fetch_store picks them up
+        scheduler.add_job(
+            fetch_store,
+            args=[state, logger],
+            kwargs={"fetch_all": True},
+            id="fetch_partitions",
+            replace_existing=True,
+        )  # their jobs may be in sync already, marked by the previous owner
+
+
+def release_partitions(state: State, logger: Logger, partitions: Set[int]) -> None:
+    with sync_lock:
+        released = [
+            job_id
+            for job_id in state.store.index
+            if partition_of(job_id, shard.partitions) in partitions
+        ]
+        apply_plan(state, logger, diff([], state.store.index, released))
+
+
+def start_shard(state: State, logger: Logger) -> ShardCoordinator:
+    global shard
+
+    shard = ShardCoordinator(
+        partitions=int(os.environ.get("SHARD_PARTITIONS", "256")),
+        lease_ttl=float(os.environ.get("SHARD_LEASE_TTL", "30")),
+        heartbeat_interval=float(os.environ.get("SHARD_HEARTBEAT_INTERVAL", "10")),
+        on_acquire=partial(acquire_partitions, state, logger),
+        on_release=partial(release_partitions, state, logger),
+        logger=logger.root_logger,
+    )
+    shard.heartbeat()  # registered with its first partitions before the first fetch
+    logger.root_logger.info(
+        "Sharding as %s, owns %s of %s partitions",
+        shard.worker_id,
+        len(shard.owned),
+        shard.partitions,
+    )
+    return shard
+
+
+def open_jobstore(logger: Logger) -> Tuple[BaseJobStore, Snapshot]:
+    """
+    Persistent jobstore of the code jobs and the snapshot of the store, kept side by side.
+    """
+    global snapshot
+
+    if JOBSTORE == "mongodb":
+        db = Job._get_db()
+        jobstore = MongoDBJobStore(
+            database=db.name, collection="apscheduler_jobs", client=db.client
         )
+        snapshot = MongoSnapshot()
+    elif JOBSTORE == "sqlite":
+        from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore  # needs SQLAlchemy
+
+        snapshot = SQLiteSnapshot(JOBSTORE_PATH)
+        jobstore = SQLAlchemyJobStore(url=f"sqlite:///{JOBSTORE_PATH}")
+    else:
+        raise ValueError(f"Unknown jobstore {JOBSTORE}, expected memory | mongodb | sqlite")
 
-    for job in jobs:
-        code_obj = Code(str(job.id), job.code)
-        state.store[cronify(job.cron)].append(code_obj)
-        scheduler.add_job(CodeJob(code_obj, logger), "cron", **job.cron, id=str(job.id))
+    scheduler.add_jobstore(jobstore, "persistent")
+    logger.root_logger.info("Persisting the schedule in the %s jobstore", JOBSTORE)
+    return jobstore, snapshot
 
-    logger.root_logger.info("scheduled %s jobs", str(num_jobs))
 
-    if num_jobs > 0:
-        logger.pip_logger.info("After fetch_store: Store: %s", str(state.store))
+def restore_store(state: State, logger: Logger) -> List[JobSpec]:
+    """
+    Rebuild the store from the snapshot, the persisted jobs run from it once the scheduler starts.
+    The jobs whose deps or environment are missing, e.g. on a fresh machine, are held back like
+    in fetch_store and left out of sync, so they are scheduled once installed.
+    :return: Specs of the restored jobs.
+    :rtype: list
+    """
+    specs = snapshot.load()
 
-    jobs.update(
-        set__sync=True,
-    )  # set the processed jobs as in sync with in-memory store
+    with sync_lock:
+        ready = hold_missing_deps(state, logger, specs)
+        for spec in ready:
+            state.store.add(spec.bucket, new_code(spec, lazy=True))
 
-    return state
+        held = set(spec.id for spec in specs) - set(spec.id for spec in ready)
+        if len(held) > 0:
+            Job.objects(id__in=list(held)).update(set__sync=False)
+
+    logger.root_logger.info(
+        "Restored %s jobs from the snapshot, held back %s", len(ready), len(held)
+    )
+    return ready
+
+
+def resume(state: State, logger: Logger, specs: List[JobSpec]) -> None:
+    """
+    Warm restart, once the scheduler runs the persisted jobs: align the jobstore with the
+    restored store, the held back jobs are dropped until installed, then reconcile the jobs
+    changed since the last sync only.
+    """
+    with sync_lock:
+        # the store as of now, held back jobs may have been installed and scheduled since
+        specs = [spec for spec in specs if spec.id in state.store.index]
+        if per_bucket():
+            scheduled = set(bucket_job_id(bucket) for bucket, _ in state.store.index.values())
+            expected = {bucket_job_id(spec.bucket): spec for spec in specs}
+        else:
+            scheduled = set(state.store.index)
+            expected = {spec.id: spec for spec in specs}
+        persisted = set(job.id for job in scheduler.get_jobs(jobstore="persistent"))
+
+        # written without the snapshot before a crash, or held back on restore
+        for job_id in persisted - scheduled:
+            scheduler.remove_job(job_id, jobstore="persistent")
+        for job_id in set(expected) - persisted:
+            spec = expected[job_id]
+            schedule_code(state, logger, spec, state.store.locate(spec.id)[1])
+
+        logger.root_logger.info(
+            "Resumed %s persisted jobs, dropped %s, re-added %s",
+            len(persisted & scheduled),
+            len(persisted - scheduled),
+            len(set(expected) - persisted),
+        )
+
+    fetch_store(state, logger)
+    refresh_workers(state, logger)
+
+
+def export_metrics(state: State, logger: Logger) -> None:
+    pool = executors["default"].pool
+
+    registry.gauge(
+        "executor_queue_depth", "Runs waiting for a worker.", fn=lambda: pool.stats()["queued"]
+    )
+    registry.gauge("executor_workers", "Workers of the executor.", fn=lambda: pool.workers)
+    registry.gauge("store_jobs", "Jobs in the store.", fn=lambda: len(state.store.index))
+    registry.gauge("store_buckets", "Cron buckets in the store.", fn=lambda: len(state.store))
+    registry.gauge("history_pending", "Job runs buffered for the history.", fn=history.pending)
+    registry.gauge(
+        "module_cache",
+        "Module cache statistics.",
+        ["stat"],
+        fn=lambda: {(key,): value for key, value in module_cache.stats().items()},
+    )
+    if shard is not None:
+        registry.gauge(
+            "shard_partitions", "Partitions leased by the worker.", fn=lambda: len(shard.owned)
+        )
+        registry.gauge(
+            "shard_workers", "Live workers seen by the worker.", fn=lambda: len(shard.workers)
+        )
+    instrument_scheduler(scheduler)
+
+    if METRICS_PORT:
+        server = serve(int(METRICS_PORT))
+        logger.root_logger.info("Serving metrics at http://%s:%s/metrics", *server.server_address)
+
+    if METRICS_FILE:
+        FileExporter(METRICS_FILE, METRICS_INTERVAL).start()
+        logger.root_logger.info("Writing metrics to %s", METRICS_FILE)
 
 
 def main():
@@ -152,14 +925,55 @@ def main():
     logger.root_logger.info("Connected to DB")
 
     state = State()
-    state.store = Store()
+    state.store = Store(scheduler=scheduler)
     logger.root_logger.info("Created in-memory store")
     logger.root_logger.info("Current store:\n%s\n", state.store)
 
-    state.deps = get_deps()
+    state.deps = PackageIndex()
     logger.pip_logger.info("Indexed deps: %s", state.deps)
 
-    fetch_store(state, logger, fetch_all=True)
+    if SHARDING:
+        start_shard(state, logger)
+
+    if JOBSTORE != "memory" and shard is None:  # the partitions of a worker change across restarts
+        open_jobstore(logger)
+        specs = restore_store(state, logger)
+        if len(specs) == 0:  # first boot with this jobstore
+            fetch_store(state, logger, fetch_all=True)
+            specs = snapshot.load()
+        scheduler.add_job(resume, args=[state, logger, specs], id="resume")  # right after start
+    else:
+        if JOBSTORE != "memory":
+            logger.root_logger.warning("Sharding, the schedule is kept in memory only")
+        fetch_store(state, logger, fetch_all=True)
+
+    atexit.register(history.close)  # write out the buffered runs
+
+    export_metrics(state, logger)
+
+    scheduler.add_job(
+        collect_envs,
+        "interval",
+        seconds=float(os.environ.get("ENV_GC_INTERVAL", "3600")),
+        args=[state, logger],
+    )
+
+    if module_cache.ttl is not None:
+        scheduler.add_job(
+            evict_modules, "interval", seconds=module_cache.ttl, args=[logger]
+        )
+
+    if SYNC_MODE == "stream":
+        ChangeStreamSync(
+            on_upsert=partial(apply_upsert, state, logger),
+            on_delete=partial(apply_delete, state, logger),
+            logger=logger.root_logger,
+        ).start()  # polling stays scheduled as the fallback
+
+    if shard is not None:
+        shard.start()
+        atexit.register(shard.stop)  # hands the partitions over right away
+
     scheduler.start()
     time.sleep(5)
 
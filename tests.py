@@ -1,14 +1,50 @@
 import datetime
+import gzip
+import io
+import json
 import logging
+import marshal
+import os
+import queue
+import sys
+import threading
+import time
+import urllib.request
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import pytest
+from apscheduler.jobstores.mongodb import MongoDBJobStore
+from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.triggers.cron import CronTrigger
 
 from mongoengine import *
 
-from add_jobs import add_jobs
-from libs.code import Code
-from libs.db import Job
-from libs.store import Store
-from main import CodeJob, Logger, State, cronify, fetch_store
-from utils import get_deps, get_URI, setup_logging
+from add_jobs import add_jobs, ingest
+from libs.aio import EventLoopThread
+from libs.cache import CompileCache, ModuleCache
+from libs.code import Code, compile_src
+from libs.deps import DependencyManager, PackageIndex
+from libs.envs import EnvCache
+from libs.executor import AdaptivePool
+from libs.history import HistoryWriter, last_runs
+from libs.logs import RotatingGzipFileHandler, enqueue_loggers, stop_listener
+from libs.metrics import (CODE_INIT, JOB_EVENTS, SCHEDULER_LAG, PhaseTimer,
+                          Registry, instrument_scheduler, serve)
+from libs.db import Job, JobRun, Worker
+from libs.reconcile import JobSpec, Plan, diff
+from libs.runner import ProcessRunner
+from libs.stagger import StaggeredCronTrigger, cron_period, peak_concurrency, stagger_offset
+from libs.store import CodeList, Store
+from libs.sync import ChangeStreamSync
+from libs.shard import HashRing, ShardCoordinator, partition_of
+from libs.snapshot import MongoSnapshot, SQLiteSnapshot, spec_to_dict
+from main import (AsyncCodeJob, CodeJob, Logger, State, apply_delete, apply_upsert,
+                  bucket_job_id, code_job, cronify, deps_synced, fetch_store,
+                  release_partitions, restore_store, resume, run_job, scheduler,
+                  scheduled_bucket)
+from utils import get_URI, setup_logging
 
 jobs = [
     {
@@ -36,6 +72,14 @@ jobs = [
 jobs_out = [out["deps"][0] + "\n" for out in jobs]
 
 
+def fetch_store_and_install(state, logger):
+    # jobs with missing deps are held back until the background installs finish
+    fetch_store(state, logger)
+    for synced in list(deps_synced):  # set after the deps are re-indexed
+        synced.result()
+    fetch_store(state, logger)
+
+
 class TestApp:
     @classmethod
     def setup_class(cls):
@@ -54,7 +98,7 @@ class TestApp:
         logger.root_logger.info("Created in-memory store")
         logger.root_logger.info(state.store)
 
-        state.deps = get_deps()
+        state.deps = PackageIndex()
         logger.pip_logger.info("Indexed deps: %s", state.deps)
 
     def test_cronify(self):
@@ -111,7 +155,7 @@ class TestApp:
             f"Before fetch_store: code present in #{cronify(cron)} bucket = {any([code == code_obj.src for code_obj in state.store[cronify(cron)]])}"
         )
 
-        fetch_store(state, logger)
+        fetch_store_and_install(state, logger)
 
         logger.pip_logger.info("After fetch_store: Deps installed: %s", str(state.deps))
 
@@ -139,7 +183,7 @@ class TestApp:
 
         Job.objects.insert(rows)
 
-        fetch_store(state, logger)
+        fetch_store_and_install(state, logger)
 
         cron_bucket = set([cronify(job["cron"]) for job in jobs])
         out = {}
@@ -198,3 +242,1213 @@ class TestCodeObj:
         code = Code(name, src)
         out = code.run_with_std_patch()
         logger.code_logger.info(f"\nSource:\n{src}\nOutput:\n{out}")
+
+    def test_concurrent_output(self):
+        logger = Logger()
+        src = "import time\nfor i in range(50):\n\tprint('{name}', i)\n\ttime.sleep(0.001)"
+        codes = [Code(f"test_concurrent_{n}", src.format(name=n)) for n in range(60)]
+
+        # run more jobs than workers on a full pool, output must not leak between jobs
+        with ThreadPoolExecutor(20) as executor:
+            outs = list(executor.map(lambda code: code.run_with_std_patch(), codes))
+
+        for n, out in enumerate(outs):
+            assert out == "".join(f"{n} {i}\n" for i in range(50))
+
+        logger.code_logger.info(f"\nConcurrent jobs: {len(codes)}, all outputs isolated")
+
+    def test_bounded_output(self, monkeypatch):
+        monkeypatch.setattr("libs.code.CAPTURE_LIMIT", 1000)
+        code = Code("test_bounded", "for i in range(10000):\n\tprint(i)\nprint('end', end='')")
+
+        # only the tail is kept, with a marker of what was dropped
+        out = code.run_with_std_patch()
+        assert out.startswith("[... ") and out.endswith("9998\n9999\nend")
+        assert len(out.split("\n", 1)[1]) == 1000
+
+        # every line is handed over as it is written, the unterminated one at the end
+        lines = []
+        code.run_with_std_patch(lines.append)
+        assert lines == [str(i) for i in range(10000)] + ["end"]
+
+    def test_lazy_code_materialization(self, monkeypatch):
+        cache = ModuleCache(max_size=2, ttl=0)
+        monkeypatch.setattr("libs.code.module_cache", cache)
+
+        codes = [Code(f"test_lazy_{n}", f"print({n})", lazy=True) for n in range(3)]
+        assert all(code.lib is None for code in codes)
+
+        assert [code.run_with_std_patch() for code in codes] == ["0\n", "1\n", "2\n"]
+        assert codes[2].run_with_std_patch() == "2\n"
+        assert cache.stats() == {"size": 2, "hits": 1, "misses": 3, "evictions": 1}
+
+        assert cache.evict_idle() == 2
+        assert codes[0].run_with_std_patch() == "0\n"
+        assert cache.misses == 4
+
+    def test_process_executor(self):
+        logger = Logger()
+        code = Code("test_process", "print('hello')", lazy=True, executor="process")
+        assert CodeJob(code, logger)() == {"test_process": "hello\n"}
+
+        # runaway jobs are killed after the timeout
+        start = datetime.datetime.now()
+        out = ProcessRunner().run("test_timeout", "import time\ntime.sleep(60)", timeout=1)
+        logger.code_logger.info(f"\nTimed out job output:\n{out}")
+        assert out.startswith("TimeoutError")
+        assert (datetime.datetime.now() - start).total_seconds() < 30
+
+    def test_forkserver_preload(self):
+        runner = ProcessRunner("forkserver")
+        src = "import sys\nprint('xml.dom.minidom' in sys.modules)"
+
+        assert runner.preload(["xml.dom.minidom"])
+        assert not runner.preload(["xml.dom.minidom"])
+        assert runner.run("test_preload", src, timeout=30) == "True\n"
+
+        # refreshed workers drop what is not needed anymore
+        assert runner.preload([])
+        assert runner.run("test_preload", src, timeout=30) == "False\n"
+
+    def test_workers_skip_main(self, monkeypatch):
+        import main as app
+
+        runner = ProcessRunner("forkserver")
+        src = "import sys\nprint(hasattr(sys.modules['__main__'], 'scheduler'))"
+
+        # python -m main / python main.py, the workers never re-run the app
+        for main_module in (app, type(sys)("__main__")):
+            if main_module is not app:
+                main_module.__file__ = app.__file__
+            monkeypatch.setitem(sys.modules, "__main__", main_module)
+            assert runner.preload([], force=True)
+            assert runner.run("test_skip_main", src, timeout=30) == "False\n"
+
+    def test_coroutine_jobs(self):
+        logger = Logger()
+        src = "import asyncio\nfor i in range(3):\n\tprint('{name}', i)\n\tawait asyncio.sleep(0.1)"
+        codes = [Code(f"test_async_{n}", src.format(name=n), lazy=n % 2 == 0) for n in range(500)]
+        assert all(code.coroutine for code in codes) and not Code("test_sync", "pass").coroutine
+
+        job, executor = code_job(codes[0], logger)
+        assert isinstance(job, AsyncCodeJob) and executor == "asyncio"
+
+        # every job waits 0.3s, all of them share one loop thread, output stays per task
+        loop_thread = EventLoopThread("test_asyncio")
+        start = datetime.datetime.now()
+        futures = [loop_thread.submit(code_job(code, logger)[0]()) for code in codes]
+        outs = [future.result(timeout=30) for future in futures]
+        assert (datetime.datetime.now() - start).total_seconds() < 10
+
+        for n, out in enumerate(outs):
+            assert out == {f"test_async_{n}": "".join(f"{n} {i}\n" for i in range(3))}
+
+        timed_out = Code("test_async_timeout", "import asyncio\nawait asyncio.sleep(60)", timeout=0.1)
+        assert loop_thread.submit(timed_out.run_async_with_std_patch()).result(timeout=30).startswith("TimeoutError")
+
+        # an async entry point run with asyncio.run is awaited on the shared loop
+        src = "import asyncio\nasync def main():\n\tawait asyncio.sleep(0.1)\n\tprint('{name}')\nasyncio.run(main())"
+        entries = [Code(f"test_async_entry_{n}", src.format(name=n), lazy=n == 0) for n in range(2)]
+        assert all(entry.coroutine for entry in entries)
+        assert loop_thread.submit(entries[0].run_async_with_std_patch()).result(timeout=30) == "0\n"
+        assert not Code("test_sync_entry", "import asyncio\nprint(asyncio.run)").coroutine
+        loop_thread.stop()
+
+        # outside of the loop, e.g. in a worker process, the coroutine runs to completion
+        assert codes[1].run_with_std_patch() == "1 0\n1 1\n1 2\n"
+
+
+class TestChangeStream:
+    @classmethod
+    def setup_class(cls):
+        """setup any state specific to the execution of the given class."""
+        setup_logging()
+        logger = Logger()
+        logger.root_logger = logging.getLogger("root")
+        logger.pip_logger = logging.getLogger("pip")
+        logger.code_logger = logging.getLogger("code")
+
+        disconnect()
+        connect(db="scheduler", host="mongomock://localhost")
+
+        state = State()
+        state.store = Store(scheduler=scheduler)
+        state.deps = PackageIndex()
+
+    @classmethod
+    def teardown_class(cls):
+        disconnect()
+
+    def test_apply_change_events(self):
+        state = State()
+        logger = Logger()
+        dep = f"pytest=={pytest.__version__}"
+
+        job = Job(cron={"hour": "14"}, deps=[dep], code="print('v1')").save()
+        doc = job.to_mongo().to_dict()
+        key = {"_id": job.id}
+
+        events = [
+            {"_id": 1, "operationType": "insert", "documentKey": key, "fullDocument": doc},
+            {
+                "_id": 2,
+                "operationType": "update",
+                "documentKey": key,
+                "updateDescription": {"updatedFields": {"sync": True}},
+                "fullDocument": dict(doc, sync=True),
+            },
+            {
+                "_id": 3,
+                "operationType": "update",
+                "documentKey": key,
+                "updateDescription": {"updatedFields": {"code": "print('v2')"}},
+                "fullDocument": dict(doc, code="print('v2')", cron={"hour": "15"}),
+            },
+        ]
+
+        sync = ChangeStreamSync(
+            on_upsert=partial(apply_upsert, state, logger),
+            on_delete=partial(apply_delete, state, logger),
+            logger=logger.root_logger,
+            source=lambda resume_after: iter(events),
+        )
+        sync.consume()
+
+        # the sync ack is skipped, the edit replaces the first version
+        assert sync.applied == 2
+        assert sync.resume_token == 3
+        assert len(state.store[cronify({"hour": "14"})]) == 0
+        assert [code_obj.src for code_obj in state.store[cronify({"hour": "15"})]] == [
+            "print('v2')"
+        ]
+        assert scheduler.get_job(str(job.id)) is not None
+        assert Job.objects.get(id=job.id).sync
+
+        events = [
+            {
+                "_id": 4,
+                "operationType": "update",
+                "documentKey": key,
+                "updateDescription": {"updatedFields": {"to_be_deleted": True}},
+                "fullDocument": dict(doc, to_be_deleted=True),
+            },
+        ]
+        sync.consume()
+
+        assert len(state.store[cronify({"hour": "15"})]) == 0
+        assert scheduler.get_job(str(job.id)) is None
+        assert Job.objects(id=job.id).count() == 0
+
+
+class TestReconcile:
+    @classmethod
+    def setup_class(cls):
+        """setup any state specific to the execution of the given class."""
+        setup_logging()
+        logger = Logger()
+        logger.root_logger = logging.getLogger("root")
+        logger.pip_logger = logging.getLogger("pip")
+        logger.code_logger = logging.getLogger("code")
+
+        disconnect()
+        connect(db="scheduler", host="mongomock://localhost")
+
+        state = State()
+        state.store = Store(scheduler=scheduler)
+        state.deps = PackageIndex()
+
+    @classmethod
+    def teardown_class(cls):
+        disconnect()
+
+    def test_diff(self):
+        def spec(job_id, bucket, digest):
+            return JobSpec(id=job_id, bucket=bucket, cron={}, src="", digest=digest)
+
+        code_obj = Code("test_diff", "pass")
+        live = {"a": ("b1", code_obj), "b": ("b1", code_obj), "c": ("b1", code_obj), "d": ("b2", code_obj)}
+        d1 = code_obj.digest
+        desired = [spec("a", "b1", d1), spec("b", "b1", "d2"), spec("c", "b2", d1), spec("e", "b1", d1)]
+
+        plan = diff(desired, live, removed=["d", "x"])
+        assert [s.id for s in plan.add] == ["e"]
+        assert [s.id for s in plan.modify] == ["b"]
+        assert [s.id for s in plan.reschedule] == ["c"]
+        assert plan.remove == ["d"]
+
+        # unchanged jobs cost nothing, a full diff drops what is no longer desired
+        assert len(diff(desired[:1], live)) == 0
+        assert sorted(diff(desired[:1], live, full=True).remove) == ["b", "c", "d"]
+
+    def test_edited_job_is_replaced(self):
+        state = State()
+        logger = Logger()
+        dep = f"pytest=={pytest.__version__}"
+
+        job = Job(cron={"hour": "16"}, deps=[dep], code="print('v1')", name="v1").save()
+        fetch_store(state, logger)
+        func = scheduler.get_job(str(job.id)).func
+        assert state.store.locate(str(job.id))[1].title == "v1"
+
+        # renamed only, the runs are recorded under the new name
+        job.update(set__name="renamed", set__sync=False)
+        fetch_store(state, logger)
+        assert state.store.locate(str(job.id))[1].title == "renamed"
+        func = scheduler.get_job(str(job.id)).func
+
+        job.update(set__code="print('v2')", set__cron={"hour": "17"}, set__sync=False)
+        fetch_store(state, logger)
+
+        assert cronify({"hour": "16"}) not in state.store
+        assert [code_obj.src for code_obj in state.store[cronify({"hour": "17"})]] == [
+            "print('v2')"
+        ]
+        scheduled = scheduler.get_job(str(job.id))
+        assert scheduled.func is not func
+        assert scheduled.func() == {str(job.id): "v2\n"}
+        assert str(scheduled.trigger) == str(CronTrigger(hour="17"))
+
+        job.update(set__to_be_deleted=True)
+        fetch_store(state, logger)
+        assert state.store.locate(str(job.id)) is None
+        assert scheduler.get_job(str(job.id)) is None
+
+    def test_coalesced_bucket_jobs(self, monkeypatch):
+        monkeypatch.setattr("main.COALESCE_BUCKETS", True)
+        state = State()
+        logger = Logger()
+        dep = f"pytest=={pytest.__version__}"
+
+        rows = [
+            Job(cron={"hour": "18"}, deps=[dep], code=f"print({n})").save() for n in range(3)
+        ] + [Job(cron={"hour": "19"}, deps=[dep], code="print(3)").save()]
+        fetch_store(state, logger)
+
+        # one scheduler job per bucket, no per-job ids in the scheduler
+        bucket_job = scheduler.get_job(bucket_job_id(cronify({"hour": "18"})))
+        assert scheduler.get_job(bucket_job_id(cronify({"hour": "19"}))) is not None
+        assert all(scheduler.get_job(str(job.id)) is None for job in rows)
+        assert bucket_job.func() == {str(job.id): f"{n}\n" for n, job in enumerate(rows[:3])}
+
+        # members are still addressable by id for removal
+        rows[0].update(set__to_be_deleted=True)
+        rows[3].update(set__cron={"hour": "18"}, set__sync=False)
+        fetch_store(state, logger)
+
+        assert scheduler.get_job(bucket_job_id(cronify({"hour": "19"}))) is None
+        assert set(bucket_job.func()) == {str(job.id) for job in rows[1:]}
+
+        for job in rows[1:]:
+            job.update(set__to_be_deleted=True)
+        fetch_store(state, logger)
+        assert scheduler.get_job(bucket_job_id(cronify({"hour": "18"}))) is None
+
+    def test_staggered_jobs(self):
+        state = State()
+        logger = Logger()
+        dep = f"pytest=={pytest.__version__}"
+        tz = datetime.timezone.utc
+
+        # runs stay in their interval, offset after the instant
+        trigger = StaggeredCronTrigger(offset=30, minute="0", timezone=tz)
+        now = datetime.datetime(2022, 7, 1, 12, 0, 10, tzinfo=tz)
+        fire_time = trigger.get_next_fire_time(None, now)
+        assert fire_time == datetime.datetime(2022, 7, 1, 12, 0, 30, tzinfo=tz)
+        assert trigger.get_next_fire_time(fire_time, fire_time) == fire_time + datetime.timedelta(hours=1)
+
+        crowded = [(cronify({"minute": "0"}), {"minute": "0"}, stagger_offset(f"job_{n}", 60)) for n in range(600)]
+        report = peak_concurrency(crowded, start=now)
+        assert report["before"] == 600 and report["after"] < 30
+
+        job = Job(cron={"hour": "20"}, deps=[dep], code="print(1)", stagger=60).save()
+        fetch_store(state, logger)
+        offset = stagger_offset(str(job.id), 60)
+        assert state.store.locate(str(job.id))[0] == scheduled_bucket(cronify({"hour": "20"}), offset)
+        assert scheduler.get_job(str(job.id)).trigger.offset == datetime.timedelta(seconds=offset)
+
+        job.update(set__stagger=None, set__sync=False)
+        fetch_store(state, logger)
+        assert state.store.locate(str(job.id))[0] == cronify({"hour": "20"})
+        assert str(scheduler.get_job(str(job.id)).trigger) == str(CronTrigger(hour="20"))
+
+        job.update(set__to_be_deleted=True)
+        fetch_store(state, logger)
+
+        # the window is capped below the cron period, a run never slides past the next instant
+        assert cron_period({"second": "0/5"}) == 5 and cron_period({"minute": "*/7"}) == 240
+        assert cron_period({"hour": "25"}) is None
+        job = Job(cron={"second": "0/5"}, deps=[dep], code="print(1)", stagger=300).save()
+        fetch_store(state, logger)
+        offset = scheduler.get_job(str(job.id)).trigger.offset
+        assert offset == datetime.timedelta(seconds=stagger_offset(str(job.id), 5))
+        assert offset < datetime.timedelta(seconds=5)
+
+        job.update(set__to_be_deleted=True)
+        fetch_store(state, logger)
+
+        # an invalid cron is left out of the report, the full pass schedules the rest
+        invalid = Job(cron={"hour": "25"}, deps=[dep], code="print(1)", jitter=5).save()
+        job = Job(cron={"hour": "20"}, deps=[dep], code="print(2)", stagger=60).save()
+        fetch_store(state, logger, fetch_all=True)
+        assert scheduler.get_job(str(job.id)) is not None
+        assert scheduler.get_job(str(invalid.id)) is None and not invalid.reload().sync
+        assert peak_concurrency([("b", {"hour": "25"}, 0)], start=now)["jobs"] == 0
+
+        Job.objects(id__in=[job.id, invalid.id]).update(set__to_be_deleted=True)
+        fetch_store(state, logger)
+
+    def test_sync_pass_queries(self):
+        state = State()
+        logger = Logger()
+        dep = f"pytest=={pytest.__version__}"
+
+        indexes = Job._get_collection().index_information()
+        assert indexes["sync_1"]["partialFilterExpression"] == {"sync": False}
+        assert indexes["to_be_deleted_1"]["partialFilterExpression"] == {"to_be_deleted": True}
+        assert "updated_at_1" in indexes
+
+        job = Job(cron={"hour": "22"}, deps=[dep], code="print(1)").save()
+        edited = Job(cron={"hour": "22"}, deps=[dep], code="print(2)").save()
+        assert job.updated_at is not None
+
+        # written while the pass runs, scheduled but left out of sync for the next pass
+        edited.update(set__updated_at=datetime.datetime.utcnow() + datetime.timedelta(minutes=1))
+        fetch_store(state, logger)
+        assert job.reload().sync and not edited.reload().sync
+        assert state.store.locate(str(edited.id)) is not None
+
+        Job.objects(id__in=[job.id, edited.id]).update(set__to_be_deleted=True)
+        fetch_store(state, logger)
+        assert Job.objects(id__in=[job.id, edited.id]).count() == 0
+        assert state.store.locate(str(job.id)) is None
+
+    def test_job_options(self):
+        state = State()
+        logger = Logger()
+        dep = f"pytest=={pytest.__version__}"
+
+        job = Job(cron={"hour": "21"}, deps=[dep], code="print(1)", max_instances=3, coalesce=False).save()
+        fetch_store(state, logger)
+        scheduled = scheduler.get_job(str(job.id))
+        assert (scheduled.max_instances, scheduled.coalesce) == (3, False)
+
+        # dropped options are left to the scheduler's defaults, filled in when it starts
+        job.update(unset__max_instances=True, set__misfire_grace_time=30, set__sync=False)
+        fetch_store(state, logger)
+        scheduled = scheduler.get_job(str(job.id))
+        assert getattr(scheduled, "max_instances", None) is None
+        assert (scheduled.coalesce, scheduled.misfire_grace_time) == (False, 30)
+
+        job.update(set__to_be_deleted=True)
+        fetch_store(state, logger)
+
+    def test_deduplicated_jobs(self, monkeypatch):
+        monkeypatch.setattr("main.DEDUP_JOBS", True)
+        state = State()
+        logger = Logger()
+        dep = f"pytest=={pytest.__version__}"
+        src = "import time\nprint(time.perf_counter_ns())"
+
+        rows = [Job(cron={"hour": "9"}, deps=[dep], code=src).save() for _ in range(3)]
+        other = Job(cron={"hour": "9"}, deps=[dep], code="print('other')").save()
+        fetch_store(state, logger)
+
+        # one scheduler job per group, run once for all of its members
+        bucket = state.store.locate(str(rows[0].id))[0]
+        assert {state.store.locate(str(job.id))[0] for job in rows} == {bucket}
+        assert state.store.locate(str(other.id))[0] != bucket
+        assert all(scheduler.get_job(str(job.id)) is None for job in rows + [other])
+        results = scheduler.get_job(bucket_job_id(bucket)).func()
+        assert set(results) == {str(job.id) for job in rows} and len(set(results.values())) == 1
+        assert sum(code_obj.lib is not None for code_obj in state.store[bucket]) == 1
+
+        # a diverging member splits back into its own job
+        rows[0].update(set__code="print('diverged')", set__sync=False)
+        fetch_store(state, logger)
+        assert set(scheduler.get_job(bucket_job_id(bucket)).func()) == {str(job.id) for job in rows[1:]}
+        diverged = state.store.locate(str(rows[0].id))[0]
+        assert scheduler.get_job(bucket_job_id(diverged)).func() == {str(rows[0].id): "diverged\n"}
+
+        Job.objects(id__in=[job.id for job in rows + [other]]).update(set__to_be_deleted=True)
+        fetch_store(state, logger)
+        assert scheduler.get_job(bucket_job_id(bucket)) is None
+        assert scheduler.get_job(bucket_job_id(diverged)) is None
+
+    def test_installed_but_missing_deps(self, monkeypatch):
+        # pip succeeds without installing anything
+        manager = DependencyManager(pip=[sys.executable, "-c", "pass"])
+        monkeypatch.setattr("main.deps_manager", manager)
+        state = State()
+        logger = Logger()
+        if scheduler.get_job("fetch_held_jobs") is not None:
+            scheduler.remove_job("fetch_held_jobs")
+
+        job = Job(cron={"hour": "8"}, deps=["sbneverinstalled==1.0"], code="print(1)").save()
+        fetch_store(state, logger)
+        assert len(deps_synced) == 1
+        for synced in list(deps_synced):  # the install and its callback are done
+            synced.result()
+        assert len(deps_synced) == 0
+        manager.shutdown()
+
+        # failed for the retry delay rather than installed again by a triggered sync pass
+        assert "sbneverinstalled==1.0" in manager.failed
+        assert scheduler.get_job("fetch_held_jobs") is None
+        fetch_store(state, logger)
+        assert len(manager.pending) == 0 and not job.reload().sync
+
+        job.update(set__to_be_deleted=True)
+        fetch_store(state, logger)
+
+    def test_invalid_cron_is_rejected(self):
+        state = State()
+        logger = Logger()
+        dep = f"pytest=={pytest.__version__}"
+
+        invalid = Job(cron={"hour": "25"}, deps=[dep], code="print(1)").save()
+        job = Job(cron={"hour": "23"}, deps=[dep], code="print(2)").save()
+        fetch_store(state, logger)
+
+        # the rest of the pass is scheduled, the invalid job is retried once fixed
+        assert scheduler.get_job(str(job.id)) is not None and job.reload().sync
+        assert scheduler.get_job(str(invalid.id)) is None and not invalid.reload().sync
+        assert state.store.locate(str(invalid.id)) is None
+
+        invalid.update(set__cron={"hour": "23"})
+        fetch_store(state, logger)
+        assert scheduler.get_job(str(invalid.id)) is not None and invalid.reload().sync
+
+        Job.objects(id__in=[job.id, invalid.id]).update(set__to_be_deleted=True)
+        fetch_store(state, logger)
+
+
+class TestShard:
+    @classmethod
+    def setup_class(cls):
+        """setup any state specific to the execution of the given class."""
+        setup_logging()
+        logger = Logger()
+        logger.root_logger = logging.getLogger("root")
+        logger.pip_logger = logging.getLogger("pip")
+        logger.code_logger = logging.getLogger("code")
+
+        disconnect()
+        connect(db="scheduler", host="mongomock://localhost")
+
+        state = State()
+        state.store = Store(scheduler=scheduler)
+        state.deps = PackageIndex()
+
+    @classmethod
+    def teardown_class(cls):
+        disconnect()
+
+    def test_partitions_are_leased_once(self):
+        partitions = 32
+        job_ids = [f"test_shard_{n}" for n in range(300)]
+        running = {}  # worker -> jobs it has scheduled
+        lock = threading.Lock()
+
+        def worker(name):
+            def on_acquire(gained):
+                with lock:
+                    running[name].update(j for j in job_ids if partition_of(j, partitions) in gained)
+
+            def on_release(lost):
+                with lock:
+                    running[name].difference_update(j for j in job_ids if partition_of(j, partitions) in lost)
+
+            running[name] = set()
+            return ShardCoordinator(
+                partitions, lease_ttl=1, heartbeat_interval=0.05,
+                on_acquire=on_acquire, on_release=on_release, worker_id=name,
+            ).start()
+
+        def wait_balanced(workers):
+            target = HashRing(w.worker_id for w in workers).assign(partitions)
+            deadline = time.monotonic() + 10
+            while time.monotonic() < deadline:
+                with lock:  # no job is ever scheduled on two workers, even while rebalancing
+                    runs = [sum(j in jobs for jobs in running.values()) for j in job_ids]
+                assert max(runs) <= 1
+                if min(runs) == 1 and all(w.owned == target[w.worker_id] for w in workers):
+                    return
+                time.sleep(0.02)
+            raise AssertionError(f"not balanced: {[len(w.owned) for w in workers]}")
+
+        a = worker("test_shard_a")
+        wait_balanced([a])
+        assert len(a.owned) == partitions
+
+        b, c = worker("test_shard_b"), worker("test_shard_c")
+        wait_balanced([a, b, c])
+        assert all(0 < len(w.owned) < partitions for w in (a, b, c))
+
+        # c dies without handing over, its partitions move once the leases expire
+        c._stopped.set()
+        c._thread.join()
+        with lock:
+            del running["test_shard_c"]
+        wait_balanced([a, b])
+
+        # b leaves cleanly, a takes over on its next heartbeat
+        b.stop()
+        wait_balanced([a])
+        a.stop()
+        assert Worker.objects(worker_id__in=["test_shard_a", "test_shard_b"]).count() == 0
+
+    def test_fetch_store_runs_owned_jobs(self, monkeypatch):
+        state = State()
+        logger = Logger()
+        dep = f"pytest=={pytest.__version__}"
+
+        shard = ShardCoordinator(8, worker_id="test_shard_fetch")
+        shard.owned = {0, 1, 2, 3}
+        monkeypatch.setattr("main.shard", shard)
+
+        rows = [Job(cron={"hour": "23"}, deps=[dep], code=f"print({n})").save() for n in range(40)]
+        fetch_store(state, logger)
+
+        owned = {str(job.id) for job in rows if shard.owns(str(job.id))}
+        assert 0 < len(owned) < len(rows)
+        assert {str(job.id) for job in rows if state.store.locate(str(job.id))} == owned
+        assert all(scheduler.get_job(str(job.id)) is None for job in rows if str(job.id) not in owned)
+
+        # jobs of the other workers are left out of sync for their owner
+        assert {str(job.id) for job in Job.objects(id__in=[job.id for job in rows], sync=True)} == owned
+
+        release_partitions(state, logger, {0, 1, 2, 3})
+        assert all(state.store.locate(str(job.id)) is None for job in rows)
+        assert all(scheduler.get_job(str(job.id)) is None for job in rows)
+
+        Job.objects(id__in=[job.id for job in rows]).delete()
+
+
+class TestSnapshot:
+    @classmethod
+    def setup_class(cls):
+        """setup any state specific to the execution of the given class."""
+        setup_logging()
+        logger = Logger()
+        logger.root_logger = logging.getLogger("root")
+        logger.pip_logger = logging.getLogger("pip")
+        logger.code_logger = logging.getLogger("code")
+
+        disconnect()
+        connect(db="scheduler", host="mongomock://localhost")
+
+        state = State()
+        state.store = Store(scheduler=scheduler)
+        state.deps = PackageIndex()
+
+    @classmethod
+    def teardown_class(cls):
+        disconnect()
+
+    def test_backends(self, tmp_path):
+        kept = JobSpec(
+            id="test_snapshot_kept", bucket="b1", cron={"hour": "1"}, src="print(1)", digest="d1",
+            deps=("pytest",), offset=5, options={"coalesce": False},
+        )
+        removed = JobSpec(id="test_snapshot_removed", bucket="b2", cron={}, src="pass", digest="d2")
+
+        for snapshot in (SQLiteSnapshot(str(tmp_path / "jobs.sqlite")), MongoSnapshot()):
+            snapshot.apply(Plan(add=[kept, removed]))
+            snapshot.apply(Plan(remove=["test_snapshot_removed"]))
+            assert [spec_to_dict(spec) for spec in snapshot.load()] == [spec_to_dict(kept)]
+            snapshot.clear()
+            assert snapshot.load() == []
+
+    def test_warm_restart(self, monkeypatch):
+        state = State()
+        logger = Logger()
+        dep = f"pytest=={pytest.__version__}"
+        db = Job._get_db()
+        MongoSnapshot().clear()
+
+        def boot():
+            jobstore = MongoDBJobStore(database=db.name, collection="test_snapshot_jobs", client=db.client)
+            restarted = BackgroundScheduler(jobstores={"persistent": jobstore})
+            monkeypatch.setattr("main.scheduler", restarted)
+            monkeypatch.setattr("main.snapshot", MongoSnapshot())
+            monkeypatch.setattr(state, "store", Store(scheduler=restarted))
+            return restarted
+
+        first = boot()
+        first.start(paused=True)
+        rows = [Job(cron={"hour": "2"}, deps=[dep], code=f"print({n})").save() for n in range(3)]
+        ids = [str(job.id) for job in rows]
+        fetch_store(state, logger)
+
+        # persisted by reference to run_job and the job id
+        assert all(first.get_job(job_id).func is run_job for job_id in ids)
+        first.shutdown()
+
+        rows[0].update(set__code="print('edited')", set__sync=False)
+        restarted = boot()
+        specs = restore_store(state, logger)
+        assert set(ids) <= {spec.id for spec in specs}
+        assert len(restarted.get_jobs()) == 0  # loaded from the jobstore on start
+
+        restarted.add_job(print, "date", id="test_snapshot_stale", jobstore="persistent")
+        restarted.start(paused=True)
+        assert {job.id for job in restarted.get_jobs(jobstore="persistent")} >= set(ids)
+
+        # the jobs missing from the snapshot are dropped, only the edited job is reconciled
+        resume(state, logger, specs)
+        assert restarted.get_job("test_snapshot_stale") is None
+        assert run_job(ids[0]) == {ids[0]: "edited\n"}
+        assert run_job(ids[1]) == {ids[1]: "1\n"}
+        assert run_job("test_snapshot_unknown") == {}
+        restarted.shutdown()
+
+        Job.objects(id__in=[job.id for job in rows]).delete()
+        db.drop_collection("test_snapshot_jobs")
+        MongoSnapshot().clear()
+
+    def test_warm_restart_missing_deps(self, monkeypatch, tmp_path):
+        state = State()
+        logger = Logger()
+        dep = f"pytest=={pytest.__version__}"
+        db = Job._get_db()
+        MongoSnapshot().clear()
+
+        def boot():
+            jobstore = MongoDBJobStore(database=db.name, collection="test_snapshot_jobs", client=db.client)
+            restarted = BackgroundScheduler(jobstores={"persistent": jobstore})
+            monkeypatch.setattr("main.scheduler", restarted)
+            monkeypatch.setattr("main.snapshot", MongoSnapshot())
+            monkeypatch.setattr(state, "store", Store(scheduler=restarted))
+            return restarted
+
+        first = boot()
+        first.start(paused=True)
+        rows = [Job(cron={"hour": "2"}, deps=[dep], code=f"print({n})").save() for n in range(2)]
+        ids = [str(job.id) for job in rows]
+        fetch_store(state, logger)
+        first.shutdown()
+
+        # a fresh machine: nothing installed, the installs fail
+        manager = DependencyManager(pip=[sys.executable, "-c", "raise SystemExit(1)"])
+        monkeypatch.setattr("main.deps_manager", manager)
+        monkeypatch.setattr(state, "deps", PackageIndex(path=[str(tmp_path)]))
+
+        restarted = boot()
+        specs = restore_store(state, logger)
+        assert len(specs) == 0 and len(state.store.index) == 0
+        assert not any(job.reload().sync for job in rows)  # synced once installed
+
+        restarted.start(paused=True)
+        resume(state, logger, specs)
+        assert len(restarted.get_jobs(jobstore="persistent")) == 0
+        assert all(state.store.locate(job_id) is None for job_id in ids)
+        restarted.shutdown()
+        manager.shutdown()
+
+        Job.objects(id__in=[job.id for job in rows]).delete()
+        db.drop_collection("test_snapshot_jobs")
+        MongoSnapshot().clear()
+
+
+class TestIngest:
+    @classmethod
+    def setup_class(cls):
+        """setup any state specific to the execution of the given class."""
+        disconnect()
+        connect(db="scheduler", host="mongomock://localhost")
+
+    @classmethod
+    def teardown_class(cls):
+        disconnect()
+
+    def test_jsonl(self):
+        rows = [
+            {"cron": {"hour": "3"}, "deps": ["requests"], "code": f"print({n})", "name": "test_ingest"}
+            for n in range(5)
+        ]
+        lines = [json.dumps(row) for row in rows[:3]] + [
+            json.dumps({"cron": {"hour": "25"}, "code": "print(1)"}),
+            json.dumps({"cron": {"hour": "3"}, "code": "print(("}),
+            json.dumps({"cron": {"hour": "3"}, "code": "pass", "owner": "x"}),
+            "",
+            "{not json",
+            json.dumps({"cron": {"hour": "3"}}),
+            json.dumps(dict(rows[0], sync=True)),  # would never be scheduled
+        ] + [json.dumps(row) for row in rows[3:]]
+        rejects = []
+
+        report = ingest(
+            io.StringIO("\n".join(lines)), chunk_size=2, workers=2,
+            on_reject=lambda line, error: rejects.append((line, error)),
+        )
+        assert report == {"read": 11, "inserted": 5, "rejected": 6}
+        assert [line for line, _ in rejects] == [4, 5, 6, 8, 9, 10]
+        assert "internal fields" in rejects[-1][1] and "sync" in rejects[-1][1]
+
+        jobs = Job.objects(name="test_ingest")
+        assert sorted(job.code for job in jobs) == [f"print({n})" for n in range(5)]
+        assert all(not job.sync and job.deps == ["requests"] for job in jobs)
+        jobs.delete()
+
+    def test_csv(self):
+        text = (
+            'name,cron,deps,code,stagger\n'
+            'test_ingest_csv,"{""minute"": ""5""}",requests flask,"import json\nprint(1)",30\n'
+            'test_ingest_csv,"{""minute"": ""61""}",requests,pass,\n'
+        )
+        rejects = []
+
+        report = ingest(io.StringIO(text), "csv", workers=0, on_reject=lambda *reject: rejects.append(reject))
+        assert report == {"read": 2, "inserted": 1, "rejected": 1}
+        assert rejects[0][0] == 4 and "cron" in rejects[0][1]
+
+        job = Job.objects.get(name="test_ingest_csv")
+        assert (job.deps, job.code, job.stagger) == (["requests", "flask"], "import json\nprint(1)", 30)
+        job.delete()
+
+
+class TestExecutor:
+    def test_adaptive_pool(self):
+        pool = AdaptivePool(min_workers=1, max_workers=8, idle_timeout=0.2)
+        release = threading.Event()
+
+        # a burst of blocking jobs grows the pool up to the bound
+        futures = [pool.submit(release.wait) for _ in range(20)]
+        assert pool.workers == 8
+        release.set()
+        assert all(future.result(timeout=5) for future in futures)
+        assert pool.avg_runtime is not None
+
+        # quiet hours shrink it back
+        deadline = time.monotonic() + 5
+        while pool.workers > 1 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert pool.workers == 1
+
+        # short jobs drain through the existing workers
+        assert [pool.submit(abs, -n).result(timeout=5) for n in range(50)] == list(range(50))
+        assert pool.workers <= 2
+        pool.shutdown()
+        assert pool.workers == 0
+
+    def test_adaptive_pool_without_min_workers(self):
+        class RacingQueue:
+            """
+            The worker's second wait times out just as the second job is submitted.
+            """
+
+            def __init__(self):
+                self.items = queue.SimpleQueue()
+                self.puts = self.gets = 0
+                self.second_put = threading.Event()
+
+            def put(self, item):
+                self.items.put(item)
+                self.puts += 1
+                if self.puts == 2:
+                    self.second_put.set()
+
+            def get(self, timeout=None):
+                self.gets += 1
+                if self.gets == 2:
+                    self.second_put.wait(5)
+                    raise queue.Empty
+                return self.items.get(timeout=timeout)
+
+        pool = AdaptivePool(min_workers=0, max_workers=4, idle_timeout=0.2)
+        pool._queue = RacingQueue()
+        assert pool.submit(abs, -1).result(timeout=5) == 1
+
+        deadline = time.monotonic() + 5
+        while pool._idle == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        # the idle worker took the job into account, it must not retire with it queued
+        assert pool.submit(abs, -2).result(timeout=5) == 2
+        pool.shutdown()
+
+
+class TestHistory:
+    @classmethod
+    def setup_class(cls):
+        """setup any state specific to the execution of the given class."""
+        setup_logging()
+        logger = Logger()
+        logger.root_logger = logging.getLogger("root")
+        logger.pip_logger = logging.getLogger("pip")
+        logger.code_logger = logging.getLogger("code")
+
+        disconnect()
+        connect(db="scheduler", host="mongomock://localhost")
+
+    @classmethod
+    def teardown_class(cls):
+        disconnect()
+
+    def test_buffered_writes(self):
+        writer = HistoryWriter(batch_size=15, flush_interval=60, output_limit=5)
+        start = datetime.datetime.utcnow()
+
+        def record(n):
+            status = "error" if n % 5 == 0 else "success"
+            end = start + datetime.timedelta(seconds=n)
+            writer.record("test_history", end - datetime.timedelta(seconds=1), end, status, "output")
+
+        # a full batch goes out in the background, the rest on close
+        for n in range(15):
+            record(n)
+        deadline = time.monotonic() + 5
+        while writer.written < 15 and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        for n in range(15, 25):
+            record(n)
+        assert writer.written == 15 and writer.pending() == 10
+        writer.close()
+
+        runs = last_runs("test_history", limit=30)
+        assert len(runs) == JobRun.objects(job_id="test_history").count() == 25
+        assert runs[0].ended_at > runs[-1].ended_at
+        assert all(run.output == "utput" and run.duration == 1 for run in runs)
+
+        # failed runs are kept longer
+        error = next(run for run in runs if run.status == "error")
+        success = next(run for run in runs if run.status == "success")
+        assert error.expire_at - error.ended_at == datetime.timedelta(days=30)
+        assert success.expire_at - success.ended_at == datetime.timedelta(days=7)
+
+    def test_job_runs_are_recorded(self, monkeypatch):
+        writer = HistoryWriter(flush_interval=60)
+        monkeypatch.setattr("main.history", writer)
+        logger = Logger()
+
+        CodeJob(Code("test_history_ok", "print('ok')", title="ok job"), logger)()
+        CodeJob(Code("test_history_error", "1/0", title="error job"), logger)()
+        CodeJob(Code("test_history_timeout", "import time\ntime.sleep(60)", lazy=True, executor="process", timeout=0.5), logger)()
+        writer.close()
+
+        statuses = {run.job_id: run.status for run in JobRun.objects(job_id__startswith="test_history_")}
+        assert statuses == {"test_history_ok": "success", "test_history_error": "error", "test_history_timeout": "timeout"}
+        names = {run.job_id: run.name for run in JobRun.objects(job_id__startswith="test_history_")}
+        assert names == {"test_history_ok": "ok job", "test_history_error": "error job", "test_history_timeout": ""}
+
+
+class TestLogging:
+    def test_rotation(self, tmp_path):
+        path = tmp_path / "app.log"
+        handler = RotatingGzipFileHandler(str(path), maxBytes=200, backupCount=2)
+        logger = logging.getLogger("test_logs_rotation")
+        logger.propagate = False
+        logger.addHandler(handler)
+
+        for n in range(50):
+            logger.warning("record %s", n)
+
+        # the oldest rotated files are dropped, the rest are gzipped
+        assert sorted(os.listdir(tmp_path)) == ["app.log", "app.log.1.gz", "app.log.2.gz"]
+        with gzip.open(tmp_path / "app.log.1.gz", "rt") as f:
+            last = int(f.read().splitlines()[-1].split()[1])
+        assert path.read_text().startswith(f"record {last + 1}\n")
+
+        # time-based rotation, whatever the size
+        handler.maxBytes, handler.interval = 0, 0.05
+        handler.doRollover()
+        time.sleep(0.1)
+        logger.warning("late record")
+        assert path.read_text() == "late record\n"
+
+        logger.removeHandler(handler)
+        handler.close()
+
+    def test_queue_pipeline(self):
+        class SlowHandler(logging.Handler):
+            def __init__(self):
+                super().__init__()
+                self.records = []
+
+            def emit(self, record):
+                time.sleep(0.001)  # disk latency
+                self.records.append(record.getMessage())
+
+        for policy in ("drop", "block"):
+            handler = SlowHandler()
+            logger = logging.getLogger(f"test_logs_{policy}")
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+            logger.addHandler(handler)
+
+            listener = enqueue_loggers([logger.name], max_size=50, policy=policy)
+            start = time.monotonic()
+            for n in range(500):
+                logger.info("record %s", n)
+            elapsed = time.monotonic() - start
+            stop_listener()
+
+            dropped = listener.queue_handlers[0].dropped
+            assert len(handler.records) + dropped == 500
+            if policy == "drop":
+                # the logging thread never waits on the handler
+                assert dropped > 0 and elapsed < 0.25
+            else:
+                assert dropped == 0 and handler.records == [f"record {n}" for n in range(500)]
+
+            logger.handlers.clear()
+
+
+class TestMetrics:
+    def test_prometheus_text(self):
+        registry = Registry()
+        runs = registry.counter("runs", "Runs.", ["status"])
+        latency = registry.histogram("latency_seconds", "Latency.", buckets=(0.1, 1))
+        registry.gauge("depth", "Depth.", fn=lambda: 3)
+
+        runs.inc(status="ok")
+        runs.inc(2, status="ok")
+        for value in (0.05, 0.5, 0.5, 5):
+            latency.observe(value)
+
+        text = registry.render()
+        assert 'runs_total{status="ok"} 3' in text
+        assert 'latency_seconds_bucket{le="0.1"} 1' in text
+        assert 'latency_seconds_bucket{le="1"} 3' in text
+        assert 'latency_seconds_bucket{le="+Inf"} 4' in text
+        assert "latency_seconds_count 4" in text and "depth 3" in text
+        assert latency.quantile(0.5) == 1
+
+    def test_series_limit(self):
+        runs = Registry().histogram("run_seconds", "Runs.", ["job"], buckets=(1,), max_series=2)
+        for job in ("a", "b", "c", "d", "a"):
+            runs.observe(0.5, job=job)
+
+        # the label values past the limit share one series
+        assert runs.count(job="a") == 2 and runs.count(job="b") == 1
+        assert runs.count(job="c") == 0 and runs.count(job="other") == 2
+        assert 'run_seconds_count{job="other"} 2' in runs.render()
+
+    def test_phase_timer(self):
+        timer = PhaseTimer()
+        with timer.phase("schedule"):
+            time.sleep(0.05)
+            with timer.phase("compile"):
+                time.sleep(0.1)
+
+        # nested phases only count for themselves
+        assert timer.durations["compile"] >= 0.1
+        assert 0.05 <= timer.durations["schedule"] < timer.durations["compile"]
+
+    def test_scheduler_events_and_endpoint(self):
+        scheduler = BackgroundScheduler()
+        instrument_scheduler(scheduler)
+        executed, lags = JOB_EVENTS.value(event="executed"), SCHEDULER_LAG.count()
+
+        scheduler.add_job(lambda: None, "interval", seconds=0.2)
+        scheduler.add_job(lambda: 1 / 0, "interval", seconds=0.2)
+        scheduler.start()
+        time.sleep(0.7)
+        scheduler.shutdown()
+
+        assert JOB_EVENTS.value(event="executed") > executed and JOB_EVENTS.value(event="error") > 0
+        assert SCHEDULER_LAG.count() > lags
+
+        Code("test_metrics", "pass")
+        server = serve(0)
+        with urllib.request.urlopen("http://%s:%s/metrics" % server.server_address) as response:
+            text = response.read().decode()
+        server.shutdown()
+
+        assert 'scheduler_job_events_total{event="executed"}' in text
+        assert f'code_init_seconds_count{{lazy="False"}} {CODE_INIT.count(lazy=False)}' in text
+
+
+class TestStore:
+    def test_index_and_removal(self):
+        class Scheduler:
+            def __init__(self):
+                self.jobs = {}
+
+            def get_job(self, job_id):
+                return self.jobs.get(job_id)
+
+            def remove_job(self, job_id):
+                del self.jobs[job_id]
+
+        scheduler = Scheduler()
+        store = Store(scheduler=scheduler)
+        code_objs = [Code(f"test_store_{n}", "pass") for n in range(1000)]
+
+        for n, code_obj in enumerate(code_objs):
+            store.add(f"bucket_{n % 2}", code_obj)
+            scheduler.jobs[code_obj.name] = code_obj
+
+        assert len(store["bucket_0"]) == len(store["bucket_1"]) == 500
+        assert store.locate("test_store_3") == ("bucket_1", code_objs[3])
+
+        # moving a job keeps the name unique across buckets
+        store.add("bucket_0", code_objs[3])
+        assert store.locate("test_store_3")[0] == "bucket_0"
+        assert len(store["bucket_1"]) == 499
+
+        for code_obj in code_objs:
+            assert store.remove(code_obj.name) is not None
+
+        assert store.remove("test_store_0") is None
+        assert len(store) == 0 and len(store.index) == 0
+        assert scheduler.jobs == {}
+
+    def test_setitem_reindexes(self):
+        store = Store()
+        store["bucket"] = CodeList([Code("test_store_a", "pass"), Code("test_store_b", "pass")])
+        assert set(store.index) == {"test_store_a", "test_store_b"}
+
+        store["bucket"] = CodeList([Code("test_store_b", "pass")])
+        assert set(store.index) == {"test_store_b"}
+
+
+class TestCompileCache:
+    def test_disk_cache(self, tmp_path):
+        src = "print('cached')"
+        directory = str(tmp_path / "bytecode")
+        cache = CompileCache(directory, version="1")
+        code = cache.get(src, compile_src)
+        path = cache._path(cache.key(src))
+
+        # restarts load the marshalled code
+        restarted = CompileCache(directory, version="1")
+        assert restarted.get(src, compile_src) == code and restarted.disk_hits == 1
+
+        # corrupt / truncated files are rebuilt
+        for content in (b"garbage", open(path, "rb").read()[:10], marshal.dumps(42)):
+            with open(path, "wb") as f:
+                f.write(content)
+            rebuilt = CompileCache(directory, version="1")
+            assert rebuilt.get(src, compile_src) == code and rebuilt.misses == 1
+            assert CompileCache(directory, version="1")._load(cache.key(src)) == code
+
+        # a new version of the wrapper doesn't read the old code
+        bumped = CompileCache(directory, version="2")
+        assert bumped.key(src) != cache.key(src)
+        assert bumped.get(src, compile_src) == code and bumped.misses == 1
+
+    def test_pruned_directory(self, tmp_path):
+        directory = str(tmp_path / "bytecode")
+        cache = CompileCache(directory, max_size=0, max_files=10)
+        keep = "print('kept')"
+
+        for n in range(30):
+            cache.get(keep if n % 5 == 0 else f"print({n})", compile_src)
+            time.sleep(0.01)  # distinct mtimes
+
+        # least recently used first, the file in use stays
+        assert len(os.listdir(directory)) <= 10
+        assert os.path.exists(cache._path(cache.key(keep)))
+
+
+class TestDependencyManager:
+    @staticmethod
+    def build_wheel(wheelhouse, name, version):
+        dist_info = f"{name}-{version}.dist-info"
+        files = {
+            f"{name}/__init__.py": f"VERSION = '{version}'\n",
+            f"{dist_info}/METADATA": f"Metadata-Version: 2.1\nName: {name}\nVersion: {version}\n",
+            f"{dist_info}/WHEEL": "Wheel-Version: 1.0\nGenerator: tests\nRoot-Is-Purelib: true\nTag: py3-none-any\n",
+            f"{dist_info}/top_level.txt": f"{name}\n",
+        }
+        record = "".join(f"{path},,\n" for path in files) + f"{dist_info}/RECORD,,\n"
+
+        with zipfile.ZipFile(os.path.join(wheelhouse, f"{name}-{version}-py3-none-any.whl"), "w") as whl:
+            for path, content in files.items():
+                whl.writestr(path, content)
+            whl.writestr(f"{dist_info}/RECORD", record)
+
+    def test_offline_wheelhouse_install(self, tmp_path):
+        wheelhouse = tmp_path / "wheelhouse"
+        target = tmp_path / "site"
+        wheelhouse.mkdir()
+        self.build_wheel(str(wheelhouse), "sbwheelone", "0.1")
+        self.build_wheel(str(wheelhouse), "sbwheeltwo", "0.2")
+
+        manager = DependencyManager(
+            wheelhouse=str(wheelhouse), offline=True, target=str(target), workers=2
+        )
+        future = manager.ensure(["sbwheelone==0.1", "sbwheeltwo", "sbwheelmissing"])
+
+        # requirements already being installed are joined, not installed twice
+        assert set(manager.pending) <= {"sbwheelone==0.1", "sbwheeltwo", "sbwheelmissing"}
+        results = {requirement: ok for requirement, ok, _ in future.result(timeout=300)}
+
+        assert results == {"sbwheelone==0.1": True, "sbwheeltwo": True, "sbwheelmissing": False}
+        assert (target / "sbwheelone" / "__init__.py").exists()
+        assert (target / "sbwheeltwo" / "__init__.py").exists()
+
+        # installed requirements are matched by normalized name and specifier
+        index = PackageIndex(path=[str(target)])
+        assert "SBWheelOne>=0.1" in index and "sbwheeltwo" in index
+        assert "sbwheelone>0.1" not in index and "sbwheelmissing" not in index
+
+        index.versions.clear()
+        index.refresh()
+        assert index.versions == {"sbwheelone": "0.1", "sbwheeltwo": "0.2"}
+
+        # failed requirements are not retried on every sync pass
+        assert manager.ensure(["sbwheelmissing"]) is None
+        manager.shutdown()
+
+    def test_serialized_installs(self, tmp_path):
+        # fails when another run holds the lock file
+        pip = [
+            sys.executable,
+            "-c",
+            f"import os, time\nfd = os.open({str(tmp_path / 'lock')!r}, os.O_CREAT | os.O_EXCL)\n"
+            f"time.sleep(0.2)\nos.close(fd)\nos.remove({str(tmp_path / 'lock')!r})",
+        ]
+        manager = DependencyManager(workers=3, pip=pip)
+
+        results = manager.ensure(["sbone", "sbtwo", "sbthree"]).result(timeout=60)
+        assert all(ok for _, ok, _ in results)
+        manager.shutdown()
+
+    def test_markers_and_urls(self, tmp_path):
+        for name, direct_url in (("sbindexed", None), ("sbvcs", "https://example.com/sb/vcs.git")):
+            dist_info = tmp_path / f"{name}-0.1.dist-info"
+            dist_info.mkdir()
+            (dist_info / "METADATA").write_text(f"Metadata-Version: 2.1\nName: {name}\nVersion: 0.1\n")
+            if direct_url:
+                (dist_info / "direct_url.json").write_text(json.dumps({"url": direct_url, "vcs_info": {"vcs": "git"}}))
+        index = PackageIndex(path=[str(tmp_path)])
+
+        # skipped by pip on other platforms, never held back
+        assert 'sbabsent; sys_platform == "nonexistent"' in index
+        assert f'sbabsent; sys_platform == "{sys.platform}"' not in index
+        assert 'sbindexed>=0.1; sys_platform == "nonexistent"' in index
+
+        # matched by the URL they were installed from, or by name
+        assert "git+https://example.com/sb/vcs.git@v1#egg=sbvcs" in index
+        assert "git+https://example.com/sb/vcs.git" in index
+        assert "sbvcs @ git+https://example.com/sb/vcs.git@main" in index
+        assert "sbindexed @ https://example.com/sbindexed-0.1.tar.gz" in index
+        assert "git+https://example.com/sb/other.git" not in index
+        assert "sbabsent @ https://example.com/sbabsent-0.1.tar.gz" not in index
+        assert "not a requirement !" not in index
+
+    def test_isolated_envs(self, tmp_path):
+        wheelhouse = tmp_path / "wheelhouse"
+        wheelhouse.mkdir()
+        self.build_wheel(str(wheelhouse), "sbenvpkg", "0.1")
+        self.build_wheel(str(wheelhouse), "sbenvpkg", "0.2")
+
+        envs = EnvCache(str(tmp_path / "envs"), wheelhouse=str(wheelhouse), offline=True, grace=0)
+        runner = ProcessRunner()
+        src = "import sbenvpkg\nprint(sbenvpkg.VERSION)"
+
+        # same normalized deps share one environment, conflicting pins get their own
+        assert envs.key(["SBEnvPkg==0.1"]) == envs.key(["sbenvpkg==0.1"])
+        old = envs.ensure(["sbenvpkg==0.1"]).result(timeout=300)
+        new = envs.ensure(["sbenvpkg==0.2"]).result(timeout=300)
+        assert envs.ensure(["SBEnvPkg==0.1"]).result() == old
+
+        assert runner.run_in(old, "test_env_old", src, timeout=60) == "0.1\n"
+        assert runner.run_in(new, "test_env_new", src, timeout=60) == "0.2\n"
+        assert "ModuleNotFoundError" in Code("test_env_base", src).run_with_std_patch()
+
+        assert envs.collect({envs.key(["sbenvpkg==0.2"])}) == [envs.key(["sbenvpkg==0.1"])]
+        assert not envs.is_ready(["sbenvpkg==0.1"]) and envs.is_ready(["sbenvpkg==0.2"])